@@ -0,0 +1,755 @@
+"""Benchmarks for webkitwindow.
+
+Run a single benchmark with `python benchmarks.py <name>` or all of
+them with `python benchmarks.py`. Benchmarks that open a window run
+each window in a subprocess, under xvfb-run when there is no display.
+
+    --json FILE       write the results as JSON
+    --baseline FILE   compare the results to an earlier --json FILE,
+                      exit with status 1 if any result got worse than
+                      --tolerance (a fraction, default 0.15)
+
+Results ending in _per_s are better when higher, all others (times,
+lags, memory) when lower.
+"""
+
+import os
+import sys
+import json
+import base64
+import time
+import argparse
+import resource
+import urlparse
+import subprocess
+import distutils.spawn
+
+import webkitwindow
+
+def _maxrss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def bench_stream_buffer(total=1024**3, write_size=512, read_size=16*1024, checkpoints=10):
+    """Stream total bytes through the FakeReply buffer in small writes.
+
+    The reader drains the buffer like QNetworkReply.readAll does
+    whenever a read_size worth of data is available. Time and peak
+    memory are reported at each checkpoint and should both stay flat.
+    """
+    buf = webkitwindow._ChunkBuffer()
+    chunk = 'x' * write_size
+    step = total // checkpoints
+    written = 0
+    next_checkpoint = step
+    start = last = time.time()
+
+    print 'stream_buffer: %d MB in %d byte writes' % (total // 1024**2, write_size)
+    while written < total:
+        buf.write(chunk)
+        written += write_size
+        if len(buf) >= read_size:
+            while buf.read(read_size):
+                pass
+
+        if written >= next_checkpoint:
+            now = time.time()
+            print '  %5d MB  %6.2fs (+%5.2fs)  maxrss %7.1f MB' % (written // 1024**2, now - start, now - last, _maxrss_mb())
+            last = now
+            next_checkpoint += step
+
+    elapsed = time.time() - start
+    print '  total: %.2fs, %.1f MB/s' % (elapsed, total / 1024.0**2 / elapsed)
+    return {'mb_per_s': total / 1024.0**2 / elapsed, 'maxrss_mb': _maxrss_mb()}
+
+class PageBenchmark(webkitwindow.NetworkHandler):
+
+    """Serve html at / and print the JSON result the page POSTs to /result.
+
+    The result is printed from the handler (which may run in a
+    handler process) as a line starting with RESULT. Subclasses
+    implement .serve(request) for all other urls.
+    """
+
+    timeout = 60 * 1000
+
+    def __init__(self, html):
+        self.html = html
+
+    def startup(self, window):
+        self.window = window
+        window.run_later(window.close, timeout=self.timeout)
+
+    def request(self, req):
+        if req.url_path == '/result':
+            print 'RESULT', self.result(req)
+            sys.stdout.flush()
+            req.found('ok')
+            self.window.close()
+        elif req.url_path == '/':
+            req.found(self.html, 'text/html')
+        else:
+            self.serve(req)
+
+    def serve(self, req):
+        req.notfound()
+
+    def result(self, req):
+        return req.message.body
+
+    def run(self, **kwargs):
+        webkitwindow.WebkitWindow.run(self, exit=False, **kwargs)
+
+def _headless_command():
+    # Qt5 can render offscreen, Qt4 needs an X server
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and distutils.spawn.find_executable('xvfb-run'):
+        return ['xvfb-run', '-a']
+    return []
+
+def _run_isolated(name, *args):
+    # there can only be one QApplication per process -> run each
+    # window in a subprocess and pick the result from its output
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    out = subprocess.check_output(_headless_command() + [sys.executable, os.path.abspath(__file__), name] + [str(a) for a in args], env=env)
+    results = [l for l in out.splitlines() if l.startswith('RESULT ')]
+    return json.loads(results[-1][len('RESULT '):])
+
+_LATENCY_HTML = """
+<html><head><script type="text/javascript">
+var n = %(n)d, i = 0, start;
+function next() {
+  if (i === n) {
+    var r = new XMLHttpRequest();
+    r.open('POST', '/result', true);
+    r.send(JSON.stringify({requests: n, seconds: (Date.now() - start) / 1000}));
+    return;
+  }
+  var x = new XMLHttpRequest();
+  x.open('GET', '/ping?' + i, true);
+  x.onreadystatechange = function() { if (x.readyState === 4) { i++; next(); } };
+  x.send();
+}
+window.onload = function() { start = Date.now(); next(); };
+</script></head><body></body></html>
+"""
+
+class _PingHandler(PageBenchmark):
+
+    def serve(self, req):
+        req.found('pong')
+
+def bench_request_latency(dispatch=None, n=2000):
+    """Sequential XHR round trips for each dispatch mode."""
+    if dispatch is None:
+        print 'request_latency: %d sequential requests' % (n, )
+        results = {}
+        for mode in ('gui', 'threads', 'asyncio'):
+            res = _run_isolated('request_latency', mode, n)
+            results[mode + '_req_per_s'] = res['requests'] / res['seconds']
+            print '  %-8s %8.1f req/s  %6.3f ms/req' % (mode, res['requests'] / res['seconds'], 1000 * res['seconds'] / res['requests'])
+        return results
+    else:
+        _PingHandler(_LATENCY_HTML % {'n': int(n)}).run(dispatch=dispatch)
+
+_RPC_HTML = """
+<html><head><script type="text/javascript">
+var n = %(n)d, mode = '%(mode)s', i = 0, start;
+function done() {
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({calls: n, seconds: (Date.now() - start) / 1000}));
+}
+function xhr() {
+  if (i === n) { return done(); }
+  var x = new XMLHttpRequest();
+  x.open('GET', '/ping?' + i, true);
+  x.onreadystatechange = function() { if (x.readyState === 4) { i++; xhr(); } };
+  x.send();
+}
+function rpc() {
+  if (i === n) { return done(); }
+  python.call('echo', i).then(function() { i++; rpc(); });
+}
+function rpc_batch() {
+  // all calls are made in one tick and cross the bridge in one batch
+  for (var j = 0; j < n; j++) {
+    python.call('echo', j).then(function() { if (++i === n) { done(); } });
+  }
+}
+window.onload = function() { start = Date.now(); window[mode](); };
+</script></head><body></body></html>
+"""
+
+def bench_rpc_latency(mode=None, n=2000):
+    """Round trips through the RPC bridge compared to XHR requests."""
+    if mode is None:
+        print 'rpc_latency: %d calls' % (n, )
+        results = {}
+        for mode in ('xhr', 'rpc', 'rpc_batch'):
+            res = _run_isolated('rpc_latency', mode, n)
+            results[mode + '_calls_per_s'] = res['calls'] / res['seconds']
+            print '  %-10s %8.1f calls/s  %6.3f ms/call' % (mode, res['calls'] / res['seconds'], 1000 * res['seconds'] / res['calls'])
+        return results
+    else:
+        _PingHandler(_RPC_HTML % {'n': int(n), 'mode': mode}).run(rpc={'echo': lambda x: x})
+
+_LAG_HTML = """
+<html><head><script type="text/javascript">
+// the page runs on the Qt main thread -> late timer ticks are event loop lag
+var n = %(n)d, pending = n, interval = 10, lags = [], last, timer, start;
+function tick() {
+  var now = Date.now();
+  lags.push(Math.max(0, now - last - interval));
+  last = now;
+}
+function done() {
+  clearInterval(timer);
+  var max = 0, sum = 0;
+  for (var i = 0; i < lags.length; i++) { max = Math.max(max, lags[i]); sum += lags[i]; }
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({requests: n, seconds: (Date.now() - start) / 1000,
+                         max_lag: max / 1000, mean_lag: sum / lags.length / 1000}));
+}
+window.onload = function() {
+  start = last = Date.now();
+  timer = setInterval(tick, interval);
+  for (var i = 0; i < n; i++) {
+    var x = new XMLHttpRequest();
+    x.open('GET', '/work?' + i, true);
+    x.onreadystatechange = function() { if (this.readyState === 4 && --pending === 0) { done(); } };
+    x.send();
+  }
+};
+</script></head><body></body></html>
+"""
+
+class _CPUBoundHandler(PageBenchmark):
+
+    work_seconds = 0.05
+
+    def serve(self, req):
+        end = time.time() + self.work_seconds
+        while time.time() < end:
+            sum(xrange(1000))
+        req.found('done')
+
+def bench_ui_lag(dispatch=None, n=40):
+    """Event loop lag while the handler burns CPU, in the GUI process or in handler processes."""
+    if dispatch is None:
+        print 'ui_lag: %d requests of %d ms CPU work' % (n, _CPUBoundHandler.work_seconds * 1000)
+        results = {}
+        for mode in ('gui', 'threads', 'process'):
+            res = _run_isolated('ui_lag', mode, n)
+            results[mode + '_max_lag_ms'] = res['max_lag'] * 1000
+            print '  %-8s max lag %7.1f ms  mean lag %6.1f ms  total %5.2fs' % (mode, res['max_lag'] * 1000, res['mean_lag'] * 1000, res['seconds'])
+        return results
+    else:
+        _CPUBoundHandler(_LAG_HTML % {'n': int(n)}).run(dispatch=dispatch, processes=2)
+
+_WEBSOCKET_HTML = """
+<html><head><script type="text/javascript">
+var sockets = %(sockets)d, n = %(n)d, opened = 0, received = 0, start;
+function done() {
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({sockets: sockets, messages: n, seconds: (Date.now() - start) / 1000}));
+}
+function pingpong(ws) {
+  ws.onmessage = function(e) {
+    if (++received === n) { done(); } else { ws.send('ping'); }
+  };
+  start = Date.now();
+  ws.send('ping');
+}
+window.onload = function() {
+  var all = [];
+  for (var i = 0; i < sockets; i++) {
+    var ws = new WebSocket('ws://localhost/echo');
+    ws.onopen = function() { if (++opened === sockets) { pingpong(all[0]); } };
+    ws.onmessage = function() {};
+    all.push(ws);
+  }
+};
+</script></head><body></body></html>
+"""
+
+class _EchoHandler(_PingHandler):
+
+    def connect(self, websocket):
+        websocket.connected()
+
+    def receive(self, websocket, data):
+        websocket.send(data)
+
+def bench_websocket_sockets(sockets=None, n=5000):
+    """Websocket ping-pong latency on one socket while many others are open."""
+    if sockets is None:
+        print 'websocket_sockets: %d round trips on one of N open sockets' % (n, )
+        results = {}
+        for count in (1, 100, 500):
+            res = _run_isolated('websocket_sockets', count, n)
+            results['%d_sockets_rtt_ms' % (count, )] = 1000 * res['seconds'] / res['messages']
+            print '  %4d sockets %8.1f msg/s  %6.3f ms/msg' % (count, res['messages'] / res['seconds'], 1000 * res['seconds'] / res['messages'])
+        return results
+    else:
+        _EchoHandler(_WEBSOCKET_HTML % {'sockets': int(sockets), 'n': int(n)}).run()
+
+_BINARY_HTML = """
+<html><head><script type="text/javascript">
+var mode = '%(mode)s', n = %(n)d, size = %(size)d, received = 0, start, payload;
+function done() {
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({mode: mode, messages: n, bytes: n * size, seconds: (Date.now() - start) / 1000}));
+}
+function toBase64(bytes) {
+  var s = '';
+  for (var i = 0; i < bytes.length; i++) { s += String.fromCharCode(bytes[i]); }
+  return btoa(s);
+}
+function fromBase64(text) {
+  var s = atob(text), bytes = new Uint8Array(s.length);
+  for (var i = 0; i < s.length; i++) { bytes[i] = s.charCodeAt(i); }
+  return bytes;
+}
+function send(ws) {
+  ws.send(mode === 'binary' ? payload : toBase64(payload));
+}
+window.onload = function() {
+  payload = new Uint8Array(size);
+  for (var i = 0; i < size; i++) { payload[i] = i %% 256; }
+  var ws = new WebSocket('ws://localhost/echo');
+  ws.binaryType = 'arraybuffer';
+  ws.onmessage = function(e) {
+    var bytes = mode === 'binary' ? new Uint8Array(e.data) : fromBase64(e.data);
+    if (++received === n) { done(); } else { send(ws); }
+  };
+  ws.onopen = function() { start = Date.now(); send(ws); };
+};
+</script></head><body></body></html>
+"""
+
+class _BinaryEchoHandler(PageBenchmark):
+
+    def __init__(self, html, mode):
+        PageBenchmark.__init__(self, html)
+        self.mode = mode
+
+    def connect(self, websocket):
+        websocket.connected()
+
+    def receive(self, websocket, data):
+        if self.mode == 'binary':
+            websocket.send(data, binary=True)
+        else:
+            websocket.send(base64.b64encode(base64.b64decode(data)))
+
+def bench_websocket_binary(mode=None, n=500, size=64*1024):
+    """Binary websocket echo throughput compared to base64 encoded text messages."""
+    if mode is None:
+        print 'websocket_binary: %d round trips of %d KB' % (n, size // 1024)
+        results = {}
+        for m in ('base64', 'binary'):
+            res = _run_isolated('websocket_binary', m, n, size)
+            results[m + '_mb_per_s'] = res['bytes'] / 1024.0**2 / res['seconds']
+            print '  %-7s %8.1f MB/s  %6.3f ms/msg' % (m, res['bytes'] / 1024.0**2 / res['seconds'], 1000 * res['seconds'] / res['messages'])
+        return results
+    else:
+        _BinaryEchoHandler(_BINARY_HTML % {'mode': mode, 'n': int(n), 'size': int(size)}, mode).run()
+
+_PUSH_HTML = """
+<html><head><script type="text/javascript">
+var sockets = %(sockets)d, n = %(n)d, expected = sockets * n, opened = 0, received = 0, start, all = [];
+function done() {
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({messages: expected, seconds: (Date.now() - start) / 1000}));
+}
+window.onload = function() {
+  for (var i = 0; i < sockets; i++) {
+    var ws = new WebSocket('ws://localhost/push');
+    ws.onopen = function() {
+      if (++opened === sockets) { start = Date.now(); all[0].send('start'); }
+    };
+    ws.onmessage = function() { if (++received === expected) { done(); } };
+    all.push(ws);
+  }
+};
+</script></head><body></body></html>
+"""
+
+class _PushHandler(PageBenchmark):
+
+    def __init__(self, html, mode, n):
+        PageBenchmark.__init__(self, html)
+        self.mode = mode
+        self.n = n
+        self.websockets = []
+
+    def connect(self, websocket):
+        self.websockets.append(websocket)
+        websocket.connected()
+
+    def receive(self, websocket, data):
+        messages = ['{"update": %d}' % i for i in range(self.n)]
+        if self.mode in ('send', 'coalesce'):
+            for ws in self.websockets:
+                for m in messages:
+                    ws.send(m)
+        elif self.mode == 'send_many':
+            for ws in self.websockets:
+                ws.send_many(messages)
+        elif self.mode == 'broadcast':
+            for m in messages:
+                self.window.broadcast(self.websockets, m)
+
+def bench_websocket_push(mode=None, sockets=20, n=2000):
+    """Push small messages to many sockets with single sends, send_many, broadcast and coalescing."""
+    if mode is None:
+        print 'websocket_push: %d messages to each of %d sockets' % (n, sockets)
+        results = {}
+        for m in ('send', 'coalesce', 'send_many', 'broadcast'):
+            res = _run_isolated('websocket_push', m, sockets, n)
+            results[m + '_msg_per_s'] = res['messages'] / res['seconds']
+            print '  %-9s %9.1f msg/s' % (m, res['messages'] / res['seconds'])
+        return results
+    else:
+        html = _PUSH_HTML % {'sockets': int(sockets), 'n': int(n)}
+        _PushHandler(html, mode, int(n)).run(websocket_coalesce=(mode == 'coalesce'))
+
+_STREAM_HTML = """
+<html><head><script type="text/javascript">
+window.onload = function() {
+  var start = Date.now(), x = new XMLHttpRequest();
+  x.open('GET', '/stream', true);
+  x.onreadystatechange = function() {
+    if (x.readyState !== 4) { return; }
+    var r = new XMLHttpRequest();
+    r.open('POST', '/result', true);
+    r.send(JSON.stringify({bytes: x.responseText.length, seconds: (Date.now() - start) / 1000}));
+  };
+  x.send();
+};
+</script></head><body></body></html>
+"""
+
+class _StreamHandler(PageBenchmark):
+
+    def __init__(self, html, total, chunk_size):
+        PageBenchmark.__init__(self, html)
+        self.total = total
+        self.chunk_size = chunk_size
+
+    def serve(self, req):
+        msg = webkitwindow.Message({'Content-Type': 'text/plain'})
+        req.respond(200, msg, streaming=True, high_watermark=1024**2)
+        chunk = 'x' * self.chunk_size
+        for _ in range(self.total // self.chunk_size):
+            msg.write(chunk)
+        msg.close()
+
+def bench_stream_throughput(chunk_size=None, total=64*1024**2):
+    """Streaming response throughput through FakeReply into an XHR."""
+    if chunk_size is None:
+        print 'stream_throughput: %d MB streamed to an XHR' % (total // 1024**2, )
+        results = {}
+        # small writes like a log tail, where write coalescing matters most
+        for size in (128, 4*1024, 64*1024):
+            res = _run_isolated('stream_throughput', size, total if size >= 4096 else total // 16)
+            results['%db_chunks_mb_per_s' % (size, )] = res['bytes'] / 1024.0**2 / res['seconds']
+            print '  %6d B chunks %8.1f MB/s' % (size, res['bytes'] / 1024.0**2 / res['seconds'])
+        return results
+    else:
+        _StreamHandler(_STREAM_HTML, int(total), int(chunk_size)).run(dispatch='threads')
+
+_ASSET_HTML = """
+<html><head><script type="text/javascript">
+var start = Date.now();
+</script></head><body>
+%(images)s
+<script type="text/javascript" src="/app.js"></script>
+</body></html>
+"""
+
+_ASSET_JS = """
+var x = new XMLHttpRequest();
+x.open('GET', '/data', true);
+x.onreadystatechange = function() {
+  if (x.readyState !== 4) { return; }
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send(JSON.stringify({seconds: (Date.now() - start) / 1000}));
+};
+x.send();
+"""
+
+class _AssetHandler(PageBenchmark):
+
+    def serve(self, req):
+        if req.url_path == '/app.js':
+            req.found(_ASSET_JS, 'application/javascript')
+        elif req.url_path == '/data':
+            req.found('{"ok": true}', 'application/json')
+        else:
+            time.sleep(0.005) # e.g. scaling a thumbnail
+            req.found('GIF89a', 'image/gif')
+
+def bench_asset_page(scheduler=None, images=300):
+    """Time until a script and its data arrive on a page with many images, with and without the RequestScheduler."""
+    if scheduler is None:
+        print 'asset_page: script and XHR data after %d images' % (images, )
+        results = {}
+        for mode in ('off', 'on'):
+            res = _run_isolated('asset_page', mode, images)
+            results[mode + '_first_data_ms'] = 1000 * res['seconds']
+            print '  scheduler %-3s %8.1f ms' % (mode, 1000 * res['seconds'])
+        return results
+    else:
+        html = _ASSET_HTML % {'images': '\n'.join('<img src="/thumb/%d.gif">' % i for i in range(int(images)))}
+        _AssetHandler(html).run(dispatch='threads', scheduler=(scheduler == 'on'))
+
+_STARTUP_HTML = """
+<html><head>
+<link rel="stylesheet" href="/style.css">
+<script type="text/javascript" src="/app.js"></script>
+<script type="text/javascript">
+window.onload = function() {
+  var r = new XMLHttpRequest();
+  r.open('POST', '/result', true);
+  r.send('{}');
+};
+</script></head><body></body></html>
+"""
+
+class _StartupHandler(PageBenchmark):
+
+    def __init__(self, html, launched):
+        PageBenchmark.__init__(self, html)
+        self.launched = launched
+        self.events = {}
+
+    def startup(self, window):
+        PageBenchmark.startup(self, window)
+        self.started = time.time()
+
+    def serve(self, req):
+        time.sleep(0.02) # e.g. rendering a template
+        if req.url_path == '/app.js':
+            req.found('var app = {};', 'application/javascript')
+        else:
+            req.found('body { margin: 0; }', 'text/css')
+
+    def timing(self, event, seconds):
+        self.events[event] = time.time() - self.launched
+
+    def result(self, req):
+        return json.dumps(dict(self.events,
+                               window_seconds=self.started - self.launched,
+                               page_seconds=time.time() - self.launched))
+
+def bench_startup(launched=None, preload='off', runs=5):
+    """Time from launching python until the window is up and its first page has loaded, with and without preloading."""
+    if launched is None:
+        print 'startup: best of %d launches' % (runs, )
+        imports = []
+        for _ in range(int(runs)):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', 'import webkitwindow'])
+            imports.append(time.time() - start)
+        results = {'import_ms': 1000 * min(imports)}
+        print '  import webkitwindow %7.1f ms' % (results['import_ms'], )
+        for mode in ('off', 'on'):
+            times = [_run_isolated('startup', repr(time.time()), mode) for _ in range(int(runs))]
+            prefix = 'preload_' if mode == 'on' else ''
+            for key in ('window', 'first_request', 'page'):
+                results[prefix + key + '_ms'] = 1000 * min(t.get(key, t.get(key + '_seconds')) for t in times)
+            print '  preload %-3s window %7.1f ms  first request %7.1f ms  page loaded %7.1f ms' % (
+                mode, results[prefix + 'window_ms'], results[prefix + 'first_request_ms'], results[prefix + 'page_ms'])
+        return results
+    else:
+        handler = _StartupHandler(_STARTUP_HTML, float(launched))
+        handler.run(dispatch='threads', startup_timing=handler.timing,
+                    preload=['/', '/style.css', '/app.js'] if preload == 'on' else None)
+
+def bench_handler_load(total=20000, concurrency=8):
+    """Requests and websocket messages per second straight into a handler, without a window."""
+    total, concurrency = int(total), int(concurrency)
+    client = webkitwindow.LoadClient(_EchoHandler(''))
+    print 'handler_load: %d requests and messages from %d threads' % (total, concurrency)
+    results = {}
+    for name, stats in (('request', client.load([('GET', 'http://localhost/ping')], total, concurrency)),
+                        ('websocket', client.websocket_load('ws://localhost/echo', total, concurrency))):
+        results[name + '_per_s'] = stats['per_s']
+        results[name + '_p99_ms'] = stats['p99'] * 1000
+        print '  %-9s %9.1f /s  p50 %6.3f ms  p99 %6.3f ms' % (name, stats['per_s'], stats['p50'] * 1000, stats['p99'] * 1000)
+    return results
+
+class _IfChainHandler(webkitwindow.NetworkHandler):
+
+    # the usual `if req.url_path == ...` dispatch, one prefix test per route
+
+    def __init__(self, routes):
+        self.routes = ['/api/r%d/' % i for i in range(routes)]
+
+    def request(self, req):
+        for prefix in self.routes:
+            if req.url_path.startswith(prefix):
+                id = int(req.url_path[len(prefix):])
+                return id
+
+def bench_router(routes=None, lookups=50000):
+    """Route lookups of RoutingNetworkHandler compared to an if chain."""
+    if routes is None:
+        print 'router: %d lookups of random routes' % (lookups, )
+        results = {}
+        for count in (10, 100, 1000):
+            for name, res in bench_router(count, lookups).items():
+                results['%d_routes_%s' % (count, name)] = res
+        return results
+
+    routes, lookups = int(routes), int(lookups)
+    router = webkitwindow.RoutingNetworkHandler()
+    for i in range(routes):
+        router.add_route('/api/r%d/<int:id>' % (i, ), lambda req, id: id)
+    requests = [webkitwindow.Request('GET', 'http://localhost/api/r%d/%d' % (i * 7919 % routes, i), webkitwindow.Message(), None)
+                for i in range(1000)]
+
+    results = {}
+    for name, handler in (('if_chain', _IfChainHandler(routes)), ('router', router)):
+        start = time.time()
+        for i in xrange(lookups):
+            handler.request(requests[i % 1000])
+        results[name + '_per_s'] = lookups / (time.time() - start)
+    print '  %4d routes  if chain %9.1f /s  router %9.1f /s' % (routes, results['if_chain_per_s'], results['router_per_s'])
+    return results
+
+class _EagerMessage():
+
+    # Message as it was before headers were checked lazily
+
+    def __init__(self, headers={}, body=None):
+        self.headers = {}
+        for k, v in headers.items():
+            assert isinstance(k, basestring)
+            assert isinstance(v, basestring)
+            self.headers[k] = v
+        self.body = body or ""
+        self._write_fn = None
+        self._close_fn = None
+        self._flow = None
+
+class _EagerRequest():
+
+    # Request as it was before url_* were parsed lazily
+
+    def __init__(self, method, url, message, fake_reply):
+        self.message = message
+        self.method = method
+        self.url = url
+        self.fake_reply = fake_reply
+        self._streaming = False
+        r = urlparse.urlparse(url)
+        self.url_scheme = r.scheme
+        self.url_netloc = r.netloc
+        self.url_path = r.path
+        self.url_params = r.params
+        self.url_query = r.query
+        self.url_query_dict = urlparse.parse_qs(r.query)
+        self.url_fragment = r.fragment
+
+def bench_request_objects(n=100000):
+    """Creating a Request and Message per request, eagerly parsed or lazy with __slots__."""
+    n = int(n)
+    # like the headers webkit sends for an asset, urls differ to defeat the urlparse cache
+    headers = {'Accept': 'text/css,*/*;q=0.1', 'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/534.34',
+               'Referer': 'http://localhost/index.html', 'Accept-Language': 'en-US,*', 'Accept-Encoding': 'gzip'}
+    urls = ['http://localhost/static/style%d.css?v=%d' % (i, i) for i in range(1000)]
+
+    print 'request_objects: %d requests, the handler only reads url_path' % (n, )
+    results = {}
+    for name, request_cls, message_cls in (('eager', _EagerRequest, _EagerMessage),
+                                           ('lazy', webkitwindow.Request, webkitwindow.Message)):
+        start = time.time()
+        for i in xrange(n):
+            request_cls('GET', urls[i % 1000], message_cls(dict(headers)), None).url_path
+        seconds = time.time() - start
+
+        request = request_cls('GET', urls[0], message_cls(dict(headers)), None)
+        request.url_path
+        size = sys.getsizeof(request) + sys.getsizeof(request.message)
+        for obj in (request, request.message):
+            if isinstance(getattr(obj, '__dict__', None), dict) and obj.__dict__:
+                size += sys.getsizeof(obj.__dict__)
+        results[name + '_us'] = 1e6 * seconds / n
+        results[name + '_object_bytes'] = size
+        print '  %-6s %6.2f us/request  %5d bytes per Request and Message' % (name, 1e6 * seconds / n, size)
+    return results
+
+BENCHMARKS = {
+    'asset_page': bench_asset_page,
+    'handler_load': bench_handler_load,
+    'request_objects': bench_request_objects,
+    'router': bench_router,
+    'stream_buffer': bench_stream_buffer,
+    'stream_throughput': bench_stream_throughput,
+    'request_latency': bench_request_latency,
+    'rpc_latency': bench_rpc_latency,
+    'startup': bench_startup,
+    'ui_lag': bench_ui_lag,
+    'websocket_sockets': bench_websocket_sockets,
+    'websocket_binary': bench_websocket_binary,
+    'websocket_push': bench_websocket_push,
+}
+
+def compare(results, baseline, tolerance=0.15):
+    """Print results next to baseline, return the names of results that got worse than tolerance."""
+    regressions = []
+    for name in sorted(results):
+        for key, value in sorted(results[name].items()):
+            old = baseline.get(name, {}).get(key)
+            if not old:
+                print '  %-40s %12.3f  (no baseline)' % (name + '.' + key, value)
+                continue
+            change = (value - old) / float(old)
+            worse = -change if key.endswith('_per_s') else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append(name + '.' + key)
+                flag = '  REGRESSION'
+            print '  %-40s %12.3f  %+7.1f%%%s' % (name + '.' + key, value, 100 * change, flag)
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(description='webkitwindow benchmarks')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare the results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('name', nargs='?', choices=sorted(BENCHMARKS))
+    parser.add_argument('args', nargs='*', help=argparse.SUPPRESS)
+    opts = parser.parse_args(args)
+
+    if opts.args:
+        # a single run, usually in a subprocess started by _run_isolated
+        return BENCHMARKS[opts.name](*opts.args)
+
+    results = {}
+    for name in [opts.name] if opts.name else sorted(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        print 'compared to %s:' % (opts.baseline, )
+        regressions = compare(results, baseline, opts.tolerance)
+        if regressions:
+            print '%d regressions: %s' % (len(regressions), ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,15 @@
 """nosetests for webkitwindow."""
 
+import os
+import sys
+import json
 import time
+import Queue
+import subprocess
+import email.utils
 import threading
 import nose.tools as ntools
+from nose.plugins.skip import SkipTest
 
 import webkitwindow
 
@@ -118,3 +125,864 @@ document.onreadystatechange = function() {
                 self.done = True
 
     webkitwindow.WebkitWindow.run(Handler(), url="http://localhost", exit=False)
+
+def test_chunk_buffer():
+    """Ensure the streaming buffer hands out data in order and drops consumed chunks."""
+    buf = webkitwindow._ChunkBuffer()
+    buf.write('abc')
+    buf.write('')
+    buf.write('defg')
+    ntools.assert_equal(len(buf), 7)
+    ntools.assert_equal(buf.read(2), 'ab')
+    ntools.assert_equal(buf.read(3), 'cde')
+    ntools.assert_equal(len(buf._chunks), 1)
+    ntools.assert_equal(buf.read(100), 'fg')
+    ntools.assert_equal(len(buf), 0)
+    ntools.assert_equal(buf.read(100), None)
+
+def test_file_range():
+    """Ensure Range headers are parsed and file ranges read only their bytes."""
+    ntools.assert_equal(webkitwindow._parse_range('bytes=0-99', 1000), (0, 99))
+    ntools.assert_equal(webkitwindow._parse_range('bytes=900-', 1000), (900, 999))
+    ntools.assert_equal(webkitwindow._parse_range('bytes=-100', 1000), (900, 999))
+    ntools.assert_equal(webkitwindow._parse_range('bytes=500-2000', 1000), (500, 999))
+    ntools.assert_equal(webkitwindow._parse_range('bytes=1000-', 1000), False)
+    ntools.assert_equal(webkitwindow._parse_range('bytes=0-1,5-6', 1000), None)
+    ntools.assert_equal(webkitwindow._parse_range('items=0-1', 1000), None)
+    ntools.assert_equal(webkitwindow._parse_range(None, 1000), None)
+
+    f = webkitwindow._FileRange(os.path.abspath(__file__), 3, 10)
+    try:
+        ntools.assert_equal(len(f), 10)
+        with open(os.path.abspath(__file__), 'rb') as expected:
+            ntools.assert_equal(f.read(4) + f.read(100), expected.read()[3:13])
+        ntools.assert_equal(f.remaining, 0)
+    finally:
+        f.close()
+
+    reply = webkitwindow._DetachedReply(respond=None, write=None, close=None)
+    request = webkitwindow.Request('GET', 'http://localhost/', webkitwindow.Message({}), reply)
+    ntools.assert_raises(IOError, request.found_file, '/nonexistent/file')
+
+    # a reply aborted before the response does not keep the file open
+    opened = []
+    class FileRange(webkitwindow._FileRange):
+        def __init__(self, *args):
+            super(FileRange, self).__init__(*args)
+            opened.append(self)
+    file_range, webkitwindow._FileRange = webkitwindow._FileRange, FileRange
+    try:
+        reply.abort()
+        ntools.assert_false(request.found_file(os.path.abspath(__file__)))
+    finally:
+        webkitwindow._FileRange = file_range
+    ntools.assert_true(opened[0]._file.closed)
+
+def test_lru_cache():
+    """Ensure the LRU cache evicts the least recently used entries beyond its size."""
+    cache = webkitwindow._LRUCache(max_size=10)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    ntools.assert_equal(cache.get('a'), 'aaaa')
+    cache.put('c', 'cccc')
+    ntools.assert_equal(cache.get('b'), None)
+    ntools.assert_equal(cache.get('c'), 'cccc')
+    cache.put('d', 'd' * 11)
+    ntools.assert_equal(cache.get('d'), None)
+    ntools.assert_equal(cache.stats(), {'entries': 2, 'size': 8, 'max_size': 10,
+                                        'hits': 2, 'misses': 2, 'evictions': 1})
+
+def test_not_modified():
+    """Ensure conditional request headers are matched against ETag and Last-Modified."""
+    resource = webkitwindow._Resource('body', 'text/plain', last_modified=1000000000)
+    since = lambda t: webkitwindow.Message({'if-modified-since': email.utils.formatdate(t, usegmt=True)})
+    ntools.assert_true(webkitwindow._not_modified(webkitwindow.Message({'If-None-Match': 'W/%s, "x"' % resource.etag}), resource.etag, resource.last_modified))
+    ntools.assert_false(webkitwindow._not_modified(webkitwindow.Message({'If-None-Match': '"x"'}), resource.etag, resource.last_modified))
+    ntools.assert_true(webkitwindow._not_modified(since(1000000000), resource.etag, resource.last_modified))
+    ntools.assert_false(webkitwindow._not_modified(since(999999999), resource.etag, resource.last_modified))
+    ntools.assert_false(webkitwindow._not_modified(webkitwindow.Message(), resource.etag, resource.last_modified))
+
+def test_found_resource_etag():
+    """Ensure found_resource answers with the passed etag, also for cached resources."""
+    responses = []
+
+    def get(etag=None, if_none_match=None):
+        reply = webkitwindow._DetachedReply(respond=lambda status, text, msg, streaming: responses.append((status, msg.headers['ETag'])),
+                                            write=None,
+                                            close=None)
+        headers = {'If-None-Match': if_none_match} if if_none_match else {}
+        webkitwindow.Request('GET', 'http://localhost/', webkitwindow.Message(headers), reply).found_resource('webkitwindow.py', 'webkitwindow', etag=etag)
+        return responses.pop()
+
+    status, md5_etag = get()
+    ntools.assert_equal(status, 200)
+    ntools.assert_equal(get('"v2"'), (200, '"v2"'))
+    ntools.assert_equal(get('"v2"', if_none_match='"v2"'), (304, '"v2"'))
+    ntools.assert_equal(get('"v3"', if_none_match='"v2"'), (200, '"v3"'))
+    ntools.assert_equal(get(if_none_match=md5_etag), (304, md5_etag))
+
+def test_streaming_backpressure():
+    """Ensure streaming writes wait for the reader once the high watermark is reached."""
+    buf = webkitwindow._ChunkBuffer()
+    flow = webkitwindow._FlowControl(high_watermark=10, low_watermark=4)
+    msg = webkitwindow.Message()
+    msg._set_streaming(write_fn=lambda data: buf.write(data) or True, close_fn=lambda: True, flow=flow)
+
+    drained = []
+    ntools.assert_true(msg.write('x' * 11))
+    ntools.assert_equal(msg.write('y', block=False), None)
+    ntools.assert_equal(msg.write('y', timeout=0.01), None)
+    msg.on_drain(lambda: drained.append(True))
+
+    writer = threading.Thread(target=lambda: msg.write('z'))
+    writer.start()
+    time.sleep(0.05)
+    ntools.assert_true(writer.is_alive())
+
+    flow.consumed(len(buf.read(5)))
+    ntools.assert_equal(drained, [])
+    flow.consumed(len(buf.read(2)))
+    writer.join(1)
+    ntools.assert_false(writer.is_alive())
+    ntools.assert_equal(drained, [True])
+    ntools.assert_equal(buf.read(100), 'xxxxz')
+
+    # a reply aborted before the response reached it never blocks writers
+    reply = webkitwindow._DetachedReply(lambda *args: None, lambda data: None, lambda: None)
+    reply.abort()
+    msg = webkitwindow.Message()
+    req = webkitwindow.Request('GET', 'http://localhost/', webkitwindow.Message(), reply)
+    ntools.assert_false(req.respond(200, msg, streaming=True, high_watermark=10))
+    written = []
+    writer = threading.Thread(target=lambda: written.extend([msg.write('x' * 11), msg.write('y')]))
+    writer.start()
+    writer.join(1)
+    ntools.assert_false(writer.is_alive())
+    ntools.assert_equal(written, [False, False])
+
+def test_response_cache():
+    """Ensure responses are cached according to Cache-Control, expire, get evicted and invalidated."""
+    cache = webkitwindow.ResponseCache(max_size=200)
+    Message = webkitwindow.Message
+    request = Message({'Accept': 'application/json'})
+    key = cache.key('GET', 'http://localhost/a?x=1', request)
+    ntools.assert_equal(cache.key('POST', 'http://localhost/a?x=1', request), None)
+    ntools.assert_equal(cache.lookup(key, request), None)
+
+    ntools.assert_false(cache.store(key, 200, 'OK', Message({}, 'no header')))
+    ntools.assert_false(cache.store(key, 200, 'OK', Message({'Cache-Control': 'no-store, max-age=10'}, 'x')))
+    ntools.assert_false(cache.store(key, 500, 'Error', Message({'Cache-Control': 'max-age=10'}, 'x')))
+    ntools.assert_true(cache.store(key, 200, 'OK', Message({'cache-control': 'max-age=10'}, 'body')))
+    entry = cache.lookup(key, request)
+    ntools.assert_equal((entry.status, entry.body), (200, 'body'))
+    ntools.assert_equal(cache.lookup(key, Message({'Cache-Control': 'no-cache'})), None)
+    ntools.assert_equal(cache.lookup(cache.key('GET', 'http://localhost/a?x=1', Message({})), request), None)
+
+    ntools.assert_equal(cache.invalidate('/a'), 0)
+    ntools.assert_equal(cache.invalidate('/a?x=1'), 1)
+    ntools.assert_equal(cache.lookup(key, request), None)
+
+    cache.store(key, 200, 'OK', Message({'Cache-Control': 'max-age=0.01'}, 'body'))
+    time.sleep(0.02)
+    ntools.assert_equal(cache.lookup(key, request), None)
+
+    for i in range(4):
+        cache.store(('GET', 'http://localhost/%d' % i), 200, 'OK', Message({'Cache-Control': 'max-age=10'}, 'x' * 30))
+    ntools.assert_equal(cache.invalidate('http://localhost/', prefix=True), 3)
+
+    stats = cache.stats()
+    ntools.assert_equal((stats['hits'], stats['misses'], stats['expired'], stats['evictions']), (1, 5, 1, 1))
+    ntools.assert_almost_equal(stats['hit_rate'], 1 / 6.0)
+
+    # lookups from several threads are all counted
+    threads = [threading.Thread(target=lambda: [cache.lookup(key, request) for _ in range(1000)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = cache.stats()
+    ntools.assert_equal(stats['hits'] + stats['misses'], 4006)
+
+def test_request_scheduler():
+    """Ensure requests are dispatched by priority within their class limits and aborted ones are dropped."""
+    def request(url, accept='*/*'):
+        return webkitwindow.Request('GET', url, webkitwindow.Message({'Accept': accept}), None)
+
+    ntools.assert_equal(webkitwindow.classify_request(request('/', 'text/html,application/xhtml+xml')), 'document')
+    ntools.assert_equal(webkitwindow.classify_request(request('/app.js')), 'script')
+    ntools.assert_equal(webkitwindow.classify_request(request('/api/items')), 'data')
+    ntools.assert_equal(webkitwindow.classify_request(request('/thumb/1.png')), 'image')
+    ntools.assert_equal(webkitwindow.classify_request(request('/events', 'text/event-stream')), None)
+
+    scheduler = webkitwindow.RequestScheduler(limits={'image': 2})
+    dispatched = []
+    images = [request('/thumb/%d.png' % i) for i in range(5)]
+    for r in images:
+        scheduler.submit(r, dispatched.append)
+    ntools.assert_equal(dispatched, images[:2])
+
+    script = request('/app.js')
+    scheduler.submit(script, dispatched.append)
+    ntools.assert_true(dispatched[-1] is script)
+
+    scheduler.done(images[2]) # aborted while queued
+    scheduler.done(images[0])
+    ntools.assert_true(dispatched[-1] is images[3])
+    scheduler.done(images[0])
+    scheduler.done(images[1])
+    ntools.assert_true(dispatched[-1] is images[4])
+    stats = scheduler.stats()['image']
+    ntools.assert_equal((stats['dispatched'], stats['dropped'], stats['active'], stats['queued']), (4, 1, 2, 0))
+
+    scheduler = webkitwindow.RequestScheduler(max_active=1)
+    dispatched = []
+    first, image, data = request('/a.png'), request('/b.png'), request('/data')
+    for r in (first, image, data):
+        scheduler.submit(r, dispatched.append)
+    scheduler.done(first)
+    ntools.assert_equal(dispatched, [first, data])
+
+    # a handler that never responds gives up its slot after slot_timeout
+    scheduler = webkitwindow.RequestScheduler(limits={'image': 1}, slot_timeout=1)
+    dispatched = []
+    stuck, image = request('/stuck.png'), request('/c.png')
+    for r in (stuck, image):
+        scheduler.submit(r, dispatched.append)
+    scheduler._expire(stuck)
+    ntools.assert_equal(dispatched, [stuck, image])
+    scheduler._expire(image)
+    scheduler.done(image)
+    ntools.assert_equal(scheduler.stats()['image']['expired'], 2)
+    ntools.assert_equal(scheduler.stats()['image']['active'], 0)
+
+def test_request_body_stream():
+    """Ensure streamed request bodies hand out data as it arrives, buffered or spooled."""
+    for spool_size in (None, 10):
+        body = webkitwindow.RequestBody(length=30, spool_size=spool_size, max_buffer=16)
+        body._feed('a' * 20)
+        ntools.assert_equal(body._full(), spool_size is None)
+        ntools.assert_equal(body.read(5), 'aaaaa')
+        ntools.assert_equal(body.read(100), 'a' * 15)
+        ntools.assert_equal(body.read(1, block=False), None)
+
+        feeder = threading.Thread(target=lambda: body._feed('b' * 10) or body._finish())
+        feeder.start()
+        ntools.assert_equal(body.read(), 'b' * 10)
+        feeder.join(1)
+        ntools.assert_equal(body.read(1), '')
+        ntools.assert_equal(body.received, 30)
+
+    completed = []
+    body = webkitwindow.RequestBody()
+    body.on_complete(completed.append)
+    body._feed('xyz')
+    body._finish('aborted')
+    ntools.assert_equal(completed, [body])
+    ntools.assert_equal(body.read(10), 'xyz')
+    ntools.assert_raises(IOError, body.read)
+
+    # bodies passed on to a handler process pause the reading side until they are sent
+    sent = []
+    body = webkitwindow.RequestBody(max_buffer=4)
+    body._feed('abc')
+    body._set_sink(sent.append, lambda error: None)
+    body._feed('def')
+    ntools.assert_equal(sent, ['abc', 'def'])
+    ntools.assert_true(body._full())
+    body._sent(6)
+    ntools.assert_false(body._full())
+
+    # the Qt main thread must not wait for data it would have to receive itself
+    gui_thread_ident = webkitwindow._gui_thread_ident
+    webkitwindow._gui_thread_ident = threading.current_thread().ident
+    try:
+        body = webkitwindow.RequestBody()
+        ntools.assert_raises(AssertionError, body.read, 1)
+        body._feed('x')
+        ntools.assert_equal(body.read(1), 'x')
+    finally:
+        webkitwindow._gui_thread_ident = gui_thread_ident
+
+def test_request_abort():
+    """Ensure handlers learn about aborted requests and completions after an abort are counted."""
+    completed = []
+    reply = webkitwindow._DetachedReply(respond=lambda *args: None, write=None, close=None,
+                                        aborted_completed=lambda: completed.append(True))
+    request = webkitwindow.Request('GET', 'http://localhost/slow', webkitwindow.Message(), reply)
+    aborted = []
+    request.on_abort(lambda: aborted.append(1))
+    ntools.assert_false(request.is_aborted())
+    ntools.assert_false(request.abort_token)
+
+    reply.abort()
+    ntools.assert_true(request.is_aborted())
+    ntools.assert_true(request.abort_token.wait(0))
+    request.on_abort(lambda: aborted.append(2))
+    ntools.assert_equal(aborted, [1, 2])
+
+    ntools.assert_false(request.found('late'))
+    ntools.assert_equal(completed, [True])
+
+    # aborting after the handler completed does not notify anyone
+    reply = webkitwindow._DetachedReply(respond=lambda *args: None, write=None, close=None)
+    request = webkitwindow.Request('GET', 'http://localhost/fast', webkitwindow.Message(), reply)
+    request.on_abort(lambda: aborted.append(3))
+    ntools.assert_true(request.found('done'))
+    reply.abort()
+    ntools.assert_equal(aborted, [1, 2])
+
+def test_metrics():
+    """Ensure latency histograms are aggregated per stage and exported."""
+    events = []
+    metrics = webkitwindow.Metrics(sink=events.append, max_paths=2)
+    trace = webkitwindow._RequestTrace('GET', 'http://localhost/a?x=1', created=100.0)
+    trace.started, trace.returned, trace.responded, trace.status = 100.001, 100.003, 100.004, 200
+    trace.finish(metrics, aborted=False)
+    ntools.assert_equal(events[0]['path'], '/a')
+    ntools.assert_equal(events[0]['status'], 200)
+    ntools.assert_almost_equal(events[0]['request_handler'], 0.002)
+
+    metrics.observe('request_total', 'GET', '/b', 0.2)
+    metrics.observe('request_total', 'GET', '/c', 20)
+    totals = [s for s in metrics.snapshot() if s['stage'] == 'request_total']
+    ntools.assert_equal([s['path'] for s in totals], ['/a', '/b', 'other'])
+    ntools.assert_equal(totals[2]['buckets'][-1], (None, 1))
+
+    text = metrics.prometheus()
+    ntools.assert_equal(text.count('# TYPE webkitwindow_request_total_seconds histogram'), 1)
+    ntools.assert_true('webkitwindow_request_total_seconds_bucket{method="GET",path="/b",le="0.25"} 1' in text)
+    ntools.assert_true('webkitwindow_request_total_seconds_bucket{method="GET",path="/b",le="0.1"} 0' in text)
+    ntools.assert_true('webkitwindow_request_total_seconds_count{method="GET",path="other"} 1' in text)
+
+def test_loop_watchdog_slow_handler():
+    """Ensure slow handler calls are reported with their request and a stack sample."""
+    reports = []
+    watchdog = webkitwindow.LoopWatchdog(threshold=0.05, interval=0.01, callback=reports.append, sample_stacks=True)
+    # what start() does, without a Qt timer
+    watchdog._gui_ident = threading.current_thread().ident
+    watchdog._last_tick = time.time() + 10
+    sampler = threading.Thread(target=watchdog._sample_loop)
+    sampler.start()
+
+    def slow_handler(request):
+        time.sleep(0.15)
+
+    request = webkitwindow.Request('GET', 'http://localhost/slow', webkitwindow.Message(), None)
+    try:
+        watchdog.call('request', request, lambda: None)
+        watchdog.call('request', request, slow_handler, request)
+    finally:
+        watchdog.stop()
+        sampler.join(1)
+
+    ntools.assert_equal(len(reports), 1)
+    ntools.assert_equal(reports[0]['url'], 'http://localhost/slow')
+    ntools.assert_equal(reports[0]['event'], 'request')
+    ntools.assert_true(reports[0]['duration'] >= 0.15)
+    ntools.assert_true('slow_handler' in reports[0]['stack'])
+    ntools.assert_equal(watchdog.stats()['slow_calls'], 1)
+
+def test_load_client():
+    """Ensure the load client drives a handler without a window and reports latencies."""
+    class Handler(webkitwindow.NetworkHandler):
+
+        def request(self, req):
+            if req.url_path == '/later':
+                threading.Thread(target=lambda: req.found('later')).start()
+            elif req.url_path == '/stream':
+                msg = webkitwindow.Message()
+                req.respond(200, msg, streaming=True)
+                msg.write('a')
+                msg.write('b')
+                msg.close()
+            elif req.url_path == '/watermark':
+                msg = webkitwindow.Message()
+                req.respond(200, msg, streaming=True, high_watermark=1000)
+                self.written = [msg.write('x' * 500, timeout=1) for _ in range(10)]
+                msg.close()
+            else:
+                req.found(req.url_query or 'hello')
+
+        def connect(self, websocket):
+            websocket.connected()
+
+        def receive(self, websocket, data):
+            websocket.send(data.upper())
+
+    handler = Handler()
+    client = webkitwindow.LoadClient(handler)
+    ntools.assert_equal(client.request('GET', 'http://localhost/').body, 'hello')
+    ntools.assert_equal(client.request('GET', 'http://localhost/later', timeout=1).body, 'later')
+    ntools.assert_equal(client.request('GET', 'http://localhost/stream').body, 'ab')
+    ntools.assert_equal(len(client.request('GET', 'http://localhost/watermark', timeout=5).body), 5000)
+    ntools.assert_equal(handler.written, [True] * 10)
+
+    ws = client.connect('ws://localhost/echo', timeout=1)
+    ws.send(u'hi')
+    ntools.assert_equal(ws.receive(1), u'HI')
+    ws.close()
+
+    stats = client.load([('GET', 'http://localhost/?x'), ('GET', 'http://localhost/later')], total=200, concurrency=4)
+    ntools.assert_equal(stats['requests'], 200)
+    ntools.assert_equal(stats['errors'], 0)
+    ntools.assert_equal(stats['statuses'], {200: 200})
+    ntools.assert_true(stats['p50'] <= stats['p99'] <= stats['max'])
+
+    stats = client.websocket_load('ws://localhost/echo', messages=100, concurrency=3)
+    ntools.assert_equal(stats['messages'], 100)
+    ntools.assert_equal(stats['errors'], 0)
+
+def test_routing_network_handler():
+    """Ensure routes are matched with typed parameters and unknown routes or methods are rejected."""
+    handler = webkitwindow.RoutingNetworkHandler()
+    handler.add_route('/users/<int:id>', lambda req, id: req.found('int %r' % (id, )), methods=('GET', 'PUT'))
+    handler.add_route('/users/<name>', lambda req, name: req.found('str %s' % (name, )))
+    handler.add_route('/users/me', lambda req: req.found('me'))
+    handler.add_route('/teams/me/settings', lambda req: req.found('settings'))
+    handler.add_route('/teams/<name>', lambda req, name: req.found('team %s' % (name, )))
+    handler.add_route('/files/<path:rest>', lambda req, rest: req.found(rest))
+
+    class Echo(webkitwindow.NetworkHandler):
+        def connect(self, websocket):
+            websocket.connected()
+        def receive(self, websocket, data):
+            websocket.send(websocket.route_params['room'] + data)
+    handler.add_websocket('/chat/<room>', Echo())
+
+    client = webkitwindow.LoadClient(handler)
+    get = lambda path, method='GET': client.request(method, 'http://localhost' + path)
+    ntools.assert_equal(get('/users/42').body, 'int 42')
+    ntools.assert_equal(get('/users/bob').body, 'str bob')
+    ntools.assert_equal(get('/users/me').body, 'me')
+    ntools.assert_equal(get('/teams/me').body, 'team me')
+    ntools.assert_equal(get('/teams/me/settings').body, 'settings')
+    ntools.assert_equal(get('/users/42', 'HEAD').body, 'int 42')
+    ntools.assert_equal(get('/files/a/b.txt').body, 'a/b.txt')
+    ntools.assert_equal(get('/users/a%2Fb').body, 'str a/b')
+    ntools.assert_raises(ValueError, handler.add_route, '/files/<path:other>', lambda req, other: None)
+    ntools.assert_equal(get('/nothing').status, 404)
+    response = get('/users/42', 'DELETE')
+    ntools.assert_equal(response.status, 405)
+    ntools.assert_equal(response.headers['Allow'], 'GET, PUT')
+
+    ws = client.connect('ws://localhost/chat/lobby', timeout=1)
+    ws.send(u'!')
+    ntools.assert_equal(ws.receive(1), u'lobby!')
+    ntools.assert_raises(IOError, client.connect, 'ws://localhost/nowhere', 0.01)
+
+def test_lazy_request_attributes():
+    """Ensure url attributes and headers are parsed on first access and behave as before."""
+    msg = webkitwindow.Message({'X-Name': u'J\xfcrgen'}, u'\xe4')
+    ntools.assert_equal(msg._headers, None)
+    ntools.assert_equal(msg.headers, {'X-Name': 'J\xc3\xbcrgen'})
+    ntools.assert_equal(msg.body, '\xc3\xa4')
+
+    req = webkitwindow.Request('GET', 'http://localhost:8000/a/b;p?x=1&x=2&y=3#top', msg, None)
+    ntools.assert_equal(req._url_parts, None)
+    ntools.assert_equal((req.url_scheme, req.url_netloc, req.url_path, req.url_params, req.url_query, req.url_fragment),
+                        ('http', 'localhost:8000', '/a/b', 'p', 'x=1&x=2&y=3', 'top'))
+    ntools.assert_equal(req.url_query_dict, {'x': ['1', '2'], 'y': ['3']})
+
+    # handlers may still attach their own attributes
+    req.user = 'bob'
+    ntools.assert_equal(req.user, 'bob')
+    msg.user = 'bob'
+    ntools.assert_equal(msg.user, 'bob')
+
+def test_write_coalescing():
+    """Ensure streaming writes are passed on in batches, by size, timer or explicit flush."""
+    emitted = []
+    timers = []
+    run_later = webkitwindow.WebkitWindow.run_later
+    webkitwindow.WebkitWindow.run_later = staticmethod(lambda f, timeout=None: timers.append(f))
+    try:
+        coalescer = webkitwindow._WriteCoalescer(emitted.append, flush_interval=0, flush_size=10)
+        for line in ('a\n', 'b\n', 'c\n'):
+            coalescer.write(line)
+        ntools.assert_equal((emitted, len(timers)), ([], 1))
+        timers.pop()()
+        ntools.assert_equal(emitted, ['a\nb\nc\n'])
+
+        coalescer.write('0123')
+        coalescer.write('456789')
+        ntools.assert_equal(emitted[-1], '0123456789')
+        coalescer.write('x')
+        coalescer.flush()
+        ntools.assert_equal(emitted[-1], 'x')
+        ntools.assert_equal((coalescer.writes, coalescer.flushes), (6, 3))
+    finally:
+        webkitwindow.WebkitWindow.run_later = run_later
+
+def test_event_stream():
+    """Ensure events are framed, fanned out, replayed after Last-Event-ID and closed."""
+    ntools.assert_equal(webkitwindow._encode_event(u'a\nb', event='x', id='7'), 'event: x\nid: 7\ndata: a\ndata: b\n\n')
+    ntools.assert_equal(webkitwindow._encode_event('a\rb'), 'data: a\ndata: b\n\n')
+    ntools.assert_raises(ValueError, webkitwindow._encode_event, 'a', event='x\ndata: injected')
+    ntools.assert_raises(ValueError, webkitwindow._encode_event, 'a', id='7\r')
+
+    stream = webkitwindow.EventStream(replay=2, heartbeat=None)
+    handler = webkitwindow.NetworkHandler()
+    handler.request = stream.subscribe
+    client = webkitwindow.LoadClient(handler)
+
+    first = client.request_async('GET', 'http://localhost/events')
+    second = client.request_async('GET', 'http://localhost/events')
+    ntools.assert_equal(stream.subscribers(), 2)
+    ntools.assert_equal(stream.publish('one'), '1')
+    stream.publish('two', event='update')
+    stream.publish('three')
+    ntools.assert_equal(first._chunks, ['id: 1\ndata: one\n\n', 'event: update\nid: 2\ndata: two\n\n', 'id: 3\ndata: three\n\n'])
+    ntools.assert_equal(second._chunks, first._chunks)
+    ntools.assert_true(second._chunks[0] is first._chunks[0])
+    ntools.assert_equal(first.headers['Content-Type'], 'text/event-stream; charset=utf-8')
+
+    resumed = client.request_async('GET', 'http://localhost/events', {'Last-Event-ID': '2'})
+    ntools.assert_equal(resumed._chunks, ['id: 3\ndata: three\n\n'])
+
+    stream.close()
+    ntools.assert_true(first.wait(1))
+    ntools.assert_equal(stream.subscribers(), 0)
+
+def test_rpc_backend():
+    """Ensure a batch of javascript calls is answered with one batch of results."""
+    class Handler(object):
+        _dispatcher = None
+        def _call(self, event, target, key, f, *args):
+            f(*args)
+
+    def fail():
+        raise ValueError('nope')
+
+    backend = webkitwindow.RPCBackend(Handler(), {'add': lambda a, b: a + b, 'fail': fail})
+    backend.expose('now', lambda: object())
+    results = []
+    backend.onresults.connect(lambda frame_id, res: results.append((frame_id, json.loads(res))))
+    frame_id = backend.register_frame()
+    backend.call_batch(frame_id, json.dumps([[0, 'add', [1, 2]], [1, 'fail', []], [2, 'missing', []], [3, 'now', []]]))
+    ntools.assert_equal(results, [])
+    backend._flush_results()
+    ntools.assert_equal(len(results), 1)
+    ntools.assert_equal(results[0][0], frame_id)
+    ntools.assert_equal([r[:2] for r in results[0][1]], [[0, True], [1, False], [2, False], [3, False]])
+    ntools.assert_equal(results[0][1][0][2], 3)
+    ntools.assert_equal(results[0][1][1][2], 'ValueError: nope')
+
+    call = webkitwindow.RPCCall('update')
+    done = []
+    call.add_done_callback(done.append)
+    call._set(True, 42)
+    ntools.assert_equal(call.result(0), 42)
+    ntools.assert_equal(done, [call])
+    failed = webkitwindow.RPCCall('update')
+    failed._set(False, 'Error: boom')
+    ntools.assert_raises(webkitwindow.RPCError, failed.result, 0)
+
+    # calls into javascript go to the frame that exposed the function
+    jscalls = []
+    backend.onjscall.connect(lambda frame_id, calls: jscalls.append((frame_id, json.loads(calls))))
+    frame = object()
+    backend.clear_frame(frame)
+    frame_id = backend.register_frame()
+    backend.js_expose(frame_id, 'update')
+    call = backend.call_js('update', 1)
+    missing = backend.call_js('missing')
+    ntools.assert_raises(webkitwindow.RPCError, missing.result, 0)
+    backend._flush_jscalls()
+    ntools.assert_equal([f for f, calls in jscalls], [frame_id])
+    ntools.assert_equal(jscalls[0][1][0][1:], ['update', [1]])
+    ntools.assert_false(call.done())
+
+    # the frame that exposed a name last gets its calls, even if it registered first
+    other = object()
+    backend.clear_frame(other)
+    other_id = backend.register_frame()
+    backend.js_expose(other_id, 'refresh')
+    backend.js_expose(frame_id, 'refresh')
+    backend.call_js('refresh')
+    backend._flush_jscalls()
+    ntools.assert_equal(jscalls[-1][0], frame_id)
+
+    # reloading the frame forgets its functions and fails the calls it did not answer
+    backend.clear_frame(frame)
+    ntools.assert_raises(webkitwindow.RPCError, call.result, 0)
+    backend.register_frame()
+    ntools.assert_raises(webkitwindow.RPCError, backend.call_js('update').result, 0)
+
+def test_lazy_gui_import():
+    """Ensure importing webkitwindow does not load QtWebKit."""
+    out = subprocess.check_output([sys.executable, '-c', 'import sys, webkitwindow; print sorted(m for m in sys.modules if m.endswith(("QtGui", "QtWebKit")))'])
+    ntools.assert_equal(out.strip(), '[]')
+
+    # the public classes are there once asked for
+    script = '; '.join([
+        'import webkitwindow',
+        'assert webkitwindow.CustomQWebPage is None',
+        'webkitwindow.import_gui()',
+        'print issubclass(webkitwindow.CustomQWebPage, webkitwindow.QtWebKit.QWebPage), webkitwindow.CustomQWebPage.__doc__.split(None, 1)[0]',
+    ])
+    out = subprocess.check_output([sys.executable, '-c', script])
+    ntools.assert_equal(out.split(), ['True', 'QWebPage'])
+
+def test_preloader():
+    """Ensure preloaded responses are handed out once, also when requested before they are complete."""
+    class Reply(object):
+        def __init__(self):
+            self.events = []
+            self.fake_response = webkitwindow._Callback(lambda *args: self.events.append(('respond', ) + args))
+            self.fake_response_write = webkitwindow._Callback(lambda data: self.events.append(('write', data)))
+            self.fake_response_close = webkitwindow._Callback(lambda: self.events.append(('close', )))
+        def _handler_done(self):
+            pass
+
+    pending = []
+    preloader = webkitwindow._Preloader()
+    preloader.start(['http://localhost', 'http://localhost/app.js', 'http://localhost/events'], pending.append, 'http://localhost')
+    ntools.assert_equal([r.url for r in pending], ['http://localhost', 'http://localhost/app.js', 'http://localhost/events'])
+    ntools.assert_true(pending[0].message.headers['Accept'].startswith('text/html'))
+    ntools.assert_equal(pending[1].message.headers['Accept'], '*/*')
+
+    pending[0].found('<html>', 'text/html')
+    reply = Reply()
+    preloader.take('http://localhost/').attach(reply)
+    ntools.assert_equal(reply.events[0][1:3], (200, 'Found'))
+    ntools.assert_equal(reply.events[0][3].body, '<html>')
+    ntools.assert_equal(preloader.take('http://localhost/'), None)
+
+    # streamed data is buffered up to the watermark and passed on as it arrives once taken
+    msg = webkitwindow.Message({'Content-Type': 'application/javascript'})
+    pending[1].respond(200, msg, streaming=True, high_watermark=10)
+    ntools.assert_true(msg.write('var a;'))
+    ntools.assert_true(msg.write('var b;'))
+    ntools.assert_equal(msg.write('var c;', block=False), None)
+    reply = Reply()
+    preloader.take('http://localhost/app.js').attach(reply)
+    ntools.assert_equal([e[0] for e in reply.events], ['respond', 'write'])
+    ntools.assert_equal(reply.events[1][1], 'var a;var b;')
+    reply.events[0][3]._flow.consumed(12)
+    msg.write('var c;')
+    msg.close()
+    ntools.assert_equal(reply.events[2:], [('write', 'var c;'), ('close', )])
+
+    # responses nobody asked for stop their handlers
+    msg = webkitwindow.Message({'Content-Type': 'text/event-stream'})
+    pending[2].respond(200, msg, streaming=True, high_watermark=10)
+    msg.write('x' * 11)
+    preloader.clear()
+    ntools.assert_false(msg.write('y'))
+
+    timer = webkitwindow._StartupTimer()
+    timer.mark('app_created')
+    first = timer.times['app_created']
+    timer.mark('app_created')
+    ntools.assert_equal(timer.times.items(), [('app_created', first)])
+
+def test_worker_pool_ordering():
+    """Ensure the worker pool keeps functions with the same key in order."""
+    pool = webkitwindow._WorkerPool(4)
+    results = []
+    done = threading.Event()
+
+    def work(i):
+        time.sleep(0.001 * (i % 3))
+        results.append(i)
+        if i == 19:
+            done.set()
+
+    for i in range(20):
+        pool.submit(lambda i=i: work(i), key='websocket-1')
+
+    ntools.assert_true(done.wait(5))
+    pool.close()
+    ntools.assert_equal(results, range(20))
+    stats = pool.stats()
+    ntools.assert_equal(stats['submitted'], 20)
+    ntools.assert_equal(stats['queue_depth'], 0)
+
+def test_asyncio_dispatcher():
+    """Ensure coroutines with the same key run one after another on the loop."""
+    try:
+        asyncio = webkitwindow._import_asyncio()
+    except ImportError:
+        raise SkipTest("neither asyncio nor trollius is installed")
+
+    dispatcher = webkitwindow._AsyncioDispatcher()
+    results = []
+    done = threading.Event()
+
+    @asyncio.coroutine
+    def work(i):
+        yield asyncio.From(asyncio.sleep(0.01 * (3 - i), loop=dispatcher.loop))
+        results.append(i)
+        if i == 2:
+            done.set()
+
+    for i in range(3):
+        dispatcher.submit(lambda i=i: work(i), key='websocket-1')
+
+    ntools.assert_true(done.wait(5))
+    dispatcher.close()
+    ntools.assert_equal(results, [0, 1, 2])
+
+def test_process_handler():
+    """Ensure requests are answered by a handler process, which is restarted after a crash."""
+
+    class Handler(webkitwindow.NetworkHandler):
+
+        def request(self, request):
+            if request.url_path == '/crash':
+                os._exit(1)
+            if request.url_path == '/stream':
+                msg = webkitwindow.Message({'Content-Type': 'text/plain'})
+                request.respond(200, msg, streaming=True, high_watermark=1000)
+                for i in range(10):
+                    msg.write('x' * 500, timeout=5)
+                msg.close()
+                return
+            if request.url_path == '/unread':
+                msg = webkitwindow.Message({'Content-Type': 'text/plain'})
+                request.respond(200, msg, streaming=True, high_watermark=1000)
+                for i in range(4):
+                    msg.write('x' * 500, timeout=0.2)
+                msg.close()
+                return
+            request.found('%s:%s' % (os.getpid(), request.message.body))
+
+    responses = Queue.Queue()
+
+    def make_request(path, body=None):
+        reply = webkitwindow._DetachedReply(respond=lambda status, text, msg, streaming: responses.put((status, msg.body)),
+                                            write=None,
+                                            close=None)
+        return webkitwindow.Request('POST', 'http://localhost' + path, webkitwindow.Message({}, body), reply)
+
+    # fork the way run() does, from the Qt main thread
+    gui_thread_ident = webkitwindow._gui_thread_ident
+    webkitwindow._gui_thread_ident = threading.current_thread().ident
+    handler = webkitwindow._ProcessNetworkHandler(Handler(), processes=1)
+    try:
+        handler.request(make_request('/echo', 'data'))
+        status, body = responses.get(timeout=5)
+        ntools.assert_equal(status, 200)
+        pid, data = body.split(':')
+        ntools.assert_not_equal(int(pid), os.getpid())
+        ntools.assert_equal(data, 'data')
+
+        handler.request(make_request('/crash'))
+        ntools.assert_equal(responses.get(timeout=5)[0], 503)
+
+        handler.request(make_request('/echo', 'again'))
+        status, body = responses.get(timeout=5)
+        ntools.assert_equal(status, 200)
+        ntools.assert_not_equal(body.split(':')[0], pid)
+        ntools.assert_equal(handler.stats()['restarts'], 1)
+
+        # the watermark applies until data has been read in this process
+        stream = {'chunks': []}
+        def write(data):
+            stream['chunks'].append(data)
+            stream['msg']._flow.consumed(len(data))
+        reply = webkitwindow._DetachedReply(respond=lambda status, text, msg, streaming: stream.update(msg=msg),
+                                            write=write,
+                                            close=lambda: responses.put(stream))
+        handler.request(webkitwindow.Request('GET', 'http://localhost/stream', webkitwindow.Message({}), reply))
+        responses.get(timeout=5)
+        ntools.assert_equal(stream['msg']._flow.high_watermark, 1000)
+        ntools.assert_equal(''.join(stream['chunks']), 'x' * 5000)
+
+        # without anybody reading, the handler stops at the watermark
+        stream = {'chunks': []}
+        reply = webkitwindow._DetachedReply(respond=lambda status, text, msg, streaming: None,
+                                            write=stream['chunks'].append,
+                                            close=lambda: responses.put(stream))
+        handler.request(webkitwindow.Request('GET', 'http://localhost/unread', webkitwindow.Message({}), reply))
+        responses.get(timeout=5)
+        ntools.assert_equal(''.join(stream['chunks']), 'x' * 1500)
+    finally:
+        handler.close()
+        webkitwindow._gui_thread_ident = gui_thread_ident
+
+def test_websocket_send_binary():
+    """Ensure WebSocket.send marks bytearrays, buffers and memoryviews as binary."""
+    sent = []
+
+    class Backend(object):
+        def send_messages(self, id, messages):
+            sent.extend(messages)
+            return True
+
+    ws = webkitwindow.WebSocket('ws://localhost/binary', Backend(), 1)
+    ws.send(u'text')
+    ws.send('\x00\xff', binary=True)
+    ws.send(bytearray('\x01\x02'))
+    ws.send(memoryview('\x03'))
+    ntools.assert_equal(sent, [(u'text', False), ('\x00\xff', True), ('\x01\x02', True), ('\x03', True)])
+
+def test_websocket_close_while_connecting():
+    """Ensure the handler sees neither connect nor close of a websocket closed while connecting."""
+    events = []
+
+    class Handler(object):
+        _connect = webkitwindow._Callback(lambda ws: events.append(('connect', ws._id)))
+        _close = webkitwindow._Callback(lambda ws: events.append(('close', ws._id)))
+
+    backend = webkitwindow.WebSocketBackend(Handler())
+    id = backend.connect('ws://localhost/closed')
+    ws = backend._connections[id]
+    backend.client_close(id)
+    backend._connected(ws)
+    ntools.assert_equal(events, [])
+
+    id = backend.connect('ws://localhost/open')
+    backend._connected(backend._connections[id])
+    backend.client_close(id)
+    ntools.assert_equal(events, [('connect', id), ('close', id)])
+
+def test_websocket_batch_encoding():
+    """Ensure batched websocket messages are framed with javascript string lengths."""
+    batch = webkitwindow._encode_websocket_batch([
+        ((1, ), False, u'a;b'),
+        ((1, 2), False, 'caf\xc3\xa9'),
+        ((3, ), True, '\x00\xff'),
+        ((1, ), False, u'\U0001F600'),
+    ])
+    ntools.assert_equal(batch, u'1,0,3;a;b1|2,0,4;caf\xe93,1,2;\x00\xff1,0,2;\U0001F600')
+
+def test_websocket_outbox_overflow():
+    """Ensure the websocket outbox enforces its limit with each overflow policy."""
+    flushes = []
+    schedule_flush = lambda: flushes.append(True)
+    msgs = lambda *data: [(d, False) for d in data]
+
+    outbox = webkitwindow._WebSocketOutbox(max_queue=2, overflow='drop_oldest')
+    ntools.assert_true(outbox.put(msgs('a', 'b', 'c'), schedule_flush))
+    ntools.assert_equal(outbox.take(), msgs('b', 'c'))
+    ntools.assert_equal(outbox.dropped, 1)
+    ntools.assert_equal(len(flushes), 1)
+
+    outbox = webkitwindow._WebSocketOutbox(max_queue=2, overflow='close')
+    ntools.assert_equal(outbox.put(msgs('a', 'b', 'c'), schedule_flush), 'overflow')
+    ntools.assert_false(outbox.put(msgs('d'), schedule_flush))
+
+    outbox = webkitwindow._WebSocketOutbox(max_queue=2, overflow='block')
+    ntools.assert_true(outbox.put(msgs('a', 'b'), schedule_flush))
+    sender = threading.Thread(target=lambda: outbox.put(msgs('c'), schedule_flush))
+    sender.start()
+    time.sleep(0.05)
+    ntools.assert_true(sender.is_alive())
+    ntools.assert_equal(outbox.take(), msgs('a', 'b'))
+    sender.join(1)
+    ntools.assert_false(sender.is_alive())
+    ntools.assert_equal(outbox.take(), msgs('c'))
+
+    # the Qt main thread can not wait for the flush it would do itself
+    ntools.assert_equal(outbox.put(msgs('d', 'e', 'f'), schedule_flush, block=False), None)
+    ntools.assert_equal(outbox.take(), msgs('d', 'e'))
+
+    # broadcasts count towards the limit while they are pending
+    ntools.assert_true(outbox.reserve())
+    ntools.assert_true(outbox.put(msgs('g'), schedule_flush))
+    ntools.assert_false(outbox.reserve())
+    ntools.assert_equal(outbox.put(msgs('h'), schedule_flush, block=False), None)
+    outbox.release()
+    ntools.assert_true(outbox.put(msgs('h'), schedule_flush))
+    ntools.assert_equal(outbox.take(), msgs('g', 'h'))
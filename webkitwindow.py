@@ -1,29 +1,71 @@
 import sys
 import os
+import time
 import Queue
-import StringIO
 import urlparse
 import mimetypes
 import pkgutil
 import itertools
+import collections
+import email.utils
+import hashlib
+import json
+import tempfile
+import bisect
+import logging
+import threading
+import traceback
+import importlib
+import signal
+import multiprocessing
+import multiprocessing.connection
 
 try:
-    from PyQt4 import QtCore, QtGui, QtWebKit, QtNetwork
+    from PyQt4 import QtCore, QtNetwork
+    _qt_package = 'PyQt4'
 except ImportError:
-    from PySide import QtCore, QtGui, QtWebKit, QtNetwork
+    from PySide import QtCore, QtNetwork
+    _qt_package = 'PySide'
+
+# imported by import_gui once the first window is created
+QtGui = None
+QtWebKit = None
 
 HTTP_STATUS = {
     200: 'OK',
+    206: 'Partial Content',
     301: 'Moved Permanently',
     302: 'Found',
+    304: 'Not Modified',
     400: 'Bad Request',
     404: 'Not Found',
+    405: 'Method Not Allowed',
     406: 'Not Acceptable',
+    416: 'Requested Range Not Satisfiable',
     500: 'Internal Server Error',
     503: 'Service Unavailable',
 }
 
-class Message():
+# ident of the thread running the Qt event loop, see WebkitWindow._run
+_gui_thread_ident = None
+
+def _on_gui_thread():
+    """Return True when called from the thread running the Qt event loop."""
+    return threading.current_thread().ident == _gui_thread_ident
+
+def _import_asyncio():
+    """Return the asyncio module, or trollius, its python 2 port."""
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+class Message(object):
 
     """An HTTP message.
 
@@ -31,22 +73,20 @@ class Message():
     converted to an utf8 string)
 
     body must be either None, str. When unicode, convert it to an utf8
-    string, else convert it to a str.
-    """
+    string, else convert it to a str. Request.found_file uses a
+    _FileRange body that is read only while the response is sent.
+    Requests with streamed uploads have a RequestBody body.
 
-    def __init__(self, headers={}, body=None):
-        self.headers = {}
-        for k,v in headers.items():
-            assert isinstance(k, basestring), "header keys must be strings, not: %r" % (k, )
+    The headers are checked and copied when they are first accessed.
+    """
 
-            if isinstance(v, unicode):
-                v = v.decode('utf-8')
-            elif isinstance(v, str):
-                pass
-            else:
-                assert False, "header values must be strings or unicode, not: %r" % (v, )
+    # __dict__: handlers may attach their own attributes
+    __slots__ = ('_headers', '_raw_headers', 'body', '_write_fn', '_close_fn', '_flush_fn', '_flow', '__dict__')
 
-            self.headers[k] = v
+    def __init__(self, headers={}, body=None):
+        # a dict, or a function returning an already checked dict
+        self._raw_headers = headers
+        self._headers = None
 
         if isinstance(body, unicode):
             self.body = body.encode('utf-8')
@@ -54,30 +94,141 @@ class Message():
             self.body = body
         elif body is None:
             self.body = ""
+        elif isinstance(body, (_FileRange, RequestBody)):
+            self.body = body
         else:
             self.body = str(body)
 
         self._write_fn = None
         self._close_fn = None
+        self._flush_fn = None
+        self._flow = None
+
+    @property
+    def headers(self):
+        headers = self._headers
+        if headers is None:
+            raw = self._raw_headers
+            headers = self._headers = raw() if callable(raw) else self._check_headers(raw)
+        return headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = self._check_headers(headers)
+        self._raw_headers = None
+
+    @staticmethod
+    def _check_headers(raw):
+        headers = {}
+        for k,v in raw.items():
+            assert isinstance(k, basestring), "header keys must be strings, not: %r" % (k, )
+
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            elif isinstance(v, str):
+                pass
+            else:
+                assert False, "header values must be strings or unicode, not: %r" % (v, )
+
+            headers[k] = v
+        return headers
+
+    def get_header(self, name, default=None):
+        """Return the value of header name, ignoring its case."""
+        if name in self.headers:
+            return self.headers[name]
+        name = name.lower()
+        for k, v in self.headers.items():
+            if k.lower() == name:
+                return v
+        return default
 
     # streaming response data
 
-    def _set_streaming(self, write_fn, close_fn):
+    def _set_streaming(self, write_fn, close_fn, flow=None, flush_fn=None):
         self._write_fn = write_fn
         self._close_fn = close_fn
+        self._flush_fn = flush_fn
+        self._flow = flow
 
-    def write(self, data):
+    def write(self, data, block=True, timeout=None):
         """Write data for a streaming response.
 
-        Return True on success, False otherwise.
+        When the response has been started with a high_watermark and
+        more than that many bytes are still waiting to be read by
+        webkit, block until it has read enough to get below the
+        low_watermark (or timeout seconds have passed). With block set
+        to False, return immediately instead. Writes from the Qt main
+        thread never block as nobody would be able to read the data.
+
+        Return True on success, None if the data was not written
+        because the buffer is full and False otherwise (e.g. when the
+        client has closed the connection).
         """
         if not self._write_fn:
             raise Exception("not a streaming response")
 
-        if data:
-            return self._write_fn(data)
+        if not data:
+            return False
 
-        return False
+        flow = self._flow
+        if flow is not None:
+            if flow.full() and not _on_gui_thread():
+                if not block or not flow.wait(timeout):
+                    return False if flow.closed else None
+            flow.wrote(len(data))
+
+        return self._write_fn(data)
+
+    def on_drain(self, callback):
+        """Call callback once the streaming buffer is below its low_watermark.
+
+        callback is called immediately if the buffer is not full,
+        otherwise it will be called from the Qt main thread.
+        """
+        if not self._write_fn:
+            raise Exception("not a streaming response")
+
+        if self._flow is None:
+            callback()
+        else:
+            self._flow.on_drain(callback)
+
+    def drained(self, loop=None):
+        """Return an asyncio future that is done once the streaming buffer has been drained."""
+        asyncio = _import_asyncio()
+        loop = loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+        self.on_drain(lambda: loop.call_soon_threadsafe(_set_future_result, future, True))
+        return future
+
+    def write_async(self, data, loop=None):
+        """Return an asyncio future for writing data without blocking the event loop.
+
+        The data is written as soon as the streaming buffer is below
+        its watermark, the future's result is the result of .write().
+        """
+        asyncio = _import_asyncio()
+        loop = loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+
+        def _write():
+            res = self.write(data, block=False)
+            if res is None:
+                self.on_drain(lambda: loop.call_soon_threadsafe(_write))
+            else:
+                _set_future_result(future, res)
+
+        _write()
+        return future
+
+    def flush(self):
+        """Pass the writes collected so far to webkit now."""
+        if not self._write_fn:
+            raise Exception("not a streaming response")
+
+        if self._flush_fn is not None:
+            self._flush_fn()
 
     def close(self):
         """Close the streaming response.
@@ -90,23 +241,782 @@ class Message():
         return self._close_fn()
 
 
-def _parse_url(obj, url):
-    """Parse url and add the resulting parts as url_* attrs to obj."""
-    r = urlparse.urlparse(url)
-    obj.url_scheme = r.scheme
-    obj.url_netloc = r.netloc
-    obj.url_path = r.path
-    obj.url_params = r.params
-    obj.url_query = r.query
-    obj.url_query_dict = urlparse.parse_qs(r.query)
-    obj.url_fragment = r.fragment
+class _WriteCoalescer(object):
+
+    """Merge the writes to a streaming response into fewer, larger ones.
+
+    Writes are collected until flush_size bytes are pending or
+    flush_interval milliseconds have passed since the first of them
+    and then passed to emit as a single string, so that webkit gets
+    one readyRead instead of one per write.
+    """
+
+    def __init__(self, emit, flush_interval=0, flush_size=64*1024):
+        self._emit = emit
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.writes = 0
+        self.flushes = 0
+        self._chunks = []
+        self._size = 0
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            self.writes += 1
+            flush = self._size >= self.flush_size
+            schedule = not flush and not self._scheduled
+            self._scheduled = self._scheduled or schedule
+        if flush:
+            self.flush()
+        elif schedule:
+            WebkitWindow.run_later(self._timeout, self.flush_interval)
+
+    def _timeout(self):
+        with self._lock:
+            self._scheduled = False
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._chunks:
+                return
+            data = self._chunks[0] if len(self._chunks) == 1 else ''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            self.flushes += 1
+            # emit while holding the lock to keep concurrent flushes in order
+            self._emit(data)
+
+
+class _FlowControl(object):
+
+    """Count the bytes of a streaming response that webkit has not read yet.
+
+    Writers use .full() and .wait() to hold off once more than
+    high_watermark bytes are pending until the reader has consumed
+    enough of them to get down to low_watermark.
+    """
+
+    def __init__(self, high_watermark, low_watermark=None):
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
+        assert 0 <= low_watermark <= high_watermark, "low_watermark must be between 0 and high_watermark"
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.pending = 0
+        self.closed = False
+        self._blocked = False
+        self._drain_callbacks = []
+        self._cond = threading.Condition()
+        # called with the size of each consumed chunk, e.g. to pass it on to a handler process
+        self.on_consumed = None
+
+    def full(self):
+        return self._blocked or self.pending > self.high_watermark
+
+    def wrote(self, size):
+        with self._cond:
+            self.pending += size
+            if self.pending > self.high_watermark:
+                self._blocked = True
+
+    def consumed(self, size):
+        if self.on_consumed is not None:
+            self.on_consumed(size)
+        with self._cond:
+            self.pending -= size
+            if not self._blocked or self.pending > self.low_watermark:
+                return
+            self._blocked = False
+            self._cond.notify_all()
+            callbacks, self._drain_callbacks = self._drain_callbacks, []
+
+        for f in callbacks:
+            f()
+
+    def close(self):
+        """Wake up all waiting writers, e.g. after the reply has been aborted."""
+        with self._cond:
+            self.closed = True
+            self._blocked = False
+            self._cond.notify_all()
+            callbacks, self._drain_callbacks = self._drain_callbacks, []
+
+        for f in callbacks:
+            f()
+
+    def wait(self, timeout=None):
+        """Wait until the buffer has drained.
+
+        Return True if it did, False if the timeout passed or the flow
+        has been closed.
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self._blocked and not self.closed:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return not self.closed
+
+    def on_drain(self, callback):
+        with self._cond:
+            if self._blocked and not self.closed:
+                self._drain_callbacks.append(callback)
+                return
+        callback()
+
+
+class RequestBody(object):
+
+    """The body of a request, received while the handler is running.
+
+    Used instead of a str body when the window has been started with
+    stream_uploads. Data is read from the page in small slices on the
+    Qt main thread and handed out with .read() or by iterating over
+    the body.
+
+    Without spool_size, at most max_buffer bytes are kept in memory,
+    reading from the page pauses until the handler has consumed them.
+    With spool_size, the whole body is written to a temporary file
+    that is kept in memory up to spool_size bytes.
+
+    Handlers running on the Qt main thread must not wait for data
+    that has not arrived yet, the main thread is the one receiving
+    it. Use .on_complete there or read with block=False.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, length=None, spool_size=None, max_buffer=1024 * 1024):
+        self.length = length
+        self.spool_size = spool_size
+        self.received = 0
+        self.complete = False
+        self.error = None
+        self.closed = False
+        self._cond = threading.Condition()
+        self._complete_callbacks = []
+        self._fill = None # reads more data on the Qt main thread
+        self._sink = None
+        self._sink_flow = None # bytes passed to the sink but not yet sent on
+        self._max_buffer = max_buffer
+        if spool_size is None:
+            self._buffer = _ChunkBuffer()
+            self._flow = _FlowControl(max_buffer)
+            self._spool = None
+        else:
+            self._buffer = None
+            self._flow = None
+            self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            self._read_pos = 0
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def _available(self):
+        if self._spool is None:
+            return len(self._buffer)
+        return self.received - self._read_pos
+
+    def _take(self, size):
+        # call with self._cond held
+        if self._spool is None:
+            return self._buffer.read(size) or ''
+        self._spool.seek(self._read_pos)
+        data = self._spool.read(size)
+        self._spool.seek(0, os.SEEK_END)
+        self._read_pos += len(data)
+        return data
+
+    def read(self, size=-1, block=True):
+        """Read up to size bytes, all remaining bytes if size is negative.
+
+        Block until data is available (or the whole body has arrived
+        if size is negative). Return '' at the end of the body and
+        None if block is False and no data is available yet. Raise an
+        IOError if the upload has been aborted.
+        """
+        if size < 0:
+            return ''.join(iter(self))
+
+        with self._cond:
+            while not self.complete and self._available() == 0:
+                if not block:
+                    return None
+                if _on_gui_thread():
+                    # nobody else would fill the buffer, read what the page has already passed on
+                    fill = self._fill
+                    if fill is not None:
+                        self._cond.release()
+                        try:
+                            fill()
+                        finally:
+                            self._cond.acquire()
+                    if self.complete or self._available():
+                        continue
+                    assert False, "blocking read of an incomplete request body on the Qt main thread, use on_complete"
+                self._cond.wait()
+
+            if self._available() == 0 and self.error:
+                raise IOError(self.error)
+            data = self._take(size)
+
+        if data and self._flow is not None:
+            self._flow.consumed(len(data))
+        return data
+
+    def on_complete(self, callback):
+        """Call callback(body) once the whole body has been received.
+
+        Useful for handlers running on the Qt main thread, which must
+        not block waiting for the upload.
+        """
+        with self._cond:
+            if not self.complete:
+                self._complete_callbacks.append(callback)
+                return
+        callback(self)
+
+    def close(self):
+        """Discard the body, stop reading it from the page."""
+        with self._cond:
+            self.closed = True
+            if not self.complete:
+                self.complete = True
+                self.error = 'request body closed'
+            self._cond.notify_all()
+        if self._flow is not None:
+            self._flow.close()
+        if self._spool is not None:
+            self._spool.close()
+
+    # called by the reading side
+
+    def _pending_flow(self):
+        # the flow control the reading side has to wait for
+        return self._sink_flow if self._sink is not None else self._flow
+
+    def _full(self):
+        flow = self._pending_flow()
+        return flow is not None and flow.full()
+
+    def _set_sink(self, write, finish):
+        # pass all data to write(data) and finish(error) instead of
+        # buffering it, write calls ._sent(size) once the data is gone
+        with self._cond:
+            self._sink = (write, finish)
+            self._sink_flow = _FlowControl(self._max_buffer)
+            pending = self._take(self._available())
+            if pending:
+                self._sink_flow.wrote(len(pending))
+        if pending:
+            write(pending)
+
+    def _sent(self, size):
+        self._sink_flow.consumed(size)
+
+    def _feed(self, data):
+        with self._cond:
+            if self.closed:
+                return
+            self.received += len(data)
+            if self._sink is not None:
+                self._sink_flow.wrote(len(data))
+                self._sink[0](data)
+                return
+            elif self._spool is None:
+                self._buffer.write(data)
+                self._flow.wrote(len(data))
+            else:
+                self._spool.write(data)
+            self._cond.notify_all()
+
+    def _finish(self, error=None):
+        with self._cond:
+            if self.complete:
+                return
+            self.complete = True
+            self.error = error
+            self._cond.notify_all()
+            callbacks, self._complete_callbacks = self._complete_callbacks, []
+            sink = self._sink
+        if sink is not None:
+            sink[1](error)
+            self._sink_flow.close()
+        if self._flow is not None:
+            self._flow.close()
+        for f in callbacks:
+            f(self)
+
+
+class _AbortToken(object):
+
+    """Set once webkit drops a reply the handler has not completed.
+
+    Works like a threading.Event and additionally calls the callbacks
+    registered with .add_callback() when it is set.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def is_set(self):
+        return self._event.is_set()
+
+    __nonzero__ = is_set
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def set(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for f in callbacks:
+            try:
+                f()
+            except Exception:
+                traceback.print_exc()
+
+    def discard(self):
+        # the handler is done, drop the references to its callbacks
+        with self._lock:
+            self._callbacks = []
+
+
+# counts of requests that have been aborted by webkit before the
+# handler completed them, and of those the handler completed anyway
+_abort_stats = {'aborted': 0, 'aborted_completed': 0}
+_abort_stats_lock = threading.Lock()
+
+def _count_abort(key):
+    with _abort_stats_lock:
+        _abort_stats[key] += 1
+
+
+class _Histogram(object):
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Metrics(object):
+
+    """Latency histograms of the local dispatch pipeline.
+
+    Pass an instance (or True) as the metrics argument of
+    WebkitWindow.run to enable it. Durations in seconds are recorded
+    per stage, HTTP method and url path:
+
+        request_queue       createRequest until the handler is called
+        request_handler     the handler call itself
+        request_respond     createRequest until the response has been
+                            passed to webkit
+        request_total       createRequest until the reply has finished
+        ws_receive_queue    message from javascript until the handler
+                            is called
+        ws_receive_handler  the handler call itself
+        ws_send_queue       WebSocket.send until the messages have been
+                            passed to javascript
+
+    Websocket stages use 'WS' as method. For 'asyncio' dispatch the
+    handler stages only cover creating the coroutine, for 'process'
+    dispatch only handing the call to the handler process.
+
+    sink, if given, is called with a dict for each finished request
+    and each websocket message. Use .snapshot() for a plain dict of
+    all histograms or .prometheus() for the Prometheus text format.
+
+    path_fn maps url paths to label values, e.g. to strip ids. At most
+    max_paths distinct paths are tracked, others are counted as
+    'other'.
+    """
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, sink=None, path_fn=None, max_paths=500):
+        self.sink = sink
+        self.path_fn = path_fn
+        self.max_paths = max_paths
+        self._paths = set()
+        self._histograms = {} # (stage, method, path) -> _Histogram
+        self._lock = threading.Lock()
+
+    def _path(self, path):
+        if self.path_fn is not None:
+            path = self.path_fn(path)
+        if path not in self._paths:
+            if len(self._paths) >= self.max_paths:
+                return 'other'
+            self._paths.add(path)
+        return path
+
+    def observe(self, stage, method, path, seconds):
+        """Add a duration to the histogram of stage, method and path."""
+        with self._lock:
+            key = (stage, method, self._path(path))
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = _Histogram(self.buckets)
+            h.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            h.count += 1
+            h.sum += seconds
+            if seconds > h.max:
+                h.max = seconds
+
+    def record(self, kind, method, path, durations, **info):
+        """Observe all (stage, seconds) items of durations and pass them to the sink."""
+        for stage, seconds in durations.items():
+            if seconds is not None:
+                self.observe(stage, method, path, seconds)
+        if self.sink is not None:
+            event = dict(info, kind=kind, method=method, path=path)
+            event.update(durations)
+            try:
+                self.sink(event)
+            except Exception:
+                traceback.print_exc()
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._paths.clear()
+
+    def snapshot(self):
+        """Return a list of dicts, one per stage, method and path.
+
+        Each has count, sum, max and buckets, a list of (upper bound,
+        count) pairs that are not cumulative, the last bound is None.
+        """
+        with self._lock:
+            items = sorted(self._histograms.items())
+            return [{'stage': stage, 'method': method, 'path': path,
+                     'count': h.count, 'sum': h.sum, 'max': h.max,
+                     'buckets': zip(self.buckets + (None, ), h.counts)}
+                    for (stage, method, path), h in items]
+
+    def prometheus(self, prefix='webkitwindow'):
+        """Return the histograms in the Prometheus text exposition format."""
+        lines = []
+        stage = None
+        for s in self.snapshot():
+            name = '%s_%s_seconds' % (prefix, s['stage'])
+            if s['stage'] != stage:
+                stage = s['stage']
+                lines.append('# TYPE %s histogram' % (name, ))
+            labels = 'method="%s",path="%s"' % (s['method'], s['path'].replace('\\', '\\\\').replace('"', '\\"'))
+            cumulative = 0
+            for bound, count in s['buckets']:
+                cumulative += count
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative))
+            lines.append('%s_sum{%s} %r' % (name, labels, s['sum']))
+            lines.append('%s_count{%s} %d' % (name, labels, s['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class _RequestTrace(object):
+
+    """Timestamps of a request passing through the dispatch pipeline."""
+
+    __slots__ = ('method', 'path', 'created', 'started', 'returned', 'responded', 'status')
+
+    def __init__(self, method, url, created):
+        self.method = method
+        self.path = urlparse.urlsplit(url).path
+        self.created = created
+        self.started = self.returned = self.responded = self.status = None
+
+    def finish(self, metrics, aborted):
+        now = time.time()
+        since = lambda t: None if t is None else t - self.created
+        metrics.record('request', self.method, self.path, {
+            'request_queue': since(self.started),
+            'request_handler': None if self.started is None or self.returned is None else self.returned - self.started,
+            'request_respond': since(self.responded),
+            'request_total': now - self.created,
+        }, status=self.status, aborted=aborted)
+
+# the Metrics instance of the running window, None when disabled
+_metrics = None
+
+
+class _URLAttributes(object):
+
+    """The url_* attributes of Request and WebSocket, parsed on first access."""
+
+    __slots__ = ('_url_parts', '_url_query_dict')
+
+    def _parts(self):
+        parts = self._url_parts
+        if parts is None:
+            parts = self._url_parts = urlparse.urlparse(self.url)
+        return parts
+
+    url_scheme = property(lambda self: self._parts().scheme)
+    url_netloc = property(lambda self: self._parts().netloc)
+    url_path = property(lambda self: self._parts().path)
+    url_params = property(lambda self: self._parts().params)
+    url_query = property(lambda self: self._parts().query)
+    url_fragment = property(lambda self: self._parts().fragment)
+
+    @property
+    def url_query_dict(self):
+        query_dict = self._url_query_dict
+        if query_dict is None:
+            query_dict = self._url_query_dict = urlparse.parse_qs(self._parts().query)
+        return query_dict
 
 def guess_type(name, default="application/octet-stream"):
     """Given a path to a file, guess its mimetype."""
     guessed_type, encoding = mimetypes.guess_type(name, strict=False)
     return guessed_type or default
 
-class Request():
+
+class _FileRange(object):
+
+    """A byte range of a file, read in chunks while the response is sent."""
+
+    def __init__(self, path, start=0, length=None):
+        self.path = path
+        self.start = start
+        self._file = open(path, 'rb')
+        if length is None:
+            length = os.fstat(self._file.fileno()).st_size - start
+        self.length = length
+        self.remaining = length
+        self._file.seek(start)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size):
+        data = self._file.read(min(size, self.remaining))
+        if data:
+            self.remaining -= len(data)
+        else:
+            # the file has been truncated in the meantime
+            self.remaining = 0
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class _FileInfoCache(object):
+
+    """Cache os.stat results and guessed mimetypes of served files.
+
+    Entries are used for max_age seconds to save the stat calls of
+    frequently requested files.
+    """
+
+    def __init__(self, max_age=1.0, max_entries=1024):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries = {} # path -> (expires, size, mtime, content_type)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return (size, mtime, content_type) of path."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] > now:
+            return entry[1:]
+
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            # callers expect the IOError open() raises
+            raise IOError(e.errno, e.strerror, path)
+        entry = (now + self.max_age, st.st_size, st.st_mtime, guess_type(path))
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[path] = entry
+        return entry[1:]
+
+_file_info_cache = _FileInfoCache()
+
+class _LRUCache(object):
+
+    """A thread-safe least recently used cache bounded by the total size of its values.
+
+    sizeof computes the size of a value, entries larger than max_size
+    are not stored.
+    """
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict() # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return a dict with the number of entries, their size, hits, misses and evictions."""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'size': self.size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class _Resource(object):
+
+    """A resource loaded by Request.found_resource, stored in resource_cache."""
+
+    def __init__(self, body, content_type, etag=None, last_modified=None):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag or '"%s"' % (hashlib.md5(body).hexdigest(), )
+        self.last_modified = int(last_modified or time.time())
+
+    def __len__(self):
+        return len(self.body)
+
+# resources served by Request.found_resource, keyed by (module_name, path, modify_fn)
+resource_cache = _LRUCache(max_size=32 * 1024 * 1024)
+
+def _not_modified(message, etag, last_modified):
+    """Return True if the conditional headers of message match etag and last_modified.
+
+    If-None-Match takes precedence over If-Modified-Since.
+    """
+    if_none_match = message.get_header('If-None-Match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        # weak comparison, ignore W/ prefixes
+        return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+    if_modified_since = message.get_header('If-Modified-Since')
+    if if_modified_since is not None:
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed is not None:
+            return int(last_modified) <= email.utils.mktime_tz(parsed)
+    return False
+
+def _parse_range(value, size):
+    """Parse the value of a Range header for a resource of size bytes.
+
+    Return a (start, end) tuple, end inclusive, None if the header
+    should be ignored (it is malformed or asks for several ranges) or
+    False if the range cannot be satisfied.
+    """
+    if not value or not value.startswith('bytes='):
+        return None
+    spec = value[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+
+    start, sep, end = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if not start.strip():
+            # the last n bytes
+            n = int(end)
+            if n <= 0 or size == 0:
+                return False
+            return max(0, size - n), size - 1
+        start = int(start)
+        end = int(end) if end.strip() else size - 1
+    except ValueError:
+        return None
+
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+class Request(_URLAttributes):
+
+    # the instance __dict__ is only created when other attributes are set
+    __slots__ = ('message', 'method', 'url', 'fake_reply', '_streaming', 'route_params', '__dict__')
 
     def __init__(self, method, url, message, fake_reply):
         self.message = message
@@ -114,15 +1024,64 @@ class Request():
         self.url = url
         self.fake_reply = fake_reply
         self._streaming = False
-        _parse_url(self, url)
+        self._url_parts = None
+        self._url_query_dict = None
+
+    # cancellation
+
+    @property
+    def abort_token(self):
+        """An _AbortToken that is set when webkit drops this request.
+
+        Check abort_token.is_set() (or the token itself) to stop
+        expensive work early, the token may be passed on to code that
+        does not know about the request.
+        """
+        return self.fake_reply.abort_token
 
-    def respond(self, status=None, message=None, streaming=False):
+    def is_aborted(self):
+        """Return True if webkit has dropped this request."""
+        return self.fake_reply.aborted
+
+    def on_abort(self, callback):
+        """Call callback() when webkit drops this request.
+
+        Called immediately if the request has already been aborted.
+        Callbacks run on the Qt main thread (in the handler process for
+        the 'process' dispatch mode) and should return quickly. They
+        are not called once the handler has completed the response.
+        """
+        self.abort_token.add_callback(callback)
+
+    def aborted_future(self, loop=None):
+        """Return an asyncio future that is done once webkit has dropped this request."""
+        asyncio = _import_asyncio()
+        loop = loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+        self.on_abort(lambda: loop.call_soon_threadsafe(_set_future_result, future, True))
+        return future
+
+    def respond(self, status=None, message=None, streaming=False, high_watermark=None, low_watermark=None,
+                flush_interval=0, flush_size=64*1024):
         """Respond to this request with a Message.
 
         If streaming is True, initiate a streaming response. Stream
         data using the passed messages .write(data) method and end the
         request with .close().
 
+        Set high_watermark to the number of bytes that may be written
+        to a streaming response but not yet read by webkit before
+        .write() blocks. It will block until webkit has read enough
+        data to get below low_watermark (defaults to half of the
+        high_watermark) again.
+
+        Writes to a streaming response are collected and passed to
+        webkit at once, flush_interval milliseconds after the first
+        pending write (0: in the next Qt event loop iteration) or as
+        soon as flush_size bytes are pending. Use .flush() on the
+        message to pass them on immediately and flush_interval=None
+        to pass on every write by itself.
+
         Returns True when the reply was initiated successfully, False
         if it failed (e.g. when the client has already closed the
         connection).
@@ -143,21 +1102,36 @@ class Request():
             raise TypeError("status must be a number or tuple of (status, text), not: %r" % (status, ))
 
         if streaming:
+            emit = self.fake_reply.fake_response_write.emit
+            coalescer = None
+            if flush_interval is not None and getattr(self.fake_reply, 'coalesce_writes', False):
+                coalescer = _WriteCoalescer(emit, flush_interval, flush_size)
+
             def _write_fn(data):
                 if self.fake_reply.aborted:
                     return False
-                self.fake_reply.fake_response_write.emit(str(data))
+                if coalescer is None:
+                    emit(str(data))
+                else:
+                    coalescer.write(str(data))
                 return True
 
             def _close_fn():
+                self.fake_reply._handler_done()
                 if self.fake_reply.aborted:
                     return False
+                if coalescer is not None:
+                    coalescer.flush()
                 self.fake_reply.fake_response_close.emit()
                 return True
 
-            message._set_streaming(write_fn=_write_fn, close_fn=_close_fn)
+            flow = None if high_watermark is None else _FlowControl(high_watermark, low_watermark)
+            message._set_streaming(write_fn=_write_fn, close_fn=_close_fn, flow=flow,
+                                   flush_fn=coalescer and coalescer.flush)
 
             if self.fake_reply.aborted:
+                if flow is not None:
+                    flow.close()
                 return False
             else:
                 self.fake_reply.fake_response.emit(status, status_text, message, True)
@@ -166,6 +1140,7 @@ class Request():
                 return True
 
         else:
+            self.fake_reply._handler_done()
             if self.fake_reply.aborted:
                 return False
             else:
@@ -190,7 +1165,7 @@ class Request():
         """Respond with a 200, data and content_type."""
         return self.respond((200, 'Found'), Message({"Content-Type": content_type}, body))
 
-    def found_resource(self, path, module_name, content_type=None, modify_fn=None):
+    def found_resource(self, path, module_name, content_type=None, modify_fn=None, cache=None, etag=None):
         """Respond with a 200 and a resource file loaded using pkgutil.get_data.
 
         module_name and path are passed to pkgutil.get_data.
@@ -201,39 +1176,149 @@ class Request():
             req.found_resource(path='/styles.css',
                                module_name='webkitwindow.resources',
                                modify_fn=lambda s: s.replace('TODAY', datetime.datetime.now()))
+
+        Resources are kept in resource_cache, keyed by module_name,
+        path and the identity of modify_fn. By default only resources
+        without a modify_fn are cached, pass cache=True to also cache
+        the result of a modify_fn (which must then be the same function
+        object on each call) or cache=False to always reload.
+
+        Responses carry an ETag (etag, even for a cached resource, or
+        the md5 of the body) and a Last-Modified header. Requests with a matching If-None-Match
+        or If-Modified-Since header are answered with a 304.
         """
-        res_string = pkgutil.get_data(module_name, path)
-        if modify_fn:
-            res_string = modify_fn(res_string)
-        return self.found(body=res_string, content_type=content_type or guess_type(path))
+        if cache is None:
+            cache = modify_fn is None
+
+        key = (module_name, path, modify_fn)
+        resource = resource_cache.get(key) if cache else None
+        if resource is None:
+            res_string = pkgutil.get_data(module_name, path)
+            if modify_fn:
+                res_string = modify_fn(res_string)
+            if isinstance(res_string, unicode):
+                res_string = res_string.encode('utf-8')
+            resource = _Resource(str(res_string), guess_type(path), etag)
+            if cache:
+                resource_cache.put(key, resource)
+
+        # a cached resource may have been loaded with another etag
+        etag = etag or resource.etag
+        headers = {'ETag': etag,
+                   'Last-Modified': email.utils.formatdate(resource.last_modified, usegmt=True)}
+        if _not_modified(self.message, etag, resource.last_modified):
+            return self.respond(304, Message(headers))
+
+        headers['Content-Type'] = content_type or resource.content_type
+        return self.respond((200, 'Found'), Message(headers, resource.body))
 
     def found_file(self, path, content_type=None):
-        """Respond with a 200 and the file at path, optionally using content_type."""
-        with open(path) as f:
-            return self.found(body=f.read(), content_type=content_type or guess_type(path))
+        """Respond with a 200 and the file at path, optionally using content_type.
 
+        The file is read in chunks while webkit consumes the response
+        instead of being loaded into memory. Single range requests are
+        answered with a 206 (or 416 if the range is not satisfiable).
+
+        Raises IOError if the file does not exist or can not be read.
+        """
+        size, mtime, guessed_type = _file_info_cache.get(path)
+        headers = {
+            'Content-Type': content_type or guessed_type,
+            'Accept-Ranges': 'bytes',
+            'Last-Modified': email.utils.formatdate(mtime, usegmt=True),
+        }
+
+        byte_range = _parse_range(self.message.get_header('Range'), size)
+        if byte_range is False:
+            headers['Content-Range'] = 'bytes */%d' % (size, )
+            return self.respond(416, Message(headers))
+
+        if byte_range is None:
+            status, start, length = 200, 0, size
+        else:
+            start, end = byte_range
+            status, length = 206, end - start + 1
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+        headers['Content-Length'] = str(length)
+        if self.method == 'HEAD' or not length:
+            return self.respond(status, Message(headers))
+        body = _FileRange(path, start, length)
+        if not self.respond(status, Message(headers, body)):
+            # aborted, nobody is going to read the file
+            body.close()
+            return False
+        return True
 
-class WebSocket():
+
+def _websocket_data(data, binary=None):
+    """Return data and whether it is binary, see WebSocket.send."""
+    if binary is None:
+        binary = isinstance(data, (bytearray, buffer, memoryview))
+    if binary:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif isinstance(data, unicode):
+            data = data.encode('utf-8')
+        else:
+            data = str(data)
+    return data, binary
+
+class WebSocket(_URLAttributes):
 
     # create and pass this to NetworkHandler in the WebSocketBackend class
 
+    __slots__ = ('url', '_backend', '_id', 'route_params', '__dict__')
+
     def __init__(self, url, backend, id):
         self.url = url
         self._backend = backend
         self._id = id
-        _parse_url(self, url)
+        self._url_parts = None
+        self._url_query_dict = None
+
+    # the backend signals are safe to emit from any thread
 
     def connected(self):
         """Confirm a connection."""
-        self._backend.onopen.emit(self._id)
+        self._backend._server_open.emit(self._id)
 
-    def send(self, data):
-        """Send data over an opened connection."""
-        self._backend.send_to_client(self._id, data)
+    def send(self, data, binary=None):
+        """Send data over an opened connection.
+
+        Binary data arrives as an ArrayBuffer or Blob (depending on
+        the socket's binaryType) in the browser, everything else as a
+        string. Data is binary when binary is True or when binary is
+        None and data is a bytearray, buffer or memoryview.
+
+        When the connection has a queue limit, see
+        WebkitWindow.run, and too many messages are waiting to be
+        passed to the browser, block, drop the oldest message or close
+        the connection according to its overflow policy.
+
+        Return False if the connection is closed, None if the message
+        was not sent because the queue is full and the 'block' policy
+        cannot wait (when called on the Qt main thread), True
+        otherwise.
+        """
+        return self._backend.send_messages(self._id, [_websocket_data(data, binary)])
+
+    def send_many(self, messages, binary=None):
+        """Send several messages at once.
+
+        They cross over into the browser in a single call and arrive
+        as separate message events. binary is applied to each message
+        as in .send().
+        """
+        return self._backend.send_messages(self._id, [_websocket_data(data, binary) for data in messages])
+
+    def buffered_amount(self):
+        """Return the number of bytes sent but not yet passed to the browser."""
+        return self._backend.buffered_amount(self._id)
 
     def close(self):
         """Close the connection."""
-        self._backend.server_close(self._id)
+        self._backend._server_close.emit(self._id)
 
 
 class NetworkHandler():
@@ -255,7 +1340,9 @@ class NetworkHandler():
     def request(self, request):
         """Incoming Request.
 
-        Use request.respond(message) to respond.
+        Use request.respond(message) to respond. Long running handlers
+        should watch request.abort_token or use request.on_abort to
+        stop once webkit has dropped the request.
         """
         pass
 
@@ -272,6 +1359,9 @@ class NetworkHandler():
     def receive(self, websocket, data):
         """Incoming WebSocket data.
 
+        data is unicode for text messages and a str for binary
+        messages (ArrayBuffer, ArrayBufferView or Blob in javascript).
+
         Call .send() on the provided websocket object to send data back.
         """
         pass
@@ -281,230 +1371,2885 @@ class NetworkHandler():
         pass
 
 
+class _RouteNode(object):
+
+    """A node of the routing trie, one per path segment."""
+
+    __slots__ = ('static', 'params', 'rest', 'methods', 'websocket')
+
+    def __init__(self):
+        self.static = {} # segment -> _RouteNode
+        self.params = [] # (name, converter, _RouteNode), most specific converter first
+        self.rest = None # (name, methods dict) of a trailing <path:name>
+        self.methods = None # method -> function
+        self.websocket = None # handler object
+
+
+class RoutingNetworkHandler(NetworkHandler):
+
+    """NetworkHandler that dispatches to registered routes.
+
+    Routes are path patterns whose segments may be parameters of the
+    form <name> or <converter:name>, converter is one of str (the
+    default, a single segment), int, float or path (the rest of the
+    path, only as last segment):
+
+        handler = RoutingNetworkHandler()
+
+        @handler.route('/users/<int:id>', methods=('GET', 'PUT'))
+        def user(request, id):
+            request.found('user %d' % id)
+
+        handler.add_websocket('/chat/<room>', ChatHandler())
+
+    Routes are stored in a trie of path segments, so finding one does
+    not get slower with the number of routes. Functions are called
+    with the request and the parameters as keyword arguments, which
+    are also available as request.route_params. Requests without a
+    route get a 404, those without a matching method a 405. HEAD
+    requests fall back to the GET route.
+
+    Websocket routes take an object with connect, receive and close
+    methods (e.g. another NetworkHandler), websocket.route_params
+    holds the parameters. Connections without a route are closed.
+    """
+
+    converters = (('int', int), ('float', float), ('str', str))
+
+    def __init__(self):
+        self._root = _RouteNode()
+        self._websockets = {} # websocket id -> handler of its route
+
+    def _split(self, path):
+        return [s for s in path.split('/') if s]
+
+    def _node(self, pattern):
+        # return the node for pattern, creating the nodes along the way
+        node = self._root
+        segments = self._split(pattern)
+        for i, segment in enumerate(segments):
+            if segment.startswith('<') and segment.endswith('>'):
+                converter, _, name = segment[1:-1].rpartition(':')
+                converter = converter or 'str'
+                if converter == 'path':
+                    assert i == len(segments) - 1, "<path:...> must be the last segment of %r" % (pattern, )
+                    if node.rest is None:
+                        node.rest = (name, _RouteNode())
+                    elif node.rest[0] != name:
+                        raise ValueError("<path:%s> in %r conflicts with <path:%s> of another route"
+                                         % (name, pattern, node.rest[0]))
+                    return node.rest[1]
+                convert = dict(self.converters).get(converter)
+                assert convert is not None, "unknown converter %r in %r" % (converter, pattern)
+                for param_name, param_convert, child in node.params:
+                    if param_name == name and param_convert is convert:
+                        node = child
+                        break
+                else:
+                    child = _RouteNode()
+                    node.params.append((name, convert, child))
+                    order = [c for _, c in self.converters]
+                    node.params.sort(key=lambda p: order.index(p[1]))
+                    node = child
+            else:
+                node = node.static.setdefault(segment, _RouteNode())
+        return node
+
+    def add_route(self, pattern, f, methods=('GET', )):
+        """Call f(request, **params) for requests to pattern with one of methods."""
+        node = self._node(pattern)
+        if node.methods is None:
+            node.methods = {}
+        for method in methods:
+            node.methods[method.upper()] = f
+
+    def route(self, pattern, methods=('GET', )):
+        """Decorator version of add_route."""
+        def decorator(f):
+            self.add_route(pattern, f, methods)
+            return f
+        return decorator
+
+    def add_websocket(self, pattern, handler):
+        """Pass websockets connecting to pattern to handler."""
+        self._node(pattern).websocket = handler
+
+    def _match(self, node, segments, i, params, kind):
+        # return the node matching segments[i:] with a route of kind
+        # ('methods' or 'websocket') or None, filling params
+        if i == len(segments):
+            if getattr(node, kind):
+                return node
+        else:
+            segment = segments[i]
+            child = node.static.get(segment)
+            if child is not None:
+                found = self._match(child, segments, i + 1, params, kind)
+                if found is not None:
+                    return found
+            for name, convert, child in node.params:
+                try:
+                    params[name] = convert(segment)
+                except ValueError:
+                    continue
+                found = self._match(child, segments, i + 1, params, kind)
+                if found is not None:
+                    return found
+                del params[name]
+        if node.rest is not None and i < len(segments):
+            name, child = node.rest
+            if getattr(child, kind):
+                params[name] = '/'.join(segments[i:])
+                return child
+        return None
+
+    def resolve(self, path, kind='methods'):
+        """Return the trie node and parameters for path, node is None without a route.
+
+        kind is 'methods' to look up request routes or 'websocket' for
+        websocket routes.
+        """
+        params = {}
+        segments = self._split(path)
+        if '%' in path:
+            # unquote after splitting so that %2F stays within its segment
+            segments = [urlparse.unquote(s) for s in segments]
+        node = self._match(self._root, segments, 0, params, kind)
+        return node, params
+
+    # NetworkHandler interface
+
+    def request(self, request):
+        node, params = self.resolve(request.url_path)
+        if node is None or not node.methods:
+            return request.notfound()
+
+        f = node.methods.get(request.method)
+        if f is None and request.method == 'HEAD':
+            f = node.methods.get('GET')
+        if f is None:
+            allowed = ', '.join(sorted(node.methods))
+            return request.respond(405, Message({'Allow': allowed, 'Content-Type': 'text/plain'}, 'allowed: ' + allowed))
+
+        request.route_params = params
+        return f(request, **params)
+
+    def connect(self, websocket):
+        node, params = self.resolve(websocket.url_path, 'websocket')
+        if node is None or node.websocket is None:
+            return websocket.close()
+        websocket.route_params = params
+        self._websockets[websocket._id] = node.websocket
+        return node.websocket.connect(websocket)
+
+    def receive(self, websocket, data):
+        handler = self._websockets.get(websocket._id)
+        if handler is not None:
+            return handler.receive(websocket, data)
+
+    def close(self, websocket):
+        handler = self._websockets.pop(websocket._id, None)
+        if handler is not None:
+            return handler.close(websocket)
+
+
+def _encode_event(data, event=None, id=None, retry=None):
+    """Frame an event in the text/event-stream format.
+
+    data may span several lines, event and id must not.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    lines = []
+    for name, value in (('event', event), ('id', id)):
+        if value is None:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value)
+        if '\n' in value or '\r' in value:
+            raise ValueError("the %s of an event must not contain line breaks: %r" % (name, value))
+        lines.append('%s: %s\n' % (name, value))
+    if retry is not None:
+        lines.append('retry: %d\n' % (retry, ))
+    # a lone CR ends a line as well
+    for line in str(data).replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        lines.append('data: %s\n' % (line, ))
+    lines.append('\n')
+    return ''.join(lines)
+
+
+class EventStream(object):
+
+    """A server-sent events channel for any number of subscribed requests.
+
+        updates = EventStream()
+
+        def request(self, req):
+            if req.url_path == '/updates':
+                updates.subscribe(req)
+
+        updates.publish(json.dumps(state), event='state')
+
+    Each published event is encoded once and written to all
+    subscribers. The last replay events are kept so that a browser
+    reconnecting with a Last-Event-ID header gets the events it
+    missed. Subscribers that do not read fast enough (their response
+    has more than high_watermark unread bytes) are closed, their
+    browser reconnects and catches up from the replay buffer.
+
+    Every heartbeat seconds a comment is sent to keep idle
+    connections open, retry (milliseconds) tells browsers how long to
+    wait before reconnecting.
+    """
+
+    def __init__(self, replay=100, heartbeat=15.0, retry=None, high_watermark=256*1024):
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.high_watermark = high_watermark
+        self._replay = collections.deque(maxlen=replay) # (id, encoded event)
+        self._subscribers = set() # streaming Messages
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._heartbeat_thread = None
+        self._closed = threading.Event()
+
+    def subscribe(self, request):
+        """Respond to request with the event stream.
+
+        Return the streaming Message or None if the request has been
+        aborted in the meantime.
+        """
+        message = Message({'Content-Type': 'text/event-stream; charset=utf-8', 'Cache-Control': 'no-cache'})
+        if not request.respond(200, message, streaming=True, high_watermark=self.high_watermark):
+            return None
+
+        last_id = request.message.get_header('Last-Event-ID')
+        with self._lock:
+            if self.retry is not None:
+                message.write(': \nretry: %d\n\n' % (self.retry, ), block=False)
+            for data in self._missed(last_id):
+                message.write(data, block=False)
+            self._subscribers.add(message)
+            if self.heartbeat and self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='webkitwindow-eventstream')
+                self._heartbeat_thread.daemon = True
+                self._heartbeat_thread.start()
+
+        request.on_abort(lambda: self._unsubscribe(message))
+        return message
+
+    def _missed(self, last_id):
+        # call with self._lock held
+        if last_id is None:
+            return []
+        ids = [id for id, _ in self._replay]
+        if last_id in ids:
+            return [data for _, data in list(self._replay)[ids.index(last_id) + 1:]]
+        # too old (or unknown), send everything there is
+        return [data for _, data in self._replay]
+
+    def _unsubscribe(self, message):
+        with self._lock:
+            self._subscribers.discard(message)
+
+    def _write_all(self, data):
+        # call with self._lock held
+        for message in list(self._subscribers):
+            res = message.write(data, block=False)
+            if not res:
+                self._subscribers.discard(message)
+                if res is None:
+                    # too slow, let the browser reconnect and replay
+                    message.close()
+
+    def publish(self, data, event=None, id=None):
+        """Send data as an event to all subscribers, return the event id.
+
+        Without an id, events are numbered consecutively. Raises
+        ValueError if event or id contain a line break.
+        """
+        with self._lock:
+            id = str(self._ids.next() if id is None else id)
+            encoded = _encode_event(data, event, id)
+            self._replay.append((id, encoded))
+            self._write_all(encoded)
+        return id
+
+    def subscribers(self):
+        """Return the number of subscribed requests."""
+        return len(self._subscribers)
+
+    def close(self):
+        """End the streams of all subscribers."""
+        self._closed.set()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, set()
+        for message in subscribers:
+            message.close()
+
+    def _heartbeat(self):
+        while not self._closed.wait(self.heartbeat):
+            with self._lock:
+                self._write_all(': \n\n')
+
+
 class AnyValue(QtCore.QObject):
 
     def __init__(self, value):
         self.value = value
 
 
-class AsyncNetworkHandler(QtCore.QObject):
-    _request   = QtCore.pyqtSignal(object)
-    _connect   = QtCore.pyqtSignal(object)
-    _receive   = QtCore.pyqtSignal(object, str)
-    _close     = QtCore.pyqtSignal(object)
+class _WorkerPool(object):
 
-    def __init__(self, network_handler):
-        super(AsyncNetworkHandler, self).__init__()
-        self._nh = network_handler
-        self._request.connect(self.request)
-        self._connect.connect(self.connect)
-        self._receive.connect(self.receive)
-        self._close.connect(self.close)
+    """Run functions on a fixed number of worker threads.
+
+    Functions submitted with the same key run one at a time in the
+    order they were submitted (used to keep the events of a websocket
+    in order), functions without a key run concurrently.
+    """
+
+    def __init__(self, size):
+        assert size > 0, "the pool needs at least one worker"
+        self.size = size
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._keys = {} # key -> deque of functions waiting for the running one
+
+        self._queued = 0
+        self._max_queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._threads = [threading.Thread(target=self._work, name='webkitwindow-worker-%s' % i)
+                         for i in range(size)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, f, key=None):
+        job = (f, key, time.time())
+        with self._lock:
+            self._submitted += 1
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+            if key is not None:
+                if key in self._keys:
+                    self._keys[key].append(job)
+                    return
+                self._keys[key] = collections.deque()
+        self._queue.put(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            f, key, submitted = job
+            waited = time.time() - submitted
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+
+            try:
+                f()
+            except Exception:
+                traceback.print_exc()
+
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                if key is not None:
+                    waiting = self._keys[key]
+                    if waiting:
+                        self._queue.put(waiting.popleft())
+                    else:
+                        del self._keys[key]
+
+    def stats(self):
+        """Return a dict of queue depth and wait time statistics."""
+        with self._lock:
+            started = self._submitted - self._queued
+            return {
+                'workers': self.size,
+                'queue_depth': self._queued,
+                'max_queue_depth': self._max_queued,
+                'running': self._running,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'wait_time_avg': self._wait_total / started if started else 0.0,
+                'wait_time_max': self._wait_max,
+            }
+
+    def close(self):
+        """Stop all workers after they have finished the queued functions."""
+        for t in self._threads:
+            self._queue.put(None)
+
+
+class _AsyncioDispatcher(object):
+
+    """Run functions on an asyncio event loop in a separate thread.
+
+    When a function returns a coroutine or a future, it is run as a
+    task on the loop. Functions submitted with the same key run one
+    after another, a keyed task has to finish before the next one is
+    started.
+    """
+
+    def __init__(self, loop=None):
+        self._asyncio = _import_asyncio()
+        self.loop = loop or self._asyncio.new_event_loop()
+        self._ensure_future = getattr(self._asyncio, 'ensure_future', None) or getattr(self._asyncio, 'async')
+        self._keys = {} # key -> deque of functions waiting for the running one, only touched on the loop
+
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._max_queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._thread = threading.Thread(target=self._run_loop, name='webkitwindow-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run_loop(self):
+        self._asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, f, key=None):
+        with self._lock:
+            self._submitted += 1
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        self.loop.call_soon_threadsafe(self._enqueue, f, key, time.time())
+
+    def _enqueue(self, f, key, submitted):
+        if key is not None:
+            if key in self._keys:
+                self._keys[key].append((f, submitted))
+                return
+            self._keys[key] = collections.deque()
+        self._start(f, key, submitted)
+
+    def _start(self, f, key, submitted):
+        waited = time.time() - submitted
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            res = f()
+        except Exception:
+            traceback.print_exc()
+            res = None
+
+        if self._asyncio.iscoroutine(res) or isinstance(res, self._asyncio.Future):
+            task = self._ensure_future(res, loop=self.loop)
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self._done(key, None)
+
+    def _done(self, key, task):
+        if task is not None and not task.cancelled() and task.exception() is not None:
+            self.loop.call_exception_handler({
+                'message': 'Unhandled exception in network handler',
+                'exception': task.exception(),
+                'future': task,
+            })
+
+        with self._lock:
+            self._running -= 1
+            self._completed += 1
+
+        if key is not None:
+            waiting = self._keys[key]
+            if waiting:
+                f, submitted = waiting.popleft()
+                self.loop.call_soon(self._start, f, key, submitted)
+            else:
+                del self._keys[key]
+
+    def stats(self):
+        """Return a dict of queue depth and wait time statistics."""
+        with self._lock:
+            started = self._submitted - self._queued
+            return {
+                'queue_depth': self._queued,
+                'max_queue_depth': self._max_queued,
+                'running': self._running,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'wait_time_avg': self._wait_total / started if started else 0.0,
+                'wait_time_max': self._wait_max,
+            }
+
+    def close(self):
+        """Stop the event loop."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class _WindowProxy(object):
+
+    """The WebkitWindow interface as seen from a handler process."""
+
+    def __init__(self, send):
+        self._send = send
+
+    @staticmethod
+    def run_later(f, timeout=None):
+        """Run function f after timeout milliseconds on a separate thread."""
+        t = threading.Timer((timeout or 0) / 1000.0, f)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self._send(('window', 'close', ()))
+
+    def zoom_factor(self, zoom_factor=None):
+        assert zoom_factor is not None, "the zoom factor can only be set from a handler process"
+        assert isinstance(zoom_factor, (int, long, float))
+        self._send(('window', 'zoom_factor', (float(zoom_factor), )))
+
+    def broadcast(self, websockets, data, binary=None):
+        ids = [getattr(ws, '_id', ws) for ws in websockets]
+        self._send(('window', 'broadcast', (ids, ) + _websocket_data(data, binary)))
+
+
+class _ProcessWebSocketBackend(object):
+
+    """The WebSocketBackend interface as seen from a handler process."""
+
+    def __init__(self, send):
+        self._send = send
+        self._server_open = _Callback(lambda id: send(('ws_open', id)))
+        self._server_close = _Callback(lambda id: send(('ws_close', id)))
+
+    def send_messages(self, id, messages):
+        if messages:
+            self._send(('ws_send', id, messages))
+        return True
+
+    def buffered_amount(self, id):
+        # queue limits are enforced in the GUI process
+        return 0
+
+
+# uploads received by handler processes without an upload_spool_size
+# are spooled to disk from this size on
+_PROCESS_UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+def _handler_process_main(handler, conn):
+    """Run handler in a child process, serving the messages on conn."""
+    lock = threading.Lock()
+    replies = {} # request id -> _DetachedReply
+    flows = {} # request id -> _FlowControl of a streaming response
+    uploads = {} # request id -> Request waiting for its streamed body
+    websockets = {}
+
+    def send(msg, body=None):
+        with lock:
+            conn.send(msg)
+            if body is not None:
+                conn.send_bytes(body)
+
+    def make_reply(id):
+        state = {}
+
+        def respond(status, status_text, message, streaming):
+            if not streaming:
+                replies.pop(id, None)
+            body, file_range, watermarks = message.body, None, None
+            if isinstance(body, _FileRange):
+                # let the GUI process read the file itself
+                body.close()
+                body, file_range = None, (body.path, body.start, body.length)
+            flow = message._flow if streaming else None
+            if flow is not None:
+                # the GUI process reports what webkit has read
+                flows[id] = flow
+                watermarks = (flow.high_watermark, flow.low_watermark)
+            has_body = not streaming and body is not None
+            send(('respond', id, status, status_text, message.headers, streaming, file_range, watermarks, has_body),
+                 body if has_body else None)
+
+        def write(data):
+            send(('write', id, True), data)
+
+        def close():
+            replies.pop(id, None)
+            flows.pop(id, None)
+            send(('close', id))
+
+        # the GUI process counted the abort, let it count the completion too
+        return _DetachedReply(respond, write, close, lambda: send(('aborted_completed', id)))
+
+    inbox = Queue.Queue()
+
+    def read():
+        # handlers run on the main thread and may wait for webkit to
+        # read their streaming responses -> receive apart from them
+        while True:
+            try:
+                msg = conn.recv()
+                has_data = (msg[0] == 'request' and msg[5]) or (msg[0] == 'body' and msg[2])
+                data = conn.recv_bytes() if has_data else None
+            except (EOFError, IOError):
+                inbox.put(None)
+                return
+            if msg[0] == 'exit':
+                inbox.put(None)
+                return
+            if msg[0] == 'consumed':
+                flow = flows.get(msg[1])
+                if flow is not None:
+                    flow.consumed(msg[2])
+                continue
+            if msg[0] == 'abort':
+                flow = flows.pop(msg[1], None)
+                if flow is not None:
+                    # nobody is going to read the rest
+                    flow.close()
+            inbox.put((msg, data))
+
+    reader = threading.Thread(target=read, name='webkitwindow-handler-reader')
+    reader.daemon = True
+    reader.start()
+
+    backend = _ProcessWebSocketBackend(send)
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+
+        msg, data = item
+        kind = msg[0]
+        try:
+            if kind == 'request':
+                _, id, method, url, headers, has_body, spool_size = msg
+                reply = replies[id] = make_reply(id)
+                if spool_size is not False:
+                    # a streamed upload, call the handler once it has been
+                    # received, nobody reads it before -> always spool it
+                    if spool_size is None:
+                        spool_size = _PROCESS_UPLOAD_SPOOL_SIZE
+                    uploads[id] = Request(method=method, url=url, message=Message(headers, RequestBody(spool_size=spool_size)), fake_reply=reply)
+                    continue
+                handler.request(Request(method=method, url=url, message=Message(headers, data), fake_reply=reply))
+            elif kind == 'body':
+                request = uploads.get(msg[1])
+                if msg[2]:
+                    if request is not None:
+                        request.message.body._feed(data)
+                elif request is not None:
+                    del uploads[msg[1]]
+                    request.message.body._finish(msg[3])
+                    if not request.fake_reply.aborted:
+                        handler.request(request)
+            elif kind == 'abort':
+                uploads.pop(msg[1], None)
+                reply = replies.pop(msg[1], None)
+                if reply is not None:
+                    reply.abort()
+            elif kind == 'connect':
+                _, id, url = msg
+                ws = websockets[id] = WebSocket(url, backend, id)
+                handler.connect(ws)
+            elif kind == 'receive':
+                _, id, data = msg
+                handler.receive(websockets[id], data)
+            elif kind == 'close':
+                handler.close(websockets.pop(msg[1]))
+            elif kind == 'startup':
+                if getattr(handler, 'startup', None):
+                    handler.startup(_WindowProxy(send))
+        except Exception:
+            traceback.print_exc()
+
+
+def _fork_server_main(handler, conn, parent_conn, address, authkey):
+    """Fork a handler process for each message on conn and reply with its pid."""
+    # without closing the inherited parent end, conn would never see EOF
+    parent_conn.close()
+    # let the kernel reap the handler processes
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            conn.recv()
+        except (EOFError, IOError):
+            return
+        pid = os.fork()
+        if pid == 0:
+            global _gui_thread_ident
+            # the handler runs on the main thread, which has the ident
+            # the Qt main thread had in the GUI process
+            _gui_thread_ident = None
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                _handler_process_main(handler, multiprocessing.connection.Client(address, authkey=authkey))
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(0)
+        conn.send(pid)
+
+
+class _ForkServer(object):
+
+    """A process that forks handler processes for the GUI process.
+
+    It is started before Qt so that handler processes, including the
+    ones restarted after a crash, never inherit the Qt state or the
+    threads of the GUI process. The handler processes connect back to
+    a listener on a unix socket.
+    """
+
+    def __init__(self, handler):
+        authkey = os.urandom(20)
+        self._listener = multiprocessing.connection.Listener(family='AF_UNIX', authkey=authkey)
+        self._lock = threading.Lock()
+        self._conn, server_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_fork_server_main,
+                                               args=(handler, server_conn, self._conn, self._listener.address, authkey))
+        self.process.daemon = True
+        self.process.start()
+        server_conn.close()
+
+    def fork(self):
+        """Start a handler process and return its pid and the connection to it."""
+        with self._lock:
+            self._conn.send('fork')
+            pid = self._conn.recv()
+            return pid, self._listener.accept()
+
+    def close(self, timeout=1):
+        self._conn.close()
+        self._listener.close()
+        self.process.join(timeout)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class _HandlerProcess(object):
+
+    """A child process running a handler and the connection to talk to it."""
+
+    def __init__(self, fork_server, on_message, on_exit):
+        self.pid, self.conn = fork_server.fork()
+
+        self.requests = {} # id -> Request, pending in this process
+        self.websockets = {} # id -> WebSocket
+        self._on_message = on_message
+        self._on_exit = on_exit
+
+        # sending may block when the child is busy -> never send from the Qt main thread
+        self._outbox = Queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='webkitwindow-process-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        self._reader = threading.Thread(target=self._read, name='webkitwindow-process-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def send(self, msg, body=None, sent=None):
+        """Queue msg (and body) for the process, call sent() once they are in the pipe."""
+        self._outbox.put((msg, body, sent))
+
+    def _write(self):
+        while True:
+            item = self._outbox.get()
+            msg, body, sent = item or (('exit', ), None, None)
+            try:
+                self.conn.send(msg)
+                if body is not None:
+                    self.conn.send_bytes(body)
+            except (IOError, EOFError, ValueError):
+                # the reader notices that the process is gone
+                return
+            if item is None:
+                # closing conn here would not wake up the reader, the
+                # process closes its end once it got 'exit'
+                return
+            if sent is not None:
+                sent()
+
+    def _read(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+                body = self.conn.recv_bytes() if msg[0] in ('respond', 'write') and msg[-1] else None
+            except (IOError, EOFError):
+                self.conn.close()
+                self._on_exit(self)
+                return
+            try:
+                self._on_message(self, msg, body)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self, timeout=1):
+        self._outbox.put(None)
+        # the process is a child of the fork server, it exits once its connection is closed
+        deadline = time.time() + timeout
+        while _pid_alive(self.pid):
+            if time.time() > deadline:
+                os.kill(self.pid, signal.SIGTERM)
+                break
+            time.sleep(0.01)
+        self._reader.join(max(0, deadline - time.time()))
+
+
+class _ProcessNetworkHandler(object):
+
+    """NetworkHandler that forwards all calls to handler processes.
+
+    Each child process runs its own forked copy of handler. They are
+    forked by a _ForkServer started along with this object, before Qt.
+    Requests go to the process with the fewest pending requests, all
+    events of a websocket go to the process that got its connect. A
+    crashed process is restarted, its pending requests are answered
+    with a 503 and its websockets are closed.
+
+    Request and response bodies are sent with send_bytes and not
+    pickled. The watermarks of a streaming response are passed on to
+    the response in the GUI process, which reports what webkit has
+    read back to the handler process.
+    """
+
+    def __init__(self, handler, processes=1):
+        assert processes > 0, "at least one handler process is required"
+        self._handler = handler
+        self._lock = threading.Lock()
+        self._closing = False
+        self._ids = itertools.count()
+        self._restarts = 0
+        self._window = None
+        self._streams = {} # request id -> streaming Message
+        self._fork_server = _ForkServer(handler)
+        self._processes = [self._start_process() for _ in range(processes)]
+
+    def _start_process(self):
+        return _HandlerProcess(self._fork_server, self._message, self._exited)
+
+    def _least_busy(self):
+        # call with self._lock held
+        return min(self._processes, key=lambda p: len(p.requests))
+
+    # NetworkHandler interface, called on the Qt main thread
+
+    def startup(self, window):
+        self._window = window
+        for p in self._processes:
+            p.send(('startup', ))
+
+    def request(self, request):
+        id = self._ids.next()
+        body = request.message.body
+        if isinstance(body, RequestBody):
+            # forward the upload to the process as it arrives
+            with self._lock:
+                p = self._least_busy()
+                p.requests[id] = request
+                p.send(('request', id, request.method, request.url, request.message.headers, False, body.spool_size))
+            # the pump pauses until the writer thread has passed the data to the pipe
+            body._set_sink(lambda data: p.send(('body', id, True), data, lambda: body._sent(len(data))),
+                           lambda error: p.send(('body', id, False, error)))
+        else:
+            with self._lock:
+                p = self._least_busy()
+                p.requests[id] = request
+                p.send(('request', id, request.method, request.url, request.message.headers, bool(body), False), body or None)
+        request.on_abort(lambda: self._abort(p, id))
+
+    def _abort(self, p, id):
+        # webkit dropped the request, let the handler know
+        with self._lock:
+            pending = p.requests.pop(id, None)
+        self._streams.pop(id, None)
+        if pending is not None:
+            p.send(('abort', id))
+
+    def connect(self, websocket):
+        with self._lock:
+            p = self._least_busy()
+            p.websockets[websocket._id] = websocket
+            p.send(('connect', websocket._id, websocket.url))
+
+    def receive(self, websocket, data):
+        for p in self._processes:
+            if websocket._id in p.websockets:
+                p.send(('receive', websocket._id, data))
+                return
+
+    def close(self, websocket):
+        for p in self._processes:
+            if p.websockets.pop(websocket._id, None):
+                p.send(('close', websocket._id))
+                return
+
+    # messages from the handler processes, called on their reader threads
+
+    def _message(self, p, msg, body):
+        kind = msg[0]
+        if kind == 'respond':
+            _, id, status, status_text, headers, streaming, file_range, watermarks, has_body = msg
+            with self._lock:
+                request = p.requests.get(id) if streaming else p.requests.pop(id, None)
+            if request is not None:
+                message = Message(headers, _FileRange(*file_range) if file_range else body)
+                high_watermark, low_watermark = watermarks or (None, None)
+                if streaming:
+                    self._streams[id] = message
+                if not request.respond((status, status_text), message, streaming=streaming,
+                                       high_watermark=high_watermark, low_watermark=low_watermark):
+                    p.send(('abort', id))
+                elif message._flow is not None:
+                    message._flow.on_consumed = lambda size: p.send(('consumed', id, size))
+        elif kind == 'write':
+            message = self._streams.get(msg[1])
+            if message is not None and not self._write(message, body):
+                p.send(('abort', msg[1]))
+        elif kind == 'close':
+            with self._lock:
+                p.requests.pop(msg[1], None)
+            message = self._streams.pop(msg[1], None)
+            if message is not None:
+                message.close()
+        elif kind == 'aborted_completed':
+            _count_abort('aborted_completed')
+        elif kind == 'ws_open':
+            ws = p.websockets.get(msg[1])
+            if ws is not None:
+                ws.connected()
+        elif kind == 'ws_send':
+            _, id, messages = msg
+            ws = p.websockets.get(id)
+            if ws is not None:
+                # may block this reader on a full queue, which in turn
+                # blocks the handler process on its pipe
+                ws._backend.send_messages(id, messages)
+        elif kind == 'ws_close':
+            with self._lock:
+                ws = p.websockets.pop(msg[1], None)
+            if ws is not None:
+                ws.close()
+        elif kind == 'window':
+            _, name, args = msg
+            getattr(self._window, name)(*args)
+
+    def _write(self, message, data):
+        # the handler process holds off at the watermark, blocking
+        # here would stall all other requests of that process
+        if message._flow is not None:
+            message._flow.wrote(len(data))
+        return message._write_fn(data)
+
+    def _exited(self, p):
+        with self._lock:
+            if self._closing:
+                return
+            self._restarts += 1
+            new_p = self._start_process()
+            self._processes[self._processes.index(p)] = new_p
+            requests, p.requests = p.requests, {}
+            websockets, p.websockets = p.websockets, {}
+        if self._window is not None:
+            new_p.send(('startup', ))
+
+        for id, request in requests.items():
+            message = self._streams.pop(id, None)
+            if message is not None:
+                message.close()
+            else:
+                request.respond(503, Message({'Content-Type': 'text/plain'}, 'handler process died'))
+        for ws in websockets.values():
+            ws.close()
+
+    def stats(self):
+        """Return a dict with the number of processes, restarts and pending work."""
+        with self._lock:
+            return {
+                'processes': len(self._processes),
+                'restarts': self._restarts,
+                'pending_requests': sum(len(p.requests) for p in self._processes),
+                'websockets': sum(len(p.websockets) for p in self._processes),
+            }
+
+    def close(self):
+        """Stop all handler processes."""
+        with self._lock:
+            self._closing = True
+        for p in self._processes:
+            p.stop()
+        self._fork_server.close()
+
+
+class AsyncNetworkHandler(QtCore.QObject):
+    _request   = QtCore.pyqtSignal(object)
+    _connect   = QtCore.pyqtSignal(object)
+    _receive   = QtCore.pyqtSignal(object, object)
+    _close     = QtCore.pyqtSignal(object)
+
+    def __init__(self, network_handler, dispatcher=None):
+        super(AsyncNetworkHandler, self).__init__()
+        self._nh = network_handler
+        self._dispatcher = dispatcher
+        self._request.connect(self.request)
+        self._connect.connect(self.connect)
+        self._receive.connect(self.receive)
+        self._close.connect(self.close)
+
+    def _call(self, event, target, key, f, *args):
+        # run the handler method on the Qt main thread or hand it to the dispatcher
+        if self._dispatcher is None:
+            if _watchdog is None:
+                f(*args)
+            else:
+                _watchdog.call(event, target, f, *args)
+        else:
+            self._dispatcher.submit(lambda: f(*args), key)
+
+    # HTTP
+
+    @QtCore.pyqtSlot(object)
+    def request(self, request):
+        trace = getattr(request.fake_reply, '_trace', None)
+        if trace is None:
+            self._call('request', request, None, self._nh.request, request)
+        else:
+            self._call('request', request, None, self._traced_request, trace, request)
+
+    def _traced_request(self, trace, request):
+        trace.started = time.time()
+        try:
+            return self._nh.request(request)
+        finally:
+            trace.returned = time.time()
+
+    # object
+
+    @QtCore.pyqtSlot(object)
+    def connect(self, websocket):
+        self._call('connect', websocket, websocket._id, self._nh.connect, websocket)
+
+    @QtCore.pyqtSlot(object, object)
+    def receive(self, websocket, data):
+        received = time.time() if _metrics is not None else None
+        self._call('receive', websocket, websocket._id, self._receive_and_ack, websocket, data, received)
+
+    def _receive_and_ack(self, websocket, data, received=None):
+        started = time.time() if received is not None else None
+        try:
+            return self._nh.receive(websocket, data)
+        finally:
+            # let the javascript side update its bufferedAmount
+            websocket._backend._server_ack.emit(websocket._id)
+            if started is not None and _metrics is not None:
+                _metrics.record('ws_receive', 'WS', websocket.url_path, {
+                    'ws_receive_queue': started - received,
+                    'ws_receive_handler': time.time() - started,
+                }, size=len(data))
+
+    @QtCore.pyqtSlot(object)
+    def close(self, websocket):
+        self._call('close', websocket, websocket._id, self._nh.close, websocket)
+
+class _UploadPump(object):
+
+    """Feed a RequestBody from the QIODevice webkit passes to createRequest.
+
+    Runs on the Qt main thread in slices of at most slice_time seconds
+    so that large uploads do not stall the UI.
+    """
+
+    slice_time = 0.005
+
+    def __init__(self, device, body, reply):
+        self.device = device
+        self.body = body
+        self.reply = reply
+        self._scheduled = False
+        body._fill = self.fill
+        # the device is only valid until the reply has finished
+        reply.finished.connect(self.stop)
+        if device.isSequential():
+            device.readyRead.connect(self.schedule)
+
+    def schedule(self):
+        if not self._scheduled and self.device is not None:
+            self._scheduled = True
+            WebkitWindow.run_later(self.pump)
+
+    def stop(self):
+        if self.device is not None:
+            self.device = None
+            self.body._fill = None
+            self.body._finish('request finished before its body was read')
+
+    def pump(self, deadline=None):
+        self._scheduled = False
+        if self.device is None:
+            return
+        if self.reply.aborted:
+            self.stop()
+            return
+
+        if deadline is None:
+            deadline = time.time() + self.slice_time
+        while not self.body.closed:
+            if self.body._full():
+                self.body._pending_flow().on_drain(self.schedule)
+                return
+
+            data = str(self.device.read(self.body.chunk_size))
+            if data:
+                self.body._feed(data)
+            elif self.device.atEnd() or not self.device.isSequential():
+                self.device = None
+                self.body._fill = None
+                self.body._finish()
+                return
+            else:
+                # wait for readyRead
+                return
+
+            if time.time() > deadline:
+                self.schedule()
+                return
+
+    def fill(self):
+        # called by RequestBody.read on the Qt main thread, reads only
+        # what the device already has without re-entering the event loop
+        self.pump(deadline=0)
+
+
+class _QtRequestHeaders(object):
+
+    """Build the header dict of a QNetworkRequest once it is needed.
+
+    Passed to Message as its headers, keeps an (implicitly shared,
+    thus cheap) copy of the request.
+    """
+
+    __slots__ = ('_request', '_headers')
+
+    def __init__(self, request):
+        self._request = QtNetwork.QNetworkRequest(request)
+        self._headers = None
+
+    def __call__(self):
+        if self._headers is None:
+            request = self._request
+            self._headers = dict((str(h), str(request.rawHeader(h))) for h in request.rawHeaderList())
+        return self._headers
+
+
+def _cache_control(value):
+    """Parse a Cache-Control header value into a dict of directive -> argument or None."""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+class _CachedResponse(object):
+
+    __slots__ = ('status', 'status_text', 'headers', 'body', 'expires')
+
+    def __init__(self, status, status_text, headers, body, expires):
+        self.status = status
+        self.status_text = status_text
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+
+    def size(self):
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+
+class ResponseCache(object):
+
+    """Cache handler responses in the network access manager.
+
+    Pass an instance (or True for a default one) as the response_cache
+    argument of WebkitWindow.run. Responses are stored when the handler
+    allows it with a Cache-Control header:
+
+        request.respond(200, Message({'Content-Type': 'application/json',
+                                      'Cache-Control': 'max-age=5'}, body))
+
+    and served without calling the handler until they expire. no-store
+    and no-cache responses are never stored, default_max_age applies to
+    responses without a max-age (None: only store responses that have
+    one). Streaming and file responses are not cached.
+
+    Entries are keyed on method, url and the request headers named in
+    vary and the least recently used ones are evicted once their size
+    exceeds max_size bytes. Requests with a no-cache Cache-Control or
+    Pragma header skip the lookup, requests with other methods (POST,
+    PUT, ...) invalidate the entries of their url.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024, default_max_age=None, vary=('Accept', ),
+                 methods=('GET', 'HEAD'), statuses=(200, 203, 301, 404, 410)):
+        self.default_max_age = default_max_age
+        self.vary = tuple(vary)
+        self.methods = frozenset(methods)
+        self.statuses = frozenset(statuses)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stores = 0
+        self.invalidations = 0
+        self._lock = threading.Lock() # for the counters
+        self._entries = _LRUCache(max_size, sizeof=_CachedResponse.size)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def key(self, method, url, message):
+        """Return the cache key of a request, None if it must not be served from the cache."""
+        if method not in self.methods:
+            return None
+        return (method, url) + tuple(message.get_header(name) for name in self.vary)
+
+    def lookup(self, key, message):
+        """Return the cached response for key or None.
+
+        Safe to call from any thread, like the other methods.
+        """
+        if 'no-cache' in _cache_control(message.get_header('Cache-Control')) \
+                or message.get_header('Pragma') == 'no-cache':
+            self._count('misses')
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.time():
+            self._entries.pop(key)
+            self._count('expired')
+            entry = None
+        self._count('misses' if entry is None else 'hits')
+        return entry
+
+    def store(self, key, status, status_text, message):
+        """Store the response message for key if its status and headers allow it.
+
+        Return True if it has been stored.
+        """
+        if status not in self.statuses or not isinstance(message.body, (str, type(None))):
+            return False
+
+        directives = _cache_control(message.get_header('Cache-Control'))
+        if 'no-store' in directives or 'no-cache' in directives:
+            return False
+        max_age = directives.get('max-age')
+        try:
+            max_age = float(max_age) if max_age is not None else self.default_max_age
+        except ValueError:
+            return False
+        if not max_age or max_age <= 0:
+            return False
+
+        headers = dict((str(k), str(v)) for k, v in message.headers.items())
+        self._entries.put(key, _CachedResponse(status, status_text, headers, message.body or '',
+                                               time.time() + max_age))
+        self._count('stores')
+        return True
+
+    def invalidate(self, url=None, prefix=False):
+        """Drop the entries of url (or all urls starting with it if prefix is set).
+
+        url is either a full url or a path (with query string), without
+        an url all entries are dropped. Return the number of dropped
+        entries.
+        """
+        if url is None:
+            count = len(self._entries)
+            self._entries.clear()
+            self._count('invalidations', count)
+            return count
+
+        def matches(entry_url):
+            if url.startswith('/'):
+                parts = urlparse.urlsplit(entry_url)
+                entry_url = parts.path + ('?' + parts.query if parts.query else '')
+            return entry_url.startswith(url) if prefix else entry_url == url
+
+        count = 0
+        for key in self._entries.keys():
+            if matches(key[1]) and self._entries.pop(key) is not None:
+                count += 1
+        self._count('invalidations', count)
+        return count
+
+    def stats(self):
+        """Return a dict with hits, misses, the hit rate and the size of the cache.
+
+        Hits and misses count lookups, expired entries and requests
+        skipping the cache are misses.
+        """
+        entries = self._entries.stats()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': entries['entries'],
+                    'size': entries['size'],
+                    'max_size': entries['max_size'],
+                    'evictions': entries['evictions'],
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'expired': self.expired,
+                    'stores': self.stores,
+                    'invalidations': self.invalidations}
+
+
+_SCRIPT_TYPES = frozenset(['application/javascript', 'application/x-javascript', 'text/javascript', 'text/css'])
+_DATA_TYPES = frozenset(['application/json', 'application/xml', 'text/xml', 'text/plain', 'text/csv'])
+
+def classify_request(request):
+    """Return the priority class of a request for the RequestScheduler.
+
+    The class is derived from the content type guessed from the url
+    path or else from the Accept header:
+
+        'document' .. html pages and frames
+        'script'   .. javascript and css
+        'data'     .. json, xml and XHR requests
+        'image'    .. images, fonts and media
+        'other'    .. everything else
+        None       .. event streams, never queued
+    """
+    accept = request.message.get_header('Accept') or ''
+    if 'text/event-stream' in accept:
+        return None
+    if request.message.get_header('X-Requested-With'):
+        return 'data'
+
+    mimetype = mimetypes.guess_type(request.url_path)[0]
+    if mimetype is None:
+        mimetype = accept.split(',')[0].split(';')[0].strip()
+        if mimetype == '*/*' and not os.path.splitext(request.url_path)[1]:
+            # XMLHttpRequest sends */* by default
+            return 'data'
+
+    if mimetype in ('text/html', 'application/xhtml+xml'):
+        return 'document'
+    elif mimetype in _SCRIPT_TYPES:
+        return 'script'
+    elif mimetype in _DATA_TYPES or mimetype.endswith('+json'):
+        return 'data'
+    elif mimetype.split('/')[0] in ('image', 'font', 'audio', 'video') or 'font' in mimetype:
+        return 'image'
+    return 'other'
+
+
+class RequestScheduler(object):
+
+    """Pass requests to the network handler by priority, limiting how many of each class are in progress.
+
+    Pass an instance (or True for a default one) as the scheduler
+    argument of WebkitWindow.run. classify(request) returns the
+    priority class of each request (see classify_request), limits maps
+    classes to the number of their requests that may be in progress
+    at once (None: unlimited) and max_active limits the number of all
+    requests in progress. A request is in progress from the moment it
+    is passed to the handler until the handler has responded (for
+    streaming responses: has started the response) or webkit has
+    aborted it, but at most slot_timeout seconds (None: no limit) so
+    that a handler that never responds does not stall its class.
+
+    Queued requests are passed on highest priority class first (in
+    order of priorities), so a page loading hundreds of images still
+    gets its scripts and data early. Requests that webkit aborts while
+    they are queued are dropped without ever reaching the handler.
+    Requests classified as None bypass the scheduler.
+
+    Used on the Qt main thread only.
+    """
+
+    priorities = ('document', 'script', 'data', 'other', 'image')
+    default_limits = {'image': 4, 'other': 8}
+
+    def __init__(self, limits=None, max_active=None, classify=None, slot_timeout=30):
+        self.limits = dict(self.default_limits)
+        self.limits.update(limits or {})
+        self.max_active = max_active
+        self.classify = classify or classify_request
+        self.slot_timeout = slot_timeout
+        self._queues = dict((c, collections.deque()) for c in self.priorities)
+        self._queued = {} # request -> class, for requests waiting in _queues
+        self._running = {} # request -> class
+        self._active = dict((c, 0) for c in self.priorities)
+        self._stats = dict((c, {'dispatched': 0, 'dropped': 0, 'expired': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+                           for c in self.priorities)
+
+    def _can_start(self, cls):
+        limit = self.limits.get(cls)
+        return ((limit is None or self._active[cls] < limit)
+                and (self.max_active is None or len(self._running) < self.max_active))
+
+    def submit(self, request, dispatch):
+        """Call dispatch(request) now or once its class is below its limit."""
+        cls = self.classify(request)
+        if cls not in self._queues:
+            dispatch(request)
+            return
+        if not self._queues[cls] and self._can_start(cls):
+            self._start(request, dispatch, cls, None)
+        else:
+            self._queued[request] = cls
+            self._queues[cls].append((request, dispatch, time.time()))
+
+    def _start(self, request, dispatch, cls, queued_at):
+        stats = self._stats[cls]
+        stats['dispatched'] += 1
+        if queued_at is not None:
+            waited = time.time() - queued_at
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+        self._running[request] = cls
+        self._active[cls] += 1
+        if self.slot_timeout is not None:
+            QtCore.QTimer.singleShot(int(self.slot_timeout * 1000), lambda: self._expire(request))
+        dispatch(request)
+
+    def _expire(self, request):
+        cls = self._running.get(request)
+        if cls is not None:
+            self._stats[cls]['expired'] += 1
+            self.done(request)
+
+    def done(self, request):
+        """Called when the handler has responded to request or webkit has aborted it."""
+        cls = self._queued.pop(request, None)
+        if cls is not None:
+            # aborted before the handler got it, dropped once it is dequeued
+            self._stats[cls]['dropped'] += 1
+            return
+        cls = self._running.pop(request, None)
+        if cls is not None:
+            self._active[cls] -= 1
+            self._schedule()
+
+    def _schedule(self):
+        for cls in self.priorities:
+            queue = self._queues[cls]
+            while queue and self._can_start(cls):
+                request, dispatch, queued_at = queue.popleft()
+                if self._queued.pop(request, None) is not None:
+                    self._start(request, dispatch, cls, queued_at)
+            if self.max_active is not None and len(self._running) >= self.max_active:
+                break
+
+    def stats(self):
+        """Return a dict of class -> dict with the number of queued, active, dispatched, dropped and expired requests and queue wait times."""
+        res = {}
+        for cls in self.priorities:
+            stats = dict(self._stats[cls])
+            stats['queued'] = sum(1 for r, _, _ in self._queues[cls] if r in self._queued)
+            stats['active'] = self._active[cls]
+            stats['wait_avg'] = stats['wait_total'] / stats['dispatched'] if stats['dispatched'] else 0.0
+            res[cls] = stats
+        return res
+
+
+def _preload_key(url):
+    # QUrl drops the path of http://host, so treat it as http://host/
+    parts = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+
+
+def _preload_headers(url, document):
+    """Return the Accept header webkit sends when requesting url."""
+    if document:
+        accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+    else:
+        mimetype = mimetypes.guess_type(urlparse.urlsplit(url).path)[0] or ''
+        if mimetype == 'text/css':
+            accept = 'text/css,*/*;q=0.1'
+        elif mimetype.startswith('image/'):
+            accept = 'image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5'
+        else:
+            accept = '*/*'
+    return {'Accept': accept}
+
+
+class _Preload(object):
+
+    """A preloaded response, kept until a FakeReply takes it over.
+
+    Writes to a streaming response are buffered until then and count
+    towards its high_watermark, afterwards they are passed on as they
+    arrive.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reply = None
+        self._response = None # (status, status_text, message, streaming)
+        self._chunks = []
+        self._closed = False
+        self.detached_reply = _DetachedReply(self._respond, self._write, self._close)
+
+    def _respond(self, status, status_text, message, streaming):
+        with self._lock:
+            self._response = (status, status_text, message, streaming)
+            reply = self._reply
+        if reply is not None:
+            if not streaming:
+                reply._handler_done()
+            reply.fake_response.emit(status, status_text, message, streaming)
+
+    def _write(self, data):
+        with self._lock:
+            reply = self._reply
+            if reply is None:
+                self._chunks.append(data)
+                return
+        reply.fake_response_write.emit(data)
+
+    def _close(self):
+        with self._lock:
+            reply = self._reply
+            if reply is None:
+                self._closed = True
+                return
+        reply._handler_done()
+        reply.fake_response_close.emit()
+
+    def attach(self, reply):
+        """Pass what the handler has responded so far to reply, and everything else once it arrives."""
+        with self._lock:
+            self._reply = reply
+            if self._response is None:
+                return
+            status, status_text, message, streaming = self._response
+            if not streaming:
+                reply._handler_done()
+            reply.fake_response.emit(status, status_text, message, streaming)
+            if self._chunks:
+                reply.fake_response_write.emit(''.join(self._chunks))
+                self._chunks = []
+            if self._closed:
+                reply._handler_done()
+                reply.fake_response_close.emit()
+
+    def discard(self):
+        """Stop a handler that is still writing and release the response."""
+        self.detached_reply.abort()
+        with self._lock:
+            response, self._response, self._chunks = self._response, None, []
+        if response is None:
+            return
+        message = response[2]
+        if response[3] and message._flow is not None:
+            message._flow.close()
+        elif isinstance(message.body, _FileRange):
+            message.body.close()
+
+
+class _Preloader(object):
+
+    """Responses requested from the handler before the window is shown, see WebkitWindow.run.
+
+    Each response is handed out once, to the first GET request for its
+    url, even if the handler is still working on it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._preloads = {} # url -> _Preload
+
+    def start(self, urls, submit, page_url=None):
+        """Pass a GET request for each url to submit(request).
+
+        page_url is requested as a document, the others as its resources.
+        """
+        for url in urls:
+            key = _preload_key(url)
+            preload = _Preload()
+            with self._lock:
+                self._preloads[key] = preload
+            headers = _preload_headers(url, page_url is not None and key == _preload_key(page_url))
+            submit(Request(method='GET', url=url, message=Message(headers), fake_reply=preload.detached_reply))
+
+    def take(self, url):
+        """Return the _Preload of url or None."""
+        with self._lock:
+            return self._preloads.pop(_preload_key(url), None)
+
+    def deliver(self, preload, reply):
+        """Attach reply to preload once webkit had a chance to connect to it."""
+        QtCore.QTimer.singleShot(0, lambda: preload.attach(reply))
+
+    def clear(self):
+        """Drop the responses nobody asked for."""
+        with self._lock:
+            preloads, self._preloads = self._preloads, {}
+        for preload in preloads.values():
+            preload.discard()
+
+
+class LocalDispatchNetworkAccessManager(QtNetwork.QNetworkAccessManager):
+    """
+    Custom NetworkAccessManager to intercept requests and dispatch them locally.
+    """
+
+    operation_strings = {
+        QtNetwork.QNetworkAccessManager.HeadOperation: 'HEAD',
+        QtNetwork.QNetworkAccessManager.GetOperation: 'GET',
+        QtNetwork.QNetworkAccessManager.PutOperation: 'PUT',
+        QtNetwork.QNetworkAccessManager.PostOperation: 'POST',
+        QtNetwork.QNetworkAccessManager.DeleteOperation: 'DELETE',
+        QtNetwork.QNetworkAccessManager.CustomOperation: None,
+    }
+
+    # pass request bodies as RequestBody streams, see WebkitWindow.run
+    stream_uploads = False
+    upload_spool_size = None
+
+    # a ResponseCache or None, see WebkitWindow.run
+    response_cache = None
+
+    # a RequestScheduler or None, see WebkitWindow.run
+    scheduler = None
+
+    # a _Preloader or None, see WebkitWindow.run
+    preloader = None
+
+    def set_network_handler(self, network_handler):
+        # overwriting the ctor with new arguments is not allowed -> use a setter instead
+        self.network_handler = network_handler
+
+    def set_upload_streaming(self, stream_uploads, upload_spool_size=None):
+        self.stream_uploads = stream_uploads
+        self.upload_spool_size = upload_spool_size
+
+    def set_response_cache(self, response_cache):
+        self.response_cache = response_cache
+
+    def set_scheduler(self, scheduler):
+        self.scheduler = scheduler
+
+    def set_preloader(self, preloader):
+        self.preloader = preloader
+
+    def _cached_reply(self, request, operation, entry):
+        reply = FakeReply(self, request, operation)
+        reply._handler_done()
+        reply._fake_response(entry.status, entry.status_text, Message(dict(entry.headers), entry.body), False)
+        QtCore.QTimer.singleShot(0, lambda:self.finished.emit(reply))
+        return reply
+
+    def createRequest(self, operation, request, data):
+        created = time.time() if _metrics is not None else None
+        reply = None
+        if _startup_timer is not None:
+            _startup_timer.mark('first_request')
+
+        # decode operation (== request method)
+        op_str = self.operation_strings[operation]
+        if op_str:
+            method = op_str
+        else:
+            # custom
+            method = str(request.attribute(QNetwork.QNetworkRequest.CustomVerbAttribute).toString())
+
+        url = str(request.url().toString())
+        headers = _QtRequestHeaders(request)
+
+        preloaded = self.preloader.take(url) if self.preloader is not None and method == 'GET' else None
+        if preloaded is not None:
+            reply = FakeReply(self, request, operation)
+            self.preloader.deliver(preloaded, reply)
+            QtCore.QTimer.singleShot(0, lambda:self.finished.emit(reply))
+            return reply
+
+        cache = self.response_cache
+        cache_key = None
+        if cache is not None:
+            request_message = Message(headers=headers)
+            cache_key = cache.key(method, url, request_message)
+            if cache_key is None:
+                cache.invalidate(url)
+            else:
+                entry = cache.lookup(cache_key, request_message)
+                if entry is not None:
+                    return self._cached_reply(request, operation, entry)
+
+        # data is a QIODevice or None
+        if data is not None and self.stream_uploads:
+            try:
+                length = int(headers().get('Content-Length'))
+            except (TypeError, ValueError):
+                # missing or malformed
+                length = None if data.isSequential() else int(data.size())
+            msg = Message(headers=headers, body=RequestBody(length, self.upload_spool_size))
+            reply = FakeReply(self, request, operation)
+            _UploadPump(data, msg.body, reply).schedule()
+        else:
+            msg = Message(headers=headers, body=data and str(data.readAll()))
+            reply = FakeReply(self, request, operation)
+
+        if cache_key is not None:
+            reply._cache = (cache, cache_key)
+        if created is not None:
+            reply._trace = _RequestTrace(method, url, created)
+            reply.finished.connect(reply._finish_trace)
+        req = Request(method=method, url=url, message=msg, fake_reply=reply)
+        if self.scheduler is None:
+            self.network_handler._request.emit(req) # will .set_response the FakeReply to reply
+        else:
+            scheduler = self.scheduler
+            emit = self.network_handler._request.emit
+            def _dispatch(req):
+                reply._dispatched = True
+                emit(req)
+            # the slot is released as soon as the handler has responded
+            reply._scheduled = (scheduler, req)
+            reply._dispatched = False
+            reply.finished.connect(lambda: scheduler.done(req))
+            scheduler.submit(req, _dispatch)
+        QtCore.QTimer.singleShot(0, lambda:self.finished.emit(reply))
+        return reply
+
+
+class _ChunkBuffer(object):
+
+    """FIFO byte buffer holding a queue of written chunks.
+
+    Chunks are handed out without copying when a read covers them
+    completely and dropped as soon as they have been consumed, so
+    memory is bounded by the amount of unread data and len() is O(1).
+    """
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._offset = 0 # read position in the first chunk
+        self._size = 0   # number of unread bytes
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def read(self, max_size):
+        """Return up to max_size bytes or None if the buffer is empty."""
+        if not self._size or max_size <= 0:
+            return None
+
+        parts = []
+        wanted = max_size
+        while wanted and self._chunks:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= wanted:
+                parts.append(chunk[self._offset:] if self._offset else chunk)
+                self._chunks.popleft()
+                self._offset = 0
+                wanted -= available
+            else:
+                parts.append(chunk[self._offset:self._offset+wanted])
+                self._offset += wanted
+                wanted = 0
+
+        data = parts[0] if len(parts) == 1 else ''.join(parts)
+        self._size -= len(data)
+        return data
+
+
+class FakeReply(QtNetwork.QNetworkReply):
+    """
+    QNetworkReply implementation that returns a given response.
+    """
+
+    # writes to streaming responses are passed on per event loop
+    # iteration, see _WriteCoalescer
+    coalesce_writes = True
+
+    # file responses are read in chunks of file_chunk_size, keeping at
+    # most file_buffer_size bytes in memory
+    file_chunk_size = 256 * 1024
+    file_buffer_size = 1024 * 1024
+
+    fake_response       = QtCore.pyqtSignal(int, str, object, object)
+    fake_response_write = QtCore.pyqtSignal(object)
+    fake_response_close = QtCore.pyqtSignal()
+
+    def __init__(self, parent, request, operation):
+        QtNetwork.QNetworkReply.__init__(self, parent)
+
+        self.fake_response.connect(self._fake_response)
+        self.fake_response_write.connect(self._fake_response_write)
+        self.fake_response_close.connect(self._fake_response_close)
+
+        self._streaming = False
+        self._content = _ChunkBuffer()
+        self._flow = None
+        self._file = None
+        self._file_read_pending = False
+
+        # know when to stop writing into the reply
+        self.aborted = False
+        self.abort_token = _AbortToken()
+        self._done = False
+        self._trace = None
+        self._cache = None # (ResponseCache, key) to store the response in
+        self._scheduled = None # (RequestScheduler, Request) holding a slot until the response arrives
+        self._dispatched = True # False while the request waits in the scheduler
+
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(self.ReadOnly | self.Unbuffered)
+
+    @QtCore.pyqtSlot(int, str, object, object)
+    def _fake_response(self, status, status_text, response, streaming):
+        assert isinstance(response, Message)
+
+        if self._trace is not None:
+            self._trace.responded = time.time()
+            self._trace.status = status
+
+        if self._scheduled is not None:
+            # streaming responses may stay open for good, do not let them block their class
+            scheduler, request = self._scheduled
+            self._scheduled = None
+            scheduler.done(request)
+
+        # status
+        self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, status)
+        self.setAttribute(QtNetwork.QNetworkRequest.HttpReasonPhraseAttribute, status_text)
+
+        # headers
+        for k,v in response.headers.items():
+            self.setRawHeader(QtCore.QByteArray(k), QtCore.QByteArray(v))
+
+        if streaming:
+            # streaming response, call fake_response_write and fake_response_close
+            self._streaming = True
+            self._flow = response._flow
+            if self.aborted and self._flow is not None:
+                # aborted while the response was on its way, nobody will read it
+                self._flow.close()
+
+        else:
+            # respond immediately
+            if response.body and not 'Content-Length' in response.headers:
+                self.setHeader(QtNetwork.QNetworkRequest.ContentLengthHeader, QtCore.QVariant(len(response.body)))
+
+            if self._cache is not None:
+                cache, key = self._cache
+                cache.store(key, status, str(status_text), response)
+
+            if isinstance(response.body, _FileRange):
+                self._file = response.body
+                self._file_read_pending = True
+                QtCore.QTimer.singleShot(0, self._read_file)
+            else:
+                self._content.write(response.body)
+                QtCore.QTimer.singleShot(0, lambda : self.readyRead.emit())
+                QtCore.QTimer.singleShot(0, lambda : self.finished.emit())
+
+    def _read_file(self):
+        # refill the buffer from the file, the next refill is
+        # triggered by readData once webkit has consumed most of it
+        self._file_read_pending = False
+        if self._file is None:
+            return
+
+        while len(self._content) < self.file_buffer_size and self._file.remaining:
+            self._content.write(self._file.read(self.file_chunk_size))
+
+        done = not self._file.remaining
+        if done:
+            self._file.close()
+            self._file = None
+        self.readyRead.emit()
+        if done:
+            self.finished.emit()
+
+    @QtCore.pyqtSlot(object)
+    def _fake_response_write(self, response):
+        assert isinstance(response, basestring)
+        assert self._streaming, "not a streaming response"
+        self._content.write(response)
+        self.readyRead.emit()
+
+    @QtCore.pyqtSlot()
+    def _fake_response_close(self):
+        assert self._streaming, "not a streaming response"
+        self.finished.emit()
+
+    def abort(self):
+        self.aborted = True
+        if self._flow is not None:
+            self._flow.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self._done:
+            if self._dispatched:
+                # requests dropped by the scheduler never reached the handler
+                _count_abort('aborted')
+            self.abort_token.set()
+        self.finished.emit()
+
+    @QtCore.pyqtSlot()
+    def _finish_trace(self):
+        trace, self._trace = self._trace, None
+        if trace is not None and _metrics is not None:
+            trace.finish(_metrics, self.aborted)
+
+    def _handler_done(self):
+        # called once the handler has responded or closed its stream
+        if self._done:
+            return
+        self._done = True
+        self.abort_token.discard()
+        if self.aborted:
+            _count_abort('aborted_completed')
+
+    def bytesAvailable(self):
+        return long(len(self._content) + super(FakeReply, self).bytesAvailable())
+
+    def isSequential(self):
+        return True
+
+    def readData(self, max_size):
+        data = self._content.read(max_size)
+        if data and self._flow is not None:
+            self._flow.consumed(len(data))
+        if self._file is not None and not self._file_read_pending and len(self._content) < self.file_buffer_size // 2:
+            # refill later, so that readAll() returns only what is buffered now
+            self._file_read_pending = True
+            QtCore.QTimer.singleShot(0, self._read_file)
+        return data
+
+
+class _Callback(object):
+
+    """Stand-in for a bound Qt signal that calls a function on .emit()."""
+
+    def __init__(self, f):
+        self.emit = f
+
+
+class _DetachedReply(object):
+
+    """Stand-in for a FakeReply that passes the response to plain functions.
+
+    Used where there is no Qt event loop to deliver the response to,
+    e.g. in handler processes.
+    """
+
+    def __init__(self, respond, write, close, aborted_completed=None):
+        self.aborted = False
+        self.abort_token = _AbortToken()
+        self.fake_response = _Callback(respond)
+        self.fake_response_write = _Callback(write)
+        self.fake_response_close = _Callback(close)
+        self._aborted_completed = aborted_completed
+        self._done = False
+
+    def abort(self):
+        self.aborted = True
+        if not self._done:
+            self.abort_token.set()
+
+    def _handler_done(self):
+        if self._done:
+            return
+        self._done = True
+        self.abort_token.discard()
+        if self.aborted:
+            if self._aborted_completed is not None:
+                self._aborted_completed()
+            else:
+                _count_abort('aborted_completed')
+
+
+def _encode_websocket_batch(entries):
+    """Encode (ids, binary, data) tuples into a single string.
+
+    Each message is framed as `<id>[|<id>...],<binary>,<length>;<data>`
+    with length in UTF-16 code units as javascript counts them. Binary
+    data is encoded with one char per byte.
+    """
+    parts = []
+    for ids, binary, data in entries:
+        if binary:
+            data = data.decode('latin-1')
+            length = len(data)
+        else:
+            if not isinstance(data, unicode):
+                data = str(data).decode('utf-8')
+            length = len(data) if sys.maxunicode == 0xffff else len(data.encode('utf-16-le')) // 2
+        parts.append(u'%s,%d,%d;' % (u'|'.join(str(id) for id in ids), binary, length))
+        parts.append(data)
+    return u''.join(parts)
+
+
+class _WebSocketOutbox(object):
+
+    """Messages sent to a websocket but not yet passed to javascript.
+
+    With max_queue set, at most that many messages are kept. On
+    overflow, .put() waits until there is room again ('block'), drops
+    the oldest message ('drop_oldest') or gives up and marks the
+    outbox closed ('close'). Where waiting is not possible (on the Qt
+    main thread, which does the flushing) 'block' refuses the
+    messages instead.
+
+    Broadcast messages are passed to javascript without going through
+    the outbox but count towards max_queue until they are, see
+    .reserve().
+    """
+
+    overflow_policies = ('block', 'drop_oldest', 'close')
+
+    def __init__(self, max_queue=None, overflow='block'):
+        assert overflow in self.overflow_policies, "unknown overflow policy: %r" % (overflow, )
+        assert max_queue is None or max_queue > 0, "max_queue must be positive"
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.messages = collections.deque()
+        self.bytes = 0
+        self.dropped = 0
+        self.reserved = 0 # broadcast messages waiting to be passed on
+        self.closed = False
+        self.queued_at = None # set by the backend when tracing
+        self._flush_pending = False
+        self._cond = threading.Condition()
+
+    def put(self, messages, schedule_flush, block=True):
+        """Queue (data, binary) messages.
+
+        schedule_flush is called when the queue needs to be flushed.
+        Return True when all messages have been queued, False when the
+        outbox is closed and 'overflow' if it has just been closed
+        because it overflowed. With the 'block' policy and block set
+        to False, return None when the queue is full, messages that
+        did not fit have not been queued.
+        """
+        res = True
+        with self._cond:
+            for data, binary in messages:
+                if self.closed:
+                    return False
+
+                if self.max_queue is not None and len(self.messages) + self.reserved >= self.max_queue:
+                    if self.overflow == 'drop_oldest':
+                        self.dropped += 1
+                        if not self.messages:
+                            # only broadcasts are pending, drop this one
+                            continue
+                        old, _ = self.messages.popleft()
+                        self.bytes -= len(old)
+                    elif self.overflow == 'close':
+                        self.close()
+                        return 'overflow'
+                    elif block:
+                        if not self._flush_pending:
+                            # messages of this call are waiting
+                            self._flush_pending = True
+                            schedule_flush()
+                        while len(self.messages) + self.reserved >= self.max_queue and not self.closed:
+                            self._cond.wait()
+                        if self.closed:
+                            return False
+                    else:
+                        res = None
+                        break
+
+                self.messages.append((data, binary))
+                self.bytes += len(data)
+
+            flush = self.messages and not self._flush_pending
+            self._flush_pending = self._flush_pending or bool(flush)
+
+        if flush:
+            schedule_flush()
+        return res
+
+    def reserve(self):
+        """Count a broadcast message towards max_queue until .release().
+
+        Never blocks. Return True if the message may be sent, False if
+        it is dropped (the outbox is full or closed) and 'overflow' if
+        the outbox has just been closed by the 'close' policy.
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            if self.max_queue is not None and len(self.messages) + self.reserved >= self.max_queue:
+                if self.overflow == 'close':
+                    self.close()
+                    return 'overflow'
+                self.dropped += 1
+                return False
+            self.reserved += 1
+            return True
+
+    def release(self):
+        """A reserved broadcast message has been passed to javascript."""
+        with self._cond:
+            self.reserved -= 1
+            self._cond.notify_all()
+
+    def take(self):
+        """Return and remove all queued messages."""
+        with self._cond:
+            messages = list(self.messages)
+            self.messages.clear()
+            self.bytes = 0
+            self._flush_pending = False
+            self._cond.notify_all()
+        return messages
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self.messages.clear()
+            self.bytes = 0
+            self._cond.notify_all()
+
+
+class WebSocketBackend(QtCore.QObject):
+
+    # javascript websocket events fo the given connection_id
+    onmessage = QtCore.pyqtSignal(int, str)
+    onbinary  = QtCore.pyqtSignal(int, str) # one char per byte
+    onopen    = QtCore.pyqtSignal(int)
+    onclose   = QtCore.pyqtSignal(int)
+
+    # several messages for one or more connections, see _encode_websocket_batch
+    onbatch   = QtCore.pyqtSignal(str)
+
+    # number of messages from the given connection processed by the handler
+    onack     = QtCore.pyqtSignal(int, int)
+
+    # used by WebSocket objects to get back onto the Qt main thread
+    _server_open      = QtCore.pyqtSignal(int)
+    _server_flush     = QtCore.pyqtSignal(int)
+    _server_broadcast = QtCore.pyqtSignal(object, object, bool)
+    _server_close     = QtCore.pyqtSignal(int)
+    _server_ack       = QtCore.pyqtSignal(int)
+
+    def __init__(self, network_handler, coalesce=False, max_queue=None, overflow='block'):
+        """Create a backend for the websockets of network_handler.
+
+        With coalesce set, messages sent during one iteration of the
+        Qt event loop are passed to javascript in a single batch.
+
+        max_queue limits the number of messages per connection that
+        have been sent but not yet passed to javascript, overflow is
+        the policy when a send exceeds it, see _WebSocketOutbox.
+        """
+        super(WebSocketBackend, self).__init__()
+        self._connections = {}
+        self._outboxes = {}
+        self._ids = itertools.count()
+        self._network_handler = network_handler
+        self._coalesce = coalesce
+        self._max_queue = max_queue
+        self._overflow = overflow
+        self._outgoing = [] # (ids, binary, data) waiting for the next flush
+        self._connecting = set() # ids whose connect has not yet been passed to the handler
+        self._reserved = [] # ids of broadcast messages in _outgoing, see _WebSocketOutbox.reserve
+        self._acks = {} # id -> number of messages to acknowledge
+        self._server_open.connect(self.server_open)
+        self._server_flush.connect(self.flush_connection)
+        self._server_broadcast.connect(self.broadcast_to_clients)
+        self._server_close.connect(self.server_close)
+        self._server_ack.connect(self.ack)
+
+    @QtCore.pyqtSlot(str, result=int)
+    def connect(self, url):
+        """Create a websocket connection."""
+        id = self._ids.next()
+        ws = WebSocket(str(url), self, id)
+        self._connections[id] = ws
+        self._outboxes[id] = _WebSocketOutbox(self._max_queue, self._overflow)
+        self._connecting.add(id)
+        QtCore.QTimer.singleShot(0, lambda: self._connected(ws)) #??????
+        return id
+
+    def _connected(self, ws):
+        if ws._id in self._connecting:
+            self._connecting.discard(ws._id)
+            self._network_handler._connect.emit(ws)
+
+    def _remove(self, id):
+        outbox = self._outboxes.pop(id, None)
+        if outbox is not None:
+            # wake up blocked senders
+            outbox.close()
+        return self._connections.pop(id, None)
+
+    @QtCore.pyqtSlot(int)
+    def client_close(self, id):
+        """Close the given websocket connection, initiated from the client."""
+        ws = self._remove(id)
+        if id in self._connecting:
+            # closed before the handler got the connect, it need not know at all
+            self._connecting.discard(id)
+        elif ws is not None:
+            self._network_handler._close.emit(ws)
+
+    @QtCore.pyqtSlot(int)
+    def server_open(self, id):
+        """Confirm the given websocket connection."""
+        if id in self._connections:
+            self.onopen.emit(id)
+
+    @QtCore.pyqtSlot(int)
+    def server_close(self, id):
+        """Close the given websocket connection, initiated from the server."""
+        if id in self._connections:
+            # deliver queued messages before the socket is gone
+            self.flush_connection(id)
+            self.flush()
+            self._remove(id)
+            self.onclose.emit(id)
+
+    @QtCore.pyqtSlot(int, str)
+    def send_to_server(self, id, data):
+        """Send data on the given websocket connection to the network_handler."""
+        self._network_handler._receive.emit(self._connections[id], unicode(data))
+
+    @QtCore.pyqtSlot(int, str)
+    def send_binary_to_server(self, id, data):
+        """Send binary data, one char per byte, to the network_handler."""
+        self._network_handler._receive.emit(self._connections[id], unicode(data).encode('latin-1'))
+
+    def send_messages(self, id, messages):
+        """Queue a list of (data, binary) messages for the given websocket.
+
+        Safe to call from any thread. Blocking on a full queue only
+        happens outside of the Qt main thread as the queue is flushed
+        there, on the main thread the 'block' policy returns None
+        instead. Return False if the connection is closed.
+        """
+        outbox = self._outboxes.get(id)
+        if outbox is None:
+            return False
+
+        if _metrics is None:
+            schedule_flush = lambda: self._server_flush.emit(id)
+        else:
+            def schedule_flush():
+                outbox.queued_at = time.time()
+                self._server_flush.emit(id)
+
+        res = outbox.put(messages, schedule_flush, block=not _on_gui_thread())
+        if res == 'overflow':
+            self._server_close.emit(id)
+            return False
+        return res
+
+    def send_to_client(self, id, data, binary=False):
+        """Send data from the backend to the given websocket in the browser.
+
+        Data sent to connections that have been closed in the meantime
+        is dropped.
+        """
+        return self.send_messages(id, [(data, binary)])
+
+    def buffered_amount(self, id):
+        """Return the number of bytes queued for the given websocket."""
+        outbox = self._outboxes.get(id)
+        return outbox.bytes if outbox is not None else 0
+
+    @QtCore.pyqtSlot(int)
+    def flush_connection(self, id):
+        """Pass the queued messages of a websocket to javascript."""
+        outbox = self._outboxes.get(id)
+        if outbox is None:
+            return
+
+        messages = outbox.take()
+        if outbox.queued_at is not None and _metrics is not None and messages:
+            _metrics.record('ws_send', 'WS', self._connections[id].url_path, {
+                'ws_send_queue': time.time() - outbox.queued_at,
+            }, messages=len(messages))
+            outbox.queued_at = None
+
+        if len(messages) == 1 and not self._coalesce:
+            data, binary = messages[0]
+            if binary:
+                self.onbinary.emit(id, data.decode('latin-1'))
+            else:
+                self.onmessage.emit(id, data)
+        elif messages:
+            self._enqueue([((id, ), binary, data) for data, binary in messages])
+
+    @QtCore.pyqtSlot(object, object, bool)
+    def broadcast_to_clients(self, ids, data, binary):
+        """Send data to all given websockets, encoding it only once."""
+        accepted = []
+        for id in ids:
+            outbox = self._outboxes.get(id)
+            if outbox is None:
+                continue
+            res = outbox.reserve()
+            if res == 'overflow':
+                self.server_close(id)
+            elif res:
+                accepted.append(id)
+        if accepted:
+            self._enqueue([(accepted, binary, data)], accepted)
+
+    def broadcast(self, connections, data, binary=None):
+        """Send data to the given WebSocket objects (or connection ids).
+
+        Safe to call from any thread. Broadcasts bypass the
+        per-connection queues but count towards their limits: a
+        connection with a full queue does not get the message (or is
+        closed with the 'close' overflow policy).
+        """
+        ids = [getattr(ws, '_id', ws) for ws in connections]
+        data, binary = _websocket_data(data, binary)
+        self._server_broadcast.emit(ids, data, binary)
+
+    def _enqueue(self, entries, reserved=()):
+        if not self._coalesce:
+            self.onbatch.emit(_encode_websocket_batch(entries))
+            self._release(reserved)
+            return
+        if not self._outgoing:
+            QtCore.QTimer.singleShot(0, self.flush)
+        self._outgoing.extend(entries)
+        self._reserved.extend(reserved)
+
+    def _release(self, ids):
+        for id in ids:
+            outbox = self._outboxes.get(id)
+            if outbox is not None:
+                outbox.release()
+
+    @QtCore.pyqtSlot()
+    def flush(self):
+        """Pass all queued messages to javascript in one batch."""
+        if self._outgoing:
+            entries, self._outgoing = self._outgoing, []
+            reserved, self._reserved = self._reserved, []
+            self.onbatch.emit(_encode_websocket_batch(entries))
+            self._release(reserved)
+
+    @QtCore.pyqtSlot(int)
+    def ack(self, id):
+        """Acknowledge a message from the browser, acks are sent once per event loop iteration."""
+        if not self._acks:
+            QtCore.QTimer.singleShot(0, self._flush_acks)
+        self._acks[id] = self._acks.get(id, 0) + 1
+
+    def _flush_acks(self):
+        acks, self._acks = self._acks, {}
+        for id, count in acks.items():
+            if id in self._connections:
+                self.onack.emit(id, count)
+
+
+class RPCError(Exception):
+
+    """A remote function raised an error or does not exist."""
+
+
+class RPCCall(object):
+
+    """The pending result of a call into javascript, see WebkitWindow.call_js.
+
+    Completed on the Qt main thread, wait for it from any other thread
+    or use add_done_callback.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._ok = None
+        self._value = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def _set(self, ok, value):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._ok, self._value = ok, value
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, None
+        for cb in callbacks:
+            cb(self)
+
+    def add_done_callback(self, cb):
+        """Call cb(self) once the result is there."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return
+        cb(self)
+
+    def result(self, timeout=None):
+        """Wait for and return the result, raise an RPCError if the call failed."""
+        if not self._event.wait(timeout):
+            raise RPCError("timeout calling %r" % (self.name, ))
+        if not self._ok:
+            raise RPCError(self._value)
+        return self._value
+
+    wait = result
+
+
+def _encode_rpc_results(results):
+    """JSON encode a list of (id, ok, value) call results.
+
+    Results that cannot be encoded are turned into errors instead of
+    failing the whole batch.
+    """
+    try:
+        return json.dumps(results)
+    except (TypeError, ValueError):
+        encoded = []
+        for id, ok, value in results:
+            try:
+                encoded.append(json.dumps([id, ok, value]))
+            except (TypeError, ValueError) as e:
+                encoded.append(json.dumps([id, False, 'cannot encode result: %s' % (e, )]))
+        return '[%s]' % ','.join(encoded)
 
-    # HTTP
 
-    @QtCore.pyqtSlot(object)
-    def request(self, request):
-        self._nh.request(request)
+class RPCBackend(QtCore.QObject):
 
-    # object
+    """Call python functions from javascript and vice versa.
 
-    @QtCore.pyqtSlot(object)
-    def connect(self, websocket):
-        self._nh.connect(websocket)
+    Works like the WebSocketBackend: it is added to each frame as
+    `_rpcExt` and rpc_js provides the `python` object in javascript:
 
-    @QtCore.pyqtSlot(object, str)
-    def receive(self, websocket, data):
-        self._nh.receive(websocket, unicode(data))
+        python.call('add', 1, 2).then(function (res) { ... });
+        python.bind('add')(1, 2).then(...);
+        python.expose('update', function (data) { ... });
 
-    @QtCore.pyqtSlot(object)
-    def close(self, websocket):
-        self._nh.close(websocket)
+    Calls made during one javascript tick cross the Qt bridge as a
+    single JSON encoded batch and so do their results. Arguments and
+    results must be JSON serializable.
 
-class LocalDispatchNetworkAccessManager(QtNetwork.QNetworkAccessManager):
-    """
-    Custom NetworkAccessManager to intercept requests and dispatch them locally.
+    Python functions are called like the methods of the network
+    handler (on the Qt main thread, a worker thread or the asyncio
+    loop, depending on the dispatch mode). They may return a value,
+    a future or, in 'asyncio' dispatch mode, a coroutine.
     """
 
-    operation_strings = {
-        QtNetwork.QNetworkAccessManager.HeadOperation: 'HEAD',
-        QtNetwork.QNetworkAccessManager.GetOperation: 'GET',
-        QtNetwork.QNetworkAccessManager.PutOperation: 'PUT',
-        QtNetwork.QNetworkAccessManager.PostOperation: 'POST',
-        QtNetwork.QNetworkAccessManager.DeleteOperation: 'DELETE',
-        QtNetwork.QNetworkAccessManager.CustomOperation: None,
-    }
+    # JSON list of [call_id, ok, result or error] for the given frame
+    onresults = QtCore.pyqtSignal(int, str)
 
-    def set_network_handler(self, network_handler):
-        # overwriting the ctor with new arguments is not allowed -> use a setter instead
-        self.network_handler = network_handler
+    # JSON list of [call_id, name, args] of calls into javascript for the given frame
+    onjscall  = QtCore.pyqtSignal(int, str)
 
-    def createRequest(self, operation, request, data):
-        reply = None
+    # used to get back onto the Qt main thread
+    _server_result = QtCore.pyqtSignal(int, object)
+    _server_jscall = QtCore.pyqtSignal(object)
 
-        # decode operation (== request method)
-        op_str = self.operation_strings[operation]
-        if op_str:
-            method = op_str
+    def __init__(self, network_handler, functions=None):
+        super(RPCBackend, self).__init__()
+        self._network_handler = network_handler
+        self._functions = dict(functions or {})
+        self._frames = itertools.count()
+        self._results = {} # frame id -> [(call_id, ok, value)] waiting for the next flush
+        self._js_ids = itertools.count()
+        self._js_calls = {} # call id -> RPCCall
+        self._js_call_frames = {} # call id -> frame id the call has been sent to
+        self._js_outgoing = {} # frame id -> [[call_id, name, args]] waiting for the next flush
+        self._js_names = {} # frame id -> {exposed function name: exposure number}
+        self._exposures = itertools.count()
+        self._frame_ids = {} # QWebFrame -> frame id of the page it shows
+        self._clearing = None # QWebFrame whose shim is being loaded
+        self._server_result.connect(self.add_result)
+        self._server_jscall.connect(self.add_jscall)
+
+    def expose(self, name, f):
+        """Make f callable from javascript as python.call(name, ...)."""
+        self._functions[name] = f
+
+    # javascript -> python
+
+    def clear_frame(self, frame):
+        """Called before the shim is loaded into a (new page of a) QWebFrame."""
+        self.forget_frame(frame)
+        self._clearing = frame
+
+    def forget_frame(self, frame):
+        """Drop the functions exposed by the page of frame and fail the calls waiting for it."""
+        frame_id = self._frame_ids.pop(frame, None)
+        if frame_id is None:
+            return
+        self._js_names.pop(frame_id, None)
+        self._js_outgoing.pop(frame_id, None)
+        for call_id, call_frame_id in self._js_call_frames.items():
+            if call_frame_id == frame_id:
+                self.js_result(call_id, False, 'frame is gone')
+
+    @QtCore.pyqtSlot(result=int)
+    def register_frame(self):
+        """Return an id for a frame to tell its results apart."""
+        frame_id = self._frames.next()
+        self._js_names[frame_id] = {}
+        if self._clearing is not None:
+            self._frame_ids[self._clearing] = frame_id
+            self._clearing = None
+        return frame_id
+
+    @QtCore.pyqtSlot(int, str)
+    def call_batch(self, frame_id, calls):
+        """Call the python functions of a JSON list of [call_id, name, args]."""
+        for call_id, name, args in json.loads(unicode(calls)):
+            f = self._functions.get(name)
+            if f is None:
+                self.add_result(frame_id, (call_id, False, 'no such function: %s' % (name, )))
+            else:
+                self._network_handler._call('rpc', None, None, self._invoke, frame_id, call_id, f, args)
+
+    def _invoke(self, frame_id, call_id, f, args):
+        try:
+            res = f(*args)
+        except Exception as e:
+            self._server_result.emit(frame_id, (call_id, False, '%s: %s' % (type(e).__name__, e)))
+            return
+
+        dispatcher = getattr(self._network_handler, '_dispatcher', None)
+        if isinstance(dispatcher, _AsyncioDispatcher) and dispatcher._asyncio.iscoroutine(res):
+            res = dispatcher._ensure_future(res, loop=dispatcher.loop)
+
+        if hasattr(res, 'add_done_callback'):
+            res.add_done_callback(lambda future: self._future_done(frame_id, call_id, future))
         else:
-            # custom
-            method = str(request.attribute(QNetwork.QNetworkRequest.CustomVerbAttribute).toString())
+            self._server_result.emit(frame_id, (call_id, True, res))
+
+    def _future_done(self, frame_id, call_id, future):
+        if future.cancelled():
+            self._server_result.emit(frame_id, (call_id, False, 'cancelled'))
+        elif future.exception() is not None:
+            e = future.exception()
+            self._server_result.emit(frame_id, (call_id, False, '%s: %s' % (type(e).__name__, e)))
+        else:
+            self._server_result.emit(frame_id, (call_id, True, future.result()))
 
-        url = str(request.url().toString())
-        headers = dict((str(h),str(request.rawHeader(h))) for h in request.rawHeaderList())
+    @QtCore.pyqtSlot(int, object)
+    def add_result(self, frame_id, result):
+        """Queue a result, results are sent once per event loop iteration."""
+        if not self._results:
+            QtCore.QTimer.singleShot(0, self._flush_results)
+        self._results.setdefault(frame_id, []).append(result)
 
-        # data is a QIODevice or None
-        msg = Message(headers=headers, body=data and str(data.readAll()))
-        reply = FakeReply(self, request, operation)
-        self.network_handler._request.emit(Request(method=method, url=url, message=msg, fake_reply=reply)) # will .set_response the FakeReply to reply
-        QtCore.QTimer.singleShot(0, lambda:self.finished.emit(reply))
-        return reply
+    def _flush_results(self):
+        results, self._results = self._results, {}
+        for frame_id, frame_results in results.items():
+            self.onresults.emit(frame_id, _encode_rpc_results(frame_results))
 
+    # python -> javascript
 
-class FakeReply(QtNetwork.QNetworkReply):
-    """
-    QNetworkReply implementation that returns a given response.
-    """
+    def call_js(self, name, *args):
+        """Call the javascript function exposed as name.
 
-    fake_response       = QtCore.pyqtSignal(int, str, object, object)
-    fake_response_write = QtCore.pyqtSignal(object)
-    fake_response_close = QtCore.pyqtSignal()
+        Safe to call from any thread. The call goes to the frame that
+        exposed name most recently. Return an RPCCall holding its
+        result, it fails if no frame exposes name or the frame is gone
+        before it answers.
+        """
+        call = RPCCall(name)
+        call_id = self._js_ids.next()
+        self._js_calls[call_id] = call
+        self._server_jscall.emit([call_id, name, list(args)])
+        return call
 
-    def __init__(self, parent, request, operation):
-        QtNetwork.QNetworkReply.__init__(self, parent)
+    @QtCore.pyqtSlot(object)
+    def add_jscall(self, jscall):
+        call_id, name, args = jscall
+        exposures = [(names[name], frame_id) for frame_id, names in self._js_names.items() if name in names]
+        if not exposures:
+            self.js_result(call_id, False, 'no such function: %s' % (name, ))
+            return
+        _, frame_id = max(exposures)
+        if not self._js_outgoing:
+            QtCore.QTimer.singleShot(0, self._flush_jscalls)
+        self._js_outgoing.setdefault(frame_id, []).append(jscall)
+        self._js_call_frames[call_id] = frame_id
+
+    def _flush_jscalls(self):
+        outgoing, self._js_outgoing = self._js_outgoing, {}
+        for frame_id, calls in outgoing.items():
+            try:
+                encoded = json.dumps(calls)
+            except (TypeError, ValueError) as e:
+                for call_id, name, args in calls:
+                    self.js_result(call_id, False, 'cannot encode arguments: %s' % (e, ))
+                continue
+            self.onjscall.emit(frame_id, encoded)
 
-        self.fake_response.connect(self._fake_response)
-        self.fake_response_write.connect(self._fake_response_write)
-        self.fake_response_close.connect(self._fake_response_close)
+    @QtCore.pyqtSlot(int, str)
+    def js_expose(self, frame_id, name):
+        """Called when a frame exposes a javascript function."""
+        names = self._js_names.get(frame_id)
+        if names is not None:
+            names[unicode(name)] = self._exposures.next()
 
-        self._streaming = False
-        self._content = None
-        self._offset = 0
+    @QtCore.pyqtSlot(str)
+    def js_results(self, results):
+        """Complete the calls of a JSON list of [call_id, ok, result or error]."""
+        for call_id, ok, value in json.loads(unicode(results)):
+            self.js_result(call_id, ok, value)
 
-        # know when to stop writing into the reply
-        self.aborted = False
+    def js_result(self, call_id, ok, value):
+        self._js_call_frames.pop(call_id, None)
+        call = self._js_calls.pop(call_id, None)
+        if call is not None:
+            call._set(ok, value)
 
-        self.setRequest(request)
-        self.setUrl(request.url())
-        self.setOperation(operation)
-        self.open(self.ReadOnly | self.Unbuffered)
 
-    @QtCore.pyqtSlot(int, str, object, object)
-    def _fake_response(self, status, status_text, response, streaming):
-        assert isinstance(response, Message)
+class _MainThreadTimer(QtCore.QObject):
 
-        # status
-        self.setAttribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute, status)
-        self.setAttribute(QtNetwork.QNetworkRequest.HttpReasonPhraseAttribute, status_text)
+    """Start single shot timers on the Qt main thread from any thread."""
 
-        # headers
-        for k,v in response.headers.items():
-            self.setRawHeader(QtCore.QByteArray(k), QtCore.QByteArray(v))
+    _start = QtCore.pyqtSignal(object, int)
 
-        if streaming:
-            # streaming response, call fake_response_write and fake_response_close
-            self._streaming = True
-            self._content = StringIO.StringIO()
+    def __init__(self):
+        super(_MainThreadTimer, self).__init__()
+        self._start.connect(self.start)
 
-        else:
-            self._content = response.body
-            self._offset = 0
+    @QtCore.pyqtSlot(object, int)
+    def start(self, f, timeout):
+        QtCore.QTimer.singleShot(timeout, f)
 
-            # respond immediately
-            if self._content and not 'Content-Length' in response.headers:
-                self.setHeader(QtNetwork.QNetworkRequest.ContentLengthHeader, QtCore.QVariant(len(self._content)))
+# created in WebkitWindow._run
+_main_thread_timer = None
 
-            QtCore.QTimer.singleShot(0, lambda : self.readyRead.emit())
-            QtCore.QTimer.singleShot(0, lambda : self.finished.emit())
 
-    @QtCore.pyqtSlot(object)
-    def _fake_response_write(self, response):
-        assert isinstance(response, basestring)
-        assert self._streaming, "not a streaming response"
-        self._content.write(response)
-        self.readyRead.emit()
+class _WatchedCall(object):
 
-    @QtCore.pyqtSlot()
-    def _fake_response_close(self):
-        assert self._streaming, "not a streaming response"
-        self.finished.emit()
+    __slots__ = ('event', 'target', 'started', 'stack')
 
-    def abort(self):
-        self.aborted = True
-        self.finished.emit()
+    def __init__(self, event, target, started):
+        self.event = event
+        self.target = target
+        self.started = started
+        self.stack = None
 
-    def bytesAvailable(self):
-        if isinstance(self._content, StringIO.StringIO):
-            c = self._content.getvalue()
-        else:
-            c = self._content
 
-        avail = long(len(c) - self._offset + super(FakeReply, self).bytesAvailable())
-        return avail
+class LoopWatchdog(object):
 
-    def isSequential(self):
-        return True
+    """Measure the lag of the Qt event loop and report slow handler calls.
 
-    def readData(self, max_size):
-        if isinstance(self._content, StringIO.StringIO):
-            c = self._content.getvalue()
-        else:
-            c = self._content
+    Pass an instance (or True) as the watchdog argument of
+    WebkitWindow.run. A timer on the Qt main thread fires every
+    interval seconds, the delay of each tick is the event loop lag.
+    Handler methods called on the Qt main thread (the 'gui' dispatch
+    mode) are timed individually.
 
-        if self._offset < len(c):
-            size = min(max_size, len(c)-self._offset)
-            data = c[self._offset:self._offset+size]
-            self._offset += size
-            return data
-        else:
-            return None
+    Lags and handler calls longer than threshold seconds are passed
+    as dicts to callback (or logged to the 'webkitwindow' logger):
 
+        {'kind': 'lag', 'lag': seconds, 'stack': ...}
+        {'kind': 'slow_handler', 'event': 'request', 'duration': seconds,
+         'method': 'GET', 'url': ..., 'stack': ...}
 
-class WebSocketBackend(QtCore.QObject):
+    Websocket events have 'websocket' (the connection id) and 'url'
+    instead of 'method' and 'url'. With sample_stacks, a thread
+    samples the stack of the Qt main thread once it has been stuck
+    for threshold seconds, otherwise stack is None.
+    """
 
-    # javascript websocket events fo the given connection_id
-    onmessage = QtCore.pyqtSignal(int, str)
-    onopen    = QtCore.pyqtSignal(int)
-    onclose   = QtCore.pyqtSignal(int)
+    def __init__(self, threshold=0.1, interval=0.05, callback=None, sample_stacks=False):
+        self.threshold = threshold
+        self.interval = interval
+        self.callback = callback
+        self.sample_stacks = sample_stacks
+        self.ticks = 0
+        self.lags = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.slow_calls = 0
+        self._current = None # _WatchedCall running on the Qt main thread
+        self._last_tick = None
+        self._stall_stack = None
+        self._gui_ident = None
+        self._timer = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching, call on the Qt main thread once there is a QApplication."""
+        self._gui_ident = threading.current_thread().ident
+        self._last_tick = time.time()
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self._tick)
+        self._timer.start(int(self.interval * 1000))
+        if self.sample_stacks:
+            sampler = threading.Thread(target=self._sample_loop, name='webkitwindow-watchdog')
+            sampler.daemon = True
+            sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.stop()
+
+    def stats(self):
+        """Return a dict with the number of ticks, lags and slow calls and the lag times."""
+        return {'ticks': self.ticks,
+                'lags': self.lags,
+                'max_lag': self.max_lag,
+                'mean_lag': self.total_lag / self.ticks if self.ticks else 0.0,
+                'slow_calls': self.slow_calls}
+
+    def call(self, event, target, f, *args):
+        """Run f(*args) on the Qt main thread, report it if it is slow."""
+        previous = self._current
+        call = self._current = _WatchedCall(event, target, time.time())
+        try:
+            return f(*args)
+        finally:
+            self._current = previous
+            duration = time.time() - call.started
+            if duration > self.threshold:
+                self.slow_calls += 1
+                report = {'kind': 'slow_handler', 'event': event, 'duration': duration, 'stack': call.stack}
+                if isinstance(target, Request):
+                    report.update(method=target.method, url=target.url)
+                elif isinstance(target, WebSocket):
+                    report.update(websocket=target._id, url=target.url)
+                self._report(report)
+
+    def _tick(self):
+        now = time.time()
+        lag = max(0.0, now - self._last_tick - self.interval)
+        self._last_tick = now
+        self.ticks += 1
+        self.total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if lag > self.threshold:
+            self.lags += 1
+            stack, self._stall_stack = self._stall_stack, None
+            self._report({'kind': 'lag', 'lag': lag, 'stack': stack})
+
+    def _sample_loop(self):
+        while not self._stopped.wait(self.interval):
+            stuck = time.time() - self.threshold
+            call = self._current
+            if call is not None and call.stack is None and call.started < stuck:
+                call.stack = self._sample()
+            if self._stall_stack is None and self._last_tick < stuck - self.interval:
+                self._stall_stack = self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._gui_ident)
+        if frame is None:
+            return None
+        return ''.join(traceback.format_stack(frame))
+
+    def _report(self, report):
+        if self.callback is not None:
+            try:
+                self.callback(report)
+            except Exception:
+                traceback.print_exc()
+        else:
+            logging.getLogger('webkitwindow').warning('event loop blocked: %r', report)
 
-    def __init__(self, network_handler):
-        super(WebSocketBackend, self).__init__()
-        self._connections = {}
-        self._ids = itertools.count()
-        self._network_handler = network_handler
+# the LoopWatchdog of the running window, None when disabled
+_watchdog = None
 
-    @QtCore.pyqtSlot(str, result=int)
-    def connect(self, url):
-        """Create a websocket connection."""
-        id = self._ids.next()
-        ws = WebSocket(str(url), self, id)
-        self._connections[id] = ws
-        QtCore.QTimer.singleShot(0, lambda: self._network_handler._connect.emit(ws)) #??????
-        return id
 
-    @QtCore.pyqtSlot(int)
-    def client_close(self, id):
-        """Close the given websocket connection, initiated from the client."""
-        self._network_handler._close.emit(self._connections[id])
-        del self._connections[id]
+class _StartupTimer(object):
 
-    def server_close(self, id):
-        """Close the given websocket connection, initiated from the server."""
-        del self._connections[id]
-        self.onclose.emit(id)
+    """Record the time of startup events, see WebkitWindow.run.
 
-    @QtCore.pyqtSlot(int, str)
-    def send_to_server(self, id, data):
-        """Send data on the given websocket connection to the network_handler."""
-        self._network_handler._receive.emit(self._connections[id], data)
+    Times are seconds since WebkitWindow.run was called, each event is
+    recorded (and passed to callback) only the first time.
+    """
 
-    def send_to_client(self, id, data):
-        """Send data from the backend to the given websocket in the browser."""
-        assert self._connections[id]
-        self.onmessage.emit(id, data)
+    def __init__(self, callback=None):
+        self.started = time.time()
+        self.callback = callback
+        self.times = collections.OrderedDict()
+
+    def mark(self, event):
+        if event in self.times:
+            return
+        self.times[event] = seconds = time.time() - self.started
+        if self.callback is not None:
+            try:
+                self.callback(event, seconds)
+            except Exception:
+                traceback.print_exc()
+
+# the _StartupTimer of the running window
+_startup_timer = None
+
+
+def import_gui():
+    """Import QtGui and QtWebKit and create the classes that derive from them.
+
+    Loading QtWebKit takes a noticeable part of the startup time, it is
+    deferred until the first window is created so that importing this
+    module (e.g. in handler processes or for a LoadClient) stays cheap.
+    Until then CustomQWebPage is None, call import_gui() first to use
+    it earlier, e.g. to subclass it.
+    """
+    global QtGui, QtWebKit
+    if QtWebKit is None:
+        QtGui = importlib.import_module(_qt_package + '.QtGui')
+        QtWebKit = importlib.import_module(_qt_package + '.QtWebKit')
+        for name, base, attrs in _gui_classes:
+            module_name, class_name = base.split('.')
+            base = getattr(globals()[module_name], class_name)
+            globals()[name] = type(base)(name, (base, ), attrs)
+
+# (name, base, attrs) of the classes created by import_gui
+_gui_classes = []
+
+def _gui_class(base):
+    """Metaclass of a class deriving from base, a 'QtGui.Class' or 'QtWebKit.Class' name.
+
+    The class body is kept until import_gui creates the class, the
+    module level name is None until then.
+    """
+    def collect(name, bases, attrs):
+        del attrs['__metaclass__']
+        _gui_classes.append((name, base, attrs))
+        return None
+    return collect
 
 
-class CustomQWebPage(QtWebKit.QWebPage):
+class CustomQWebPage(object):
 
     """QWebPage subclass to be able to implement shouldInterruptJavaScript.
 
@@ -528,6 +4273,8 @@ class CustomQWebPage(QtWebKit.QWebPage):
       - implement the other javascript* handlers (alert, prompt, confirm
     """
 
+    __metaclass__ = _gui_class('QtWebKit.QWebPage')
+
     def __init__(self, console_message='print'):
         self._console_message = console_message
         QtWebKit.QWebPage.__init__(self)
@@ -549,15 +4296,28 @@ class CustomQWebPage(QtWebKit.QWebPage):
             pass
 
 
-class _WebkitWindow(QtGui.QMainWindow):
+class _WebkitWindow(object):
+    __metaclass__ = _gui_class('QtGui.QMainWindow')
 
     _close_window = QtCore.pyqtSignal()
     _set_zoom_factor = QtCore.pyqtSignal(float)
 
-    def __init__(self, network_handler, url=None, console_message='print', no_focus_classname=None):
+    def __init__(self, network_handler, url=None, console_message='print', no_focus_classname=None, dispatcher=None,
+                 websocket_coalesce=False, websocket_max_queue=None, websocket_overflow='block',
+                 stream_uploads=False, upload_spool_size=None, rpc=None, response_cache=None,
+                 scheduler=None, preloader=None):
         self._console_message = console_message
+        self._preloader = preloader
+        self._scheduler = scheduler
+        self._response_cache = response_cache
+        self._rpc = rpc
+        self._stream_uploads = stream_uploads
+        self._upload_spool_size = upload_spool_size
+        self._websocket_coalesce = websocket_coalesce
+        self._websocket_max_queue = websocket_max_queue
+        self._websocket_overflow = websocket_overflow
         self.url = url or "http://localhost"
-        self.network_handler = AsyncNetworkHandler(network_handler)
+        self.network_handler = AsyncNetworkHandler(network_handler, dispatcher)
         self.no_focus_classname = no_focus_classname
         QtGui.QMainWindow.__init__(self)
         self.setup()
@@ -575,17 +4335,25 @@ class _WebkitWindow(QtGui.QMainWindow):
         # set the custom NAM
         nam = LocalDispatchNetworkAccessManager()
         nam.set_network_handler(self.network_handler)
+        nam.set_upload_streaming(self._stream_uploads, self._upload_spool_size)
+        nam.set_response_cache(self._response_cache)
+        nam.set_scheduler(self._scheduler)
+        nam.set_preloader(self._preloader)
         webpage.setNetworkAccessManager(nam)
 
         # websocket requests do not go through the custom NAM
         # -> catch them in the javascript directly
-        self.websocket_backend = WebSocketBackend(self.network_handler)
+        self.websocket_backend = WebSocketBackend(self.network_handler, self._websocket_coalesce,
+                                                  self._websocket_max_queue, self._websocket_overflow)
+        self.rpc_backend = RPCBackend(self.network_handler, self._rpc)
         self.setup_local_websockets(webpage)
         self.webview.setPage(webpage)
 
         # implement the custom focus rule for iframes
         self.setup_micro_focus_handler(webpage)
 
+        self.webview.loadFinished.connect(self._load_finished)
+
         horizontalLayout.addWidget(self.webview)
         horizontalLayout.setContentsMargins(0, 0, 0, 0)
         self.setCentralWidget(centralwidget)
@@ -613,6 +4381,15 @@ class _WebkitWindow(QtGui.QMainWindow):
             self.close()
         self._close_window.connect(_close_handler)
 
+    @QtCore.pyqtSlot(bool)
+    def _load_finished(self, ok):
+        if _startup_timer is not None:
+            _startup_timer.mark('load_finished')
+        if self._preloader is not None:
+            # responses not requested by the first page are of no use anymore
+            self._preloader.clear()
+            self._preloader = None
+
     ### Capturing Websocket Connections
 
     # For WebSockets, QtWebKit does not use the
@@ -632,6 +4409,95 @@ class _WebkitWindow(QtGui.QMainWindow):
     var wsExt = window._wsExt;
     window._wsExt = undefined;
 
+    // open connections by id, the Qt signals are connected only once
+    // per frame and each event is dispatched to its connection only
+    var sockets = {};
+
+    // binary data crosses the Qt bridge as strings with one char per byte
+
+    function isBlob(data) {
+        return typeof Blob !== 'undefined' && data instanceof Blob;
+    }
+
+    function isBinary(data) {
+        return data instanceof ArrayBuffer || (data && data.buffer instanceof ArrayBuffer);
+    }
+
+    function binaryToString(data) {
+        var bytes = (data instanceof ArrayBuffer) ? new Uint8Array(data) : new Uint8Array(data.buffer, data.byteOffset, data.byteLength),
+            parts = [];
+        for (var i = 0; i < bytes.length; i += 8192) {
+            parts.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 8192)));
+        }
+        return parts.join('');
+    }
+
+    function stringToArrayBuffer(s) {
+        var buf = new ArrayBuffer(s.length), bytes = new Uint8Array(buf);
+        for (var i = 0; i < s.length; i++) {
+            bytes[i] = s.charCodeAt(i);
+        }
+        return buf;
+    }
+
+    wsExt.onopen.connect(function(id) {
+        var ws = sockets[id];
+        if (ws) {
+            ws._onopen();
+        }
+    });
+
+    wsExt.onmessage.connect(function(id, data) {
+        var ws = sockets[id];
+        if (ws) {
+            ws._onmessage(data);
+        }
+    });
+
+    wsExt.onbinary.connect(function(id, data) {
+        var ws = sockets[id];
+        if (ws) {
+            ws._onbinary(data);
+        }
+    });
+
+    wsExt.onbatch.connect(function(batch) {
+        var pos = 0, sep, header, ids, length, data, ws, i;
+        while (pos < batch.length) {
+            sep = batch.indexOf(';', pos);
+            header = batch.substring(pos, sep).split(',');
+            ids = header[0].split('|');
+            length = parseInt(header[2], 10);
+            data = batch.substr(sep + 1, length);
+            pos = sep + 1 + length;
+            for (i = 0; i < ids.length; i++) {
+                ws = sockets[ids[i]];
+                if (ws) {
+                    if (header[1] === '1') {
+                        ws._onbinary(data);
+                    } else {
+                        ws._onmessage(data);
+                    }
+                }
+            }
+        }
+    });
+
+    wsExt.onack.connect(function(id, count) {
+        var ws = sockets[id];
+        if (ws) {
+            ws._onack(count);
+        }
+    });
+
+    wsExt.onclose.connect(function(id) {
+        var ws = sockets[id];
+        if (ws) {
+            delete sockets[id];
+            ws._onclose();
+        }
+    });
+
     window.WebSocket = function(url) {
         var self = this, connId;
 
@@ -644,14 +4510,58 @@ class _WebkitWindow(QtGui.QMainWindow):
         self.readyState = self.CONNECTING;
         self.extensions = "";
         self.protocol = "";
+        self.binaryType = "blob";
+        self.bufferedAmount = 0;
 
         self.onopen = undefined;
         self.onmessage = undefined;
         self.onerror = undefined;
         self.onclose = undefined;
 
+        // sends waiting for a Blob to be read, to keep them in order
+        var outbox = [];
+
+        // sizes of the sent messages the server has not yet processed
+        var unacked = [];
+
+        function sendNow(data) {
+            if (isBinary(data)) {
+                wsExt.send_binary_to_server(connId, binaryToString(data));
+            } else {
+                wsExt.send_to_server(connId, String(data));
+            }
+        }
+
+        function sendOutbox() {
+            while (outbox.length) {
+                var item = outbox[0];
+                if (isBlob(item)) {
+                    var reader = new FileReader();
+                    reader.onload = function() {
+                        outbox[0] = reader.result;
+                        sendOutbox();
+                    };
+                    outbox[0] = {reading: item};
+                    reader.readAsArrayBuffer(item);
+                    return;
+                } else if (item && item.reading) {
+                    return;
+                }
+                sendNow(outbox.shift());
+            }
+        }
+
         self.send = function(data) {
-            wsExt.send_to_server(connId, data);
+            var size = isBlob(data) ? data.size : (isBinary(data) ? data.byteLength : String(data).length);
+            unacked.push(size);
+            self.bufferedAmount += size;
+
+            if (outbox.length || isBlob(data)) {
+                outbox.push(data);
+                sendOutbox();
+            } else {
+                sendNow(data);
+            }
         };
 
         self.close = function(code, reason) {
@@ -659,60 +4569,244 @@ class _WebkitWindow(QtGui.QMainWindow):
                 // nothing
             } else if (self.readyState === self.OPEN) {
                 self.readyState = self.CLOSING;
-                wsExt.close(connId);
-                if (self.onclose) {
-                    self.onclose();
-                }
+                delete sockets[connId];
+                wsExt.client_close(connId);
+                self._onclose();
             } else {
-                self.readyState == CLOSED;
+                // still connecting, let the server forget it too
+                delete sockets[connId];
+                wsExt.client_close(connId);
+                self._onclose();
             }
         };
 
-        // register callbacks on the Qt side
+        // events from the Qt side
 
-        wsExt.onopen.connect(function(id) {
-            if (id === connId) {
-                self.readyState = self.OPEN;
-                if (self.onopen) {
-                    self.onopen();
-                }
+        self._onopen = function() {
+            self.readyState = self.OPEN;
+            if (self.onopen) {
+                self.onopen();
+            }
+        };
+
+        self._onmessage = function(data) {
+            if (self.onmessage) {
+                self.onmessage({data:data});
             }
-        });
+        };
 
-        wsExt.onmessage.connect(function(id, data) {
-            if (id === connId) {
-                if (self.onmessage) {
-                    self.onmessage({data:data});
-                }
+        self._onack = function(count) {
+            while (count-- > 0 && unacked.length) {
+                self.bufferedAmount -= unacked.shift();
             }
-        });
+        };
 
-        wsExt.onclose.connect(function(id) {
-            if (id === connId) {
-                self.readyState = self.CLOSED;
-                if (self.onclose) {
-                    self.onclose();
+        self._onbinary = function(data) {
+            data = stringToArrayBuffer(data);
+            if (self.binaryType === 'blob') {
+                try {
+                    data = new Blob([data]);
+                } catch (e) {
+                    // no Blob constructor in older webkits
                 }
             }
-        });
+            self._onmessage(data);
+        };
+
+        self._onclose = function() {
+            self.readyState = self.CLOSED;
+            if (self.onclose) {
+                self.onclose();
+            }
+        };
 
         // init
         connId = wsExt.connect(url);
+        sockets[connId] = self;
+    };
+})();
+"""
+
+    rpc_js = """
+/**
+ * Provide the python object to call functions of the RPCBackend
+ * (_rpcExt) and to expose functions to python.
+ */
+(function() {
+
+    var rpcExt = window._rpcExt;
+    window._rpcExt = undefined;
+
+    var frameId = rpcExt.register_frame();
+    var nextId = 0;
+    var pending = {}; // call id -> deferred
+    var batch = []; // calls waiting for the end of the current tick
+    var exposed = {};
+
+    // minimal promise replacement for webkits without Promise
+    function Thenable() {
+        var self = this, state = null, value, handlers = [];
+
+        function run(h) {
+            var cb = state === 'ok' ? h.ok : h.err;
+            if (!cb) {
+                (state === 'ok' ? h.next.resolve : h.next.reject)(value);
+                return;
+            }
+            try {
+                h.next.resolve(cb(value));
+            } catch (e) {
+                h.next.reject(e);
+            }
+        }
+
+        function settle(s, v) {
+            if (state) {
+                return;
+            }
+            if (s === 'ok' && v && typeof v.then === 'function') {
+                v.then(function(x) { settle('ok', x); }, function(e) { settle('err', e); });
+                return;
+            }
+            state = s;
+            value = v;
+            for (var i = 0; i < handlers.length; i++) {
+                run(handlers[i]);
+            }
+            handlers = null;
+        }
+
+        self.resolve = function(v) { settle('ok', v); };
+        self.reject = function(e) { settle('err', e); };
+        self.then = function(ok, err) {
+            var h = {ok: ok, err: err, next: new Thenable()};
+            if (state) {
+                setTimeout(function() { run(h); }, 0);
+            } else {
+                handlers.push(h);
+            }
+            return h.next;
+        };
+        self['catch'] = function(err) { return self.then(null, err); };
+    }
+
+    function deferred() {
+        var d = {};
+        if (typeof Promise !== 'undefined') {
+            d.promise = new Promise(function(resolve, reject) {
+                d.resolve = resolve;
+                d.reject = reject;
+            });
+        } else {
+            var t = new Thenable();
+            d.promise = t;
+            d.resolve = t.resolve;
+            d.reject = t.reject;
+        }
+        return d;
+    }
+
+    function flush() {
+        var calls = batch;
+        batch = [];
+        rpcExt.call_batch(frameId, JSON.stringify(calls));
+    }
+
+    rpcExt.onresults.connect(function(id, results) {
+        if (id !== frameId) {
+            return;
+        }
+        results = JSON.parse(results);
+        for (var i = 0; i < results.length; i++) {
+            var r = results[i], d = pending[r[0]];
+            if (d) {
+                delete pending[r[0]];
+                if (r[1]) {
+                    d.resolve(r[2]);
+                } else {
+                    d.reject(new Error(r[2]));
+                }
+            }
+        }
+    });
+
+    function sendResult(id) {
+        return [function(value) {
+            rpcExt.js_results(JSON.stringify([[id, true, value]]));
+        }, function(e) {
+            rpcExt.js_results(JSON.stringify([[id, false, String(e)]]));
+        }];
+    }
+
+    rpcExt.onjscall.connect(function(target, calls) {
+        if (target !== frameId) {
+            return;
+        }
+        var results = [];
+        calls = JSON.parse(calls);
+        for (var i = 0; i < calls.length; i++) {
+            var id = calls[i][0], fn = exposed[calls[i][1]], value;
+            if (!fn) {
+                results.push([id, false, 'no such function: ' + calls[i][1]]);
+                continue;
+            }
+            try {
+                value = fn.apply(null, calls[i][2]);
+            } catch (e) {
+                results.push([id, false, String(e)]);
+                continue;
+            }
+            if (value && typeof value.then === 'function') {
+                value.then.apply(value, sendResult(id));
+            } else {
+                results.push([id, true, value === undefined ? null : value]);
+            }
+        }
+        if (results.length) {
+            rpcExt.js_results(JSON.stringify(results));
+        }
+    });
+
+    window.python = {
+        call: function(name) {
+            var d = deferred(), id = nextId++;
+            pending[id] = d;
+            if (!batch.length) {
+                setTimeout(flush, 0);
+            }
+            batch.push([id, name, Array.prototype.slice.call(arguments, 1)]);
+            return d.promise;
+        },
+        bind: function(name) {
+            var self = this;
+            return function() {
+                return self.call.apply(self, [name].concat(Array.prototype.slice.call(arguments)));
+            };
+        },
+        expose: function(name, fn) {
+            exposed[name] = fn;
+            rpcExt.js_expose(frameId, name);
+        }
     };
 })();
 """
 
     def setup_local_websockets_on_frame(self, qwebframe):
-        def _load_js(f=qwebframe, js=self.websocket_js, websocket_backend=self.websocket_backend):
+        def _load_js(f=qwebframe, js=self.websocket_js, websocket_backend=self.websocket_backend,
+                     rpc_js=self.rpc_js, rpc_backend=self.rpc_backend):
             # without passing arguments as default keyword arguments, I get strange errors:
             #     "NameError: free variable 'self' referenced before assignment in enclosing scope"
             # which looks like sombody is trying to null all local
             # arguments at the end of my function
             f.addToJavaScriptWindowObject("_wsExt", websocket_backend)
             f.evaluateJavaScript(js)
+            rpc_backend.clear_frame(f)
+            f.addToJavaScriptWindowObject("_rpcExt", rpc_backend)
+            f.evaluateJavaScript(rpc_js)
 
         # TODO: 'dispose' the websocket object when the frame is gone (e.g. after reload)
         qwebframe.javaScriptWindowObjectCleared.connect(_load_js)
+        qwebframe.destroyed.connect(lambda f=qwebframe, rpc_backend=self.rpc_backend: rpc_backend.forget_frame(f))
 
     def setup_local_websockets(self, qwebpage):
         qwebpage.frameCreated.connect(lambda frame: self.setup_local_websockets_on_frame(frame))
@@ -751,7 +4845,10 @@ class _WebkitWindow(QtGui.QMainWindow):
 class WebkitWindow(object):
 
     @classmethod
-    def run(self, handler, url="http://localhost", exit=True, console_message='print', no_focus_classname=None):
+    def run(self, handler, url="http://localhost", exit=True, console_message='print', no_focus_classname=None,
+            dispatch='gui', workers=4, processes=1, websocket_coalesce=False, websocket_max_queue=None,
+            websocket_overflow='block', stream_uploads=False, upload_spool_size=None, metrics=None,
+            watchdog=None, rpc=None, response_cache=None, scheduler=None, preload=None, startup_timing=None):
         """Open a window displaying a single webkit instance.
 
         handler must be an object implementing the NetworkHandler
@@ -761,7 +4858,8 @@ class WebkitWindow(object):
 
         console_message ('print', function that receives a dict or
         None) controls how to deal with javascript console messages,
-        see CustomQWebPage.
+        see CustomQWebPage (call import_gui() to use it before the
+        first window is created).
 
         no_focus_classname should be a css classname that, when set on
         an iframe element, will prevent this element from being
@@ -769,40 +4867,263 @@ class WebkitWindow(object):
         parent iframe. Use None (the default) to turn this feature
         off.
 
+        dispatch selects where the handler methods are called:
+
+            'gui'     .. on the Qt main thread (the default)
+            'threads' .. on a pool of `workers` threads, websocket
+                         events of a single connection are still
+                         delivered one at a time and in order
+            'asyncio' .. on an asyncio (or trollius) event loop
+                         running in its own thread, handler methods
+                         (including startup) may be coroutines, see
+                         WebkitWindow.loop
+            'process' .. in `processes` forked child processes so
+                         that handler CPU work does not compete with
+                         the GUI for the GIL, see _ProcessNetworkHandler
+
+        If websocket_coalesce is true, websocket messages sent during
+        one iteration of the Qt event loop are passed to javascript in
+        a single call.
+
+        websocket_max_queue limits the number of messages per
+        websocket that have been sent but not yet passed to javascript.
+        websocket_overflow decides what a send on a full queue does:
+
+            'block'       .. wait until there is room (the default),
+                             sends from the Qt main thread return None
+                             instead of waiting
+            'drop_oldest' .. drop the oldest queued message
+            'close'       .. close the connection
+
+        If stream_uploads is true, request bodies are not read before
+        the handler is called, request.message.body is a RequestBody
+        that receives the data while the handler reads it. With
+        upload_spool_size, bodies are spooled to a temporary file once
+        they get larger than that many bytes, see RequestBody.
+        In 'process' dispatch mode the handler is called once the body
+        has been received by its process, which always spools it
+        (from 1MB on without upload_spool_size).
+
+        metrics may be a Metrics instance (or True for a default one)
+        to record the latency of requests and websocket messages, see
+        WebkitWindow.metrics.
+
+        watchdog may be a LoopWatchdog instance (or True for a default
+        one) to report event loop lags and slow handler calls, see
+        WebkitWindow.watchdog.
+
+        rpc is a dict of functions (or an object whose public methods
+        are used) that javascript can call directly, without going
+        through HTTP, see RPCBackend and WebkitWindow.expose.
+
+        response_cache may be a ResponseCache instance (or True for a
+        default one) to serve repeated requests without calling the
+        handler, see WebkitWindow.response_cache.
+
+        scheduler may be a RequestScheduler instance (or True for a
+        default one) to pass requests to the handler by priority and
+        to limit the number of concurrent requests per class (e.g.
+        images), see WebkitWindow.scheduler.
+
+        preload is a list of urls (absolute or relative to url, True
+        for just url) that are requested from the handler before the
+        window is created, so that handler work on the first page and
+        its resources overlaps with loading QtWebKit. Each response is
+        used for the first GET request of its url, streaming responses
+        keep at most their high_watermark buffered until then. The
+        requests carry the Accept header webkit would send but no
+        User-Agent. The handler's request method is called before its
+        startup method then.
+
+        startup_timing is called with the name and time (seconds since
+        run was called) of each startup event: 'gui_imported',
+        'app_created', 'window_created', 'window_shown',
+        'first_request' and 'load_finished', see
+        WebkitWindow.startup_times.
+
         If exit is true, sys.exit after closing the window.
         """
-        win = self(handler, url, exit, console_message, no_focus_classname)
+        win = self(handler, url, exit, console_message, no_focus_classname, dispatch, workers, processes,
+                   websocket_coalesce, websocket_max_queue, websocket_overflow, stream_uploads, upload_spool_size,
+                   metrics, watchdog, rpc, response_cache, scheduler, preload, startup_timing)
         return win._run()
 
     @staticmethod
     def run_later(f, timeout=None):
         """Enqueue and run function f on the main thread."""
-        QtCore.QTimer.singleShot(timeout or 0, f)
+        if _main_thread_timer is None or _on_gui_thread():
+            QtCore.QTimer.singleShot(timeout or 0, f)
+        else:
+            _main_thread_timer._start.emit(f, timeout or 0)
 
-    def __init__(self, handler, url, exit, console_message, no_focus_classname):
+    def __init__(self, handler, url, exit, console_message, no_focus_classname, dispatch='gui', workers=4, processes=1,
+                 websocket_coalesce=False, websocket_max_queue=None, websocket_overflow='block',
+                 stream_uploads=False, upload_spool_size=None, metrics=None, watchdog=None, rpc=None,
+                 response_cache=None, scheduler=None, preload=None, startup_timing=None):
+        assert dispatch in ('gui', 'threads', 'asyncio', 'process'), "unknown dispatch mode: %r" % (dispatch, )
         self._handler = handler
         self._url = url
         self._exit = exit
         self._console_message = console_message
         self._no_focus_classname = no_focus_classname
+        self._dispatch = dispatch
+        self._workers = workers
+        self._processes = processes
+        self._websocket_coalesce = websocket_coalesce
+        self._websocket_max_queue = websocket_max_queue
+        self._websocket_overflow = websocket_overflow
+        self._stream_uploads = stream_uploads
+        self._upload_spool_size = upload_spool_size
+        self._metrics = Metrics() if metrics is True else (metrics or None)
+        self._watchdog = LoopWatchdog() if watchdog is True else (watchdog or None)
+        if rpc is not None and not isinstance(rpc, dict):
+            rpc = dict((name, getattr(rpc, name)) for name in dir(rpc)
+                       if not name.startswith('_') and callable(getattr(rpc, name)))
+        self._rpc = rpc
+        self._response_cache = ResponseCache() if response_cache is True else (response_cache or None)
+        self._scheduler = RequestScheduler() if scheduler is True else (scheduler or None)
+        if preload is True:
+            preload = [url]
+        self._preload = [urlparse.urljoin(url, u) for u in preload or ()]
+        self._startup_timer = _StartupTimer(startup_timing)
+        self._dispatcher = None
 
     def _run(self):
+        global _gui_thread_ident, _main_thread_timer, _metrics, _watchdog, _startup_timer
+        _gui_thread_ident = threading.current_thread().ident
+        _metrics = self._metrics
+        _startup_timer = timer = self._startup_timer
+
+        handler = self._handler
+        dispatcher = None
+        if self._dispatch == 'process':
+            # fork the handler processes before there is any Qt state to inherit
+            handler = self._dispatcher = _ProcessNetworkHandler(self._handler, self._processes)
+        elif self._dispatch == 'threads':
+            dispatcher = self._dispatcher = _WorkerPool(self._workers)
+        elif self._dispatch == 'asyncio':
+            dispatcher = self._dispatcher = _AsyncioDispatcher()
+
+        preloader = None
+        if self._preload:
+            preloader = _Preloader()
+            if dispatcher is None:
+                preloader.start(self._preload, handler.request, self._url)
+            else:
+                preloader.start(self._preload, lambda request: dispatcher.submit(lambda: handler.request(request)), self._url)
+
+        import_gui()
+        timer.mark('gui_imported')
         app = QtGui.QApplication(sys.argv)
-        self._window = _WebkitWindow(self._handler, self._url, self._console_message, self._no_focus_classname)
+        timer.mark('app_created')
+        _main_thread_timer = _MainThreadTimer()
+        if self._watchdog is not None:
+            _watchdog = self._watchdog
+            _watchdog.start()
+        self._window = _WebkitWindow(handler, self._url, self._console_message, self._no_focus_classname, dispatcher,
+                                     self._websocket_coalesce, self._websocket_max_queue, self._websocket_overflow,
+                                     self._stream_uploads, self._upload_spool_size, self._rpc,
+                                     self._response_cache, self._scheduler, preloader)
+        timer.mark('window_created')
         self._window.show()
+        timer.mark('window_shown')
 
-        if getattr(self._handler, 'startup', None):
-            self.run_later(lambda:self._handler.startup(self))
+        if getattr(handler, 'startup', None):
+            if self._dispatch == 'asyncio':
+                self._dispatcher.submit(lambda:handler.startup(self))
+            else:
+                self.run_later(lambda:handler.startup(self))
+
+        try:
+            res = app.exec_()
+        finally:
+            if self._dispatcher is not None:
+                self._dispatcher.close()
+            if self._watchdog is not None:
+                self._watchdog.stop()
+                _watchdog = None
 
         if self._exit:
-            sys.exit(app.exec_())
+            sys.exit(res)
         else:
-            return app.exec_()
+            return res
+
+    @property
+    def loop(self):
+        """The asyncio event loop running the handler in 'asyncio' dispatch mode, else None."""
+        if isinstance(self._dispatcher, _AsyncioDispatcher):
+            return self._dispatcher.loop
+        return None
+
+    def dispatch_stats(self):
+        """Return a dict of statistics of the dispatcher.
+
+        For 'threads' and 'asyncio' this includes queue depth and wait
+        times, for 'process' the number of restarts and pending work.
+        Returns None when the handler is called on the Qt main thread.
+        """
+        if self._dispatcher is None:
+            return None
+        return self._dispatcher.stats()
+
+    @property
+    def metrics(self):
+        """The Metrics instance passed to run or None if metrics are disabled."""
+        return self._metrics
+
+    @property
+    def watchdog(self):
+        """The LoopWatchdog passed to run or None if it is disabled."""
+        return self._watchdog
+
+    @property
+    def response_cache(self):
+        """The ResponseCache passed to run or None, use it to invalidate entries and for its stats."""
+        return self._response_cache
+
+    def startup_times(self):
+        """Return an ordered dict of startup event -> seconds since run was called, see WebkitWindow.run."""
+        return collections.OrderedDict(self._startup_timer.times)
+
+    @property
+    def scheduler(self):
+        """The RequestScheduler passed to run or None, see RequestScheduler.stats."""
+        return self._scheduler
+
+    def abort_stats(self):
+        """Return a dict with the number of requests webkit aborted before the handler completed them.
+
+        'aborted_completed' counts those the handler nevertheless went
+        on to respond to (or close), i.e. work that could have been
+        stopped early using Request.on_abort or Request.abort_token.
+        """
+        with _abort_stats_lock:
+            return dict(_abort_stats)
 
     def close(self):
         """Close this WebkitWindow and exit."""
         self._window._close_window.emit()
 
+    def broadcast(self, websockets, data, binary=None):
+        """Send data to all given websockets at once.
+
+        The data is encoded once and passed to javascript in a single
+        call, binary works like in WebSocket.send.
+        """
+        self._window.websocket_backend.broadcast(websockets, data, binary)
+
+    def expose(self, name, f):
+        """Make function f callable from javascript as python.call(name, ...)."""
+        self._window.rpc_backend.expose(name, f)
+
+    def call_js(self, name, *args):
+        """Call a javascript function exposed with python.expose(name, fn).
+
+        Return an RPCCall, use its result method to wait for the
+        result. Arguments and results must be JSON serializable.
+        """
+        return self._window.rpc_backend.call_js(name, *args)
+
     def zoom_factor(self, zoom_factor=None):
         """Get or set the zoom factor."""
         if zoom_factor == None:
@@ -810,3 +5131,264 @@ class WebkitWindow(object):
         else:
             assert isinstance(zoom_factor, (int, long, float))
             self._window._set_zoom_factor.emit(float(zoom_factor))
+
+
+class ClientResponse(object):
+
+    """A response received by LoadClient."""
+
+    def __init__(self):
+        self.status = None
+        self.status_text = None
+        self.headers = None
+        self.body = None
+        self.latency = None
+        self._chunks = []
+        self._message = None
+        self._started = time.time()
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait until the response is complete, return False on timeout."""
+        return self._done.wait(timeout)
+
+    def _respond(self, status, status_text, message, streaming):
+        self.status = status
+        self.status_text = status_text
+        self.headers = message.headers
+        self._message = message
+        if not streaming:
+            body = message.body
+            if isinstance(body, _FileRange):
+                body = self._read_file(body)
+            self._finish(body)
+
+    @staticmethod
+    def _read_file(f):
+        try:
+            return f.read(f.remaining)
+        finally:
+            f.close()
+
+    def _write(self, data):
+        self._chunks.append(data)
+        flow = self._message._flow
+        if flow is not None:
+            # received means read, let high_watermark writers continue
+            flow.consumed(len(data))
+
+    def _close(self):
+        self._finish(''.join(self._chunks))
+
+    def _finish(self, body):
+        self.body = body
+        self.latency = time.time() - self._started
+        self._done.set()
+
+
+class _ClientWebSocketBackend(object):
+
+    """The WebSocketBackend interface for websockets of a LoadClient."""
+
+    def __init__(self, client):
+        self._client = client
+        self._server_open = _Callback(lambda id: client._websockets[id]._opened.set())
+        self._server_close = _Callback(lambda id: client._websockets[id]._closed_by_server())
+
+    def send_messages(self, id, messages):
+        ws = self._client._websockets.get(id)
+        if ws is None or ws.closed:
+            return False
+        for data, binary in messages:
+            ws.messages.put(data)
+        return True
+
+    def buffered_amount(self, id):
+        return 0
+
+
+class ClientWebSocket(object):
+
+    """A websocket connection of a LoadClient, the javascript side of a WebSocket."""
+
+    def __init__(self, client, url, id):
+        self._client = client
+        self.websocket = WebSocket(url, client._backend, id)
+        self.messages = Queue.Queue() # data sent by the handler
+        self.closed = False
+        self._opened = threading.Event()
+
+    def wait_connected(self, timeout=None):
+        """Wait until the handler has confirmed the connection."""
+        return self._opened.wait(timeout)
+
+    def send(self, data):
+        """Pass data (unicode for text, str for binary messages) to the handler's receive."""
+        self._client._handler.receive(self.websocket, data)
+
+    def receive(self, timeout=None):
+        """Return the next message sent by the handler, None on timeout."""
+        try:
+            return self.messages.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        """Close the connection from the client side."""
+        if not self.closed:
+            self.closed = True
+            self._client._websockets.pop(self.websocket._id, None)
+            self._client._handler.close(self.websocket)
+
+    def _closed_by_server(self):
+        self.closed = True
+        self._client._websockets.pop(self.websocket._id, None)
+
+
+def _percentile(values, p):
+    # values must be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class LoadClient(object):
+
+    """Drive a NetworkHandler without a window, e.g. for load tests and profiling.
+
+    Requests and websockets are built like the ones webkit produces
+    and passed directly to the handler on the calling thread, replies
+    are captured by ClientResponse objects. Handlers may respond from
+    any thread.
+
+        client = LoadClient(MyHandler())
+        print client.request('GET', 'http://localhost/').body
+        print client.load([('GET', 'http://localhost/api')], total=10000, concurrency=8)
+    """
+
+    def __init__(self, handler, startup=True):
+        self._handler = handler
+        self._backend = _ClientWebSocketBackend(self)
+        self._websockets = {} # id -> ClientWebSocket
+        self._ids = itertools.count()
+        self.closed = False
+        if startup and getattr(handler, 'startup', None):
+            handler.startup(_WindowProxy(self._window_message))
+
+    def _window_message(self, msg):
+        _, name, args = msg
+        if name == 'close':
+            self.closed = True
+        elif name == 'broadcast':
+            ids, data, binary = args
+            for id in ids:
+                self._backend.send_messages(id, [(data, binary)])
+
+    def request_async(self, method, url, headers=None, body=None):
+        """Pass a request to the handler, return its ClientResponse without waiting."""
+        response = ClientResponse()
+        reply = _DetachedReply(response._respond, response._write, response._close)
+        self._handler.request(Request(method=method, url=url, message=Message(headers or {}, body), fake_reply=reply))
+        return response
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        """Pass a request to the handler and wait for the complete response.
+
+        Raise an IOError if there was no response within timeout seconds.
+        """
+        response = self.request_async(method, url, headers, body)
+        if not response.wait(timeout):
+            raise IOError("no response to %s %s within %s seconds" % (method, url, timeout))
+        return response
+
+    def connect(self, url, timeout=None):
+        """Open a websocket to url, return a ClientWebSocket once the handler confirmed it."""
+        id = self._ids.next()
+        ws = self._websockets[id] = ClientWebSocket(self, url, id)
+        self._handler.connect(ws.websocket)
+        if not ws.wait_connected(timeout):
+            raise IOError("websocket %s has not been confirmed within %s seconds" % (url, timeout))
+        return ws
+
+    def load(self, requests, total=1000, concurrency=4, timeout=10):
+        """Send total requests from concurrency threads, return statistics.
+
+        requests is a list of (method, url[, headers[, body]]) tuples
+        that are sent round-robin. Each thread waits for a response
+        before sending its next request.
+        """
+        counter = itertools.count()
+        def one():
+            i = counter.next()
+            if i >= total:
+                return None
+            response = self.request(*requests[i % len(requests)], timeout=timeout)
+            return response.latency, response.status
+        return self._run(one, concurrency, 'requests')
+
+    def websocket_load(self, url, messages=1000, concurrency=4, data=u'ping', reply=True, timeout=10):
+        """Send messages from concurrency websockets, return statistics.
+
+        With reply set, wait for a message from the handler after each
+        send and measure the round trip, otherwise measure how long
+        the handler's receive took.
+        """
+        counter = itertools.count()
+        local = threading.local()
+        def one():
+            if counter.next() >= messages:
+                return None
+            ws = getattr(local, 'ws', None)
+            if ws is None:
+                ws = local.ws = self.connect(url, timeout)
+            start = time.time()
+            ws.send(data)
+            if reply and ws.receive(timeout) is None:
+                raise IOError("no reply on websocket %s within %s seconds" % (url, timeout))
+            return time.time() - start, None
+        try:
+            return self._run(one, concurrency, 'messages')
+        finally:
+            for ws in self._websockets.values():
+                ws.close()
+
+    def _run(self, one, concurrency, unit):
+        latencies = []
+        statuses = collections.Counter()
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    res = one()
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    continue
+                if res is None:
+                    return
+                with lock:
+                    latencies.append(res[0])
+                    if res[1] is not None:
+                        statuses[res[1]] += 1
+
+        threads = [threading.Thread(target=worker, name='webkitwindow-load-%d' % (i, )) for i in range(concurrency)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        seconds = time.time() - start
+
+        latencies.sort()
+        return {unit: len(latencies),
+                'errors': len(errors),
+                'seconds': seconds,
+                'per_s': len(latencies) / seconds if seconds else 0.0,
+                'statuses': dict(statuses),
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None}